@@ -40,16 +40,29 @@ rm -f ${DEST_SCRIPT}
 rm -f ${DEST_SCRIPT}.sgn
 
 
+# the settings in source/configuration, to check that the edits
+# below do not clobber any, e.g. BOOT_SERVER_MIRRORS
+config_keys() {
+    sed -n -e "s@^\([A-Za-z_][A-Za-z0-9_]*\)=.*@\1@p" source/configuration
+}
+CONFIG_KEYS=$(config_keys)
+
 # hard code 443 here.
-sed -i -e "s@^BOOT_API_SERVER.*@BOOT_API_SERVER=https://$PLC_API_HOST:443/$PLC_API_PATH/@" source/configuration
+sed -i -e "s@^BOOT_API_SERVER=.*@BOOT_API_SERVER=https://$PLC_API_HOST:443/$PLC_API_PATH/@" source/configuration
 
-sed -i -e "s@^BOOT_SERVER.*@BOOT_SERVER=$PLC_BOOT_HOST@" source/configuration
+sed -i -e "s@^BOOT_SERVER=.*@BOOT_SERVER=$PLC_BOOT_HOST@" source/configuration
 if [ "$PLC_MONITOR_ENABLED" = "1" ]; then
     MONITOR_SERVER=$PLC_MONITOR_HOST
 else
     MONITOR_SERVER=$PLC_BOOT_HOST
 fi
-sed -i -e "s@^MONITOR_SERVER.*@MONITOR_SERVER=$MONITOR_SERVER@" source/configuration
+sed -i -e "s@^MONITOR_SERVER=.*@MONITOR_SERVER=$MONITOR_SERVER@" source/configuration
+
+if [ "$(config_keys)" != "$CONFIG_KEYS" ] ; then
+    echo "build.sh: settings lost while editing source/configuration" >&2
+    diff <(echo "$CONFIG_KEYS") <(config_keys) >&2 || :
+    exit 1
+fi
 
 install -D -m 644 $PLC_BOOT_CA_SSL_CRT source/cacert/$PLC_BOOT_HOST/cacert.pem
 if [ -f "$PLC_MONITOR_CA_SSL_CRT" ] ; then 
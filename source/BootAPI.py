@@ -6,6 +6,7 @@
 # Copyright (c) 2004-2006 The Trustees of Princeton University
 # All rights reserved.
 
+from __future__ import print_function
 
 import xmlrpclib
 import xml.parsers.expat
@@ -13,12 +14,145 @@ import hmac
 import string
 import sha
 import cPickle
+import copy
 import utils
 import os
+import time
+import random
+import bisect
+import errno
+import socket
+import httplib
+import ssl
+import threading
+import traceback
 
 from Exceptions import *
+import KeepAliveTransport
+
+# results of the api calls, indexed on stash_key(function, params),
+# the latest one winning; what was saved on the Stash device by
+# previous runs is only loaded when needed
+stash = {}
+stash_loaded = False
+# (key, result) records not saved yet
+stash_pending = []
+
+# the Stash device holds a journal: a header line, then one pickled
+# (key, result) record per call, appended by successive saves
+STASH_MAGIC = "bootmanager-stash"
+STASH_VERSION = 2
+
+SESSION_FILE = '/etc/planetlab/session'
+# when, and against which server, the session was last found valid
+SESSION_VALIDITY_FILE = '/etc/planetlab/session.valid'
+# in seconds, how long a valid session is trusted without an AuthCheck,
+# unless SESSION_VALIDITY_TTL is set
+DEFAULT_SESSION_VALIDITY_TTL = 3600
+# the PLCAPI fault code for authentication failures
+AUTH_FAULT = 103
+
+# read-only api functions whose results are kept for the rest of the run
+CACHED_FUNCTIONS = ('GetNodes', 'GetInterfaces', 'GetInterfaceTags',
+                    'GetNodeTags', 'GetNodeFlavour', 'GetNodeGroups',
+                    'GetSites')
+# the cached functions whose results may be changed by other functions;
+# any function that is in neither list drops the whole cache
+INVALIDATED_BY = {
+    'BootCheckAuthentication': (),
+    'BootNotifyOwners': (),
+    'BootUpdateNode': ('GetNodes', 'GetInterfaces', 'GetInterfaceTags'),
+    'ReportRunlevel': ('GetNodes',),
+    'UpdateNode': ('GetNodes', 'GetNodeFlavour'),
+    'UpdateInterface': ('GetInterfaces',),
+    'AddNodeTag': ('GetNodeTags', 'GetNodes', 'GetNodeFlavour'),
+    'UpdateNodeTag': ('GetNodeTags', 'GetNodes', 'GetNodeFlavour'),
+    'DeleteNodeTag': ('GetNodeTags', 'GetNodes', 'GetNodeFlavour'),
+    'AddInterfaceTag': ('GetInterfaceTags', 'GetInterfaces'),
+    'UpdateInterfaceTag': ('GetInterfaceTags', 'GetInterfaces'),
+    'DeleteInterfaceTag': ('GetInterfaceTags', 'GetInterfaces'),
+    }
+# for the functions above that take a dict of fields to update, the
+# fields that only change the node record; an update of just those, or
+# an empty one that only records the boot time, only drops GetNodes
+NODE_FIELDS = {
+    'BootUpdateNode': ('boot_state', 'run_level', 'ssh_rsa_key', 'ssh_host_key'),
+    }
+# results of the cached functions, indexed like the stash
+api_cache = {}
+# function -> [hits, misses, prefetched]
+api_cache_counters = {}
+# bumped whenever cached results may have been invalidated, so that
+# results fetched in the background before that are not stored; for
+# the whole cache, and per cached function
+api_cache_generation = 0
+api_cache_generations = {}
+api_cache_lock = threading.Lock()
+# key -> event set once the result is in the cache, for the cached
+# calls being fetched in the background, see prefetch
+prefetching = {}
+# in seconds, how long a call waits for the result of the same call
+# being fetched in the background, before making it itself
+PREFETCH_WAIT = 30
+
+# whether the API server supports system.multicall, until proven otherwise
+multicall_supported = True
+
+# api functions that can safely be sent again when it is not known
+# whether the server got them; the others are only retried when the
+# connection could not even be established
+IDEMPOTENT_FUNCTIONS = CACHED_FUNCTIONS + ('BootCheckAuthentication', 'AuthCheck',
+                                           'BootUpdateNode', 'ReportRunlevel')
+# defaults for the retry and circuit breaker settings in vars; see
+# configuration
+DEFAULT_API_RETRIES = 3
+DEFAULT_API_RETRY_DELAY = 1
+DEFAULT_API_RETRY_MAX_DELAY = 30
+DEFAULT_API_BREAKER_THRESHOLD = 3
+DEFAULT_API_BREAKER_COOLDOWN = 60
+
+# consecutive calls that failed on a transient error, and when the
+# breaker opened, if it did
+breaker_failures = 0
+breaker_opened = None
+breaker_trips = 0
+
+# in seconds, upper bounds of the latency histogram buckets, the last
+# bucket being for anything longer
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# function -> count per bucket
+api_latencies = {}
+# function -> number of retries
+api_retries = {}
+
+def connect(server_url):
+    """
+    return an xmlrpclib.ServerProxy for the API server at server_url,
+    and its transport, that keeps its connection open across calls
+    """
+    api_inst = None
+    # preferred strategy : select tlsv1 as the encryption protocol
+    try:
+        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
+        transport = KeepAliveTransport.KeepAliveTransport(server_url,
+                                                          context=ssl_context)
+        api_inst = xmlrpclib.ServerProxy(server_url,
+                                         transport=transport,
+                                         verbose=0)
+    # this is only supported in python >= 2.7.9 though, so allow for failure
+    except:
+        print("Default xmlrpclib strategy failed")
+        traceback.print_exc()
+        pass
+
+    # if that failed, resort to the old-fashioned code
+    if api_inst is None:
+        transport = KeepAliveTransport.KeepAliveTransport(server_url)
+        api_inst = xmlrpclib.ServerProxy(server_url,
+                                         transport=transport,
+                                         verbose=0)
+    return (api_inst, transport)
 
-stash = None
 
 def create_auth_structure(vars, call_params):
     """
@@ -37,12 +171,20 @@ def create_auth_structure(vars, call_params):
 
         if not vars.has_key('NODE_SESSION'):
             # Try to load /etc/planetlab/session if it exists.
-            sessionfile = open('/etc/planetlab/session', 'r')
+            sessionfile = open(SESSION_FILE, 'r')
             session = sessionfile.read().strip()
 
             auth_session['session'] = session
-            # Test session.  Faults if it's no good.
-            vars['API_SERVER_INST'].AuthCheck(auth_session)
+            server_url = vars.get('BOOT_API_SERVER', '')
+            ttl = int(vars.get('SESSION_VALIDITY_TTL', DEFAULT_SESSION_VALIDITY_TTL))
+            if session_known_good(session, server_url, ttl):
+                # checked by a recent run; call_api_function gets
+                # a new one if it turns out to have expired since
+                vars['NODE_SESSION_UNCHECKED'] = True
+            else:
+                # Test session.  Faults if it's no good.
+                vars['API_SERVER_INST'].AuthCheck(auth_session)
+                mark_session_good(session, server_url)
             vars['NODE_SESSION'] = session
 
             sessionfile.close()
@@ -72,9 +214,10 @@ def create_auth_structure(vars, call_params):
                 # RunlevelAgent and future BootManager runs
                 if not os.path.exists("/etc/planetlab"):
                     os.makedirs("/etc/planetlab")
-                sessionfile = open('/etc/planetlab/session', 'w')
+                sessionfile = open(SESSION_FILE, 'w')
                 sessionfile.write(vars['NODE_SESSION'])
                 sessionfile.close()
+                mark_session_good(session, vars.get('BOOT_API_SERVER', ''))
             else:
                 auth_session['session'] = vars['NODE_SESSION']
 
@@ -88,6 +231,45 @@ def create_auth_structure(vars, call_params):
     return auth
 
 
+def session_fingerprint(session, server_url):
+    return sha.new("{} {}".format(server_url, session)).hexdigest()
+
+def session_known_good(session, server_url, ttl):
+    """
+    whether session was found valid by server_url less than ttl
+    seconds ago
+    """
+    try:
+        (stamp, fingerprint) = open(SESSION_VALIDITY_FILE).read().split()
+        return fingerprint == session_fingerprint(session, server_url) \
+            and time.time() - float(stamp) < ttl
+    except (IOError, ValueError):
+        return False
+
+def mark_session_good(session, server_url):
+    try:
+        with open(SESSION_VALIDITY_FILE, 'w') as validity:
+            validity.write("{} {}\n".format(int(time.time()),
+                                           session_fingerprint(session, server_url)))
+    except IOError:
+        pass
+
+def forget_session_validity():
+    try:
+        os.unlink(SESSION_VALIDITY_FILE)
+    except OSError:
+        pass
+
+def revalidate_session(vars):
+    """
+    the session that was used without an AuthCheck got rejected, make
+    the next create_auth_structure check it, or get a new one
+    """
+    forget_session_validity()
+    vars.pop('NODE_SESSION_UNCHECKED', None)
+    vars.pop('NODE_SESSION', None)
+
+
 def serialize_params(call_params):
     """
     convert a list of parameters into a format that will be used in the
@@ -127,7 +309,6 @@ def call_api_function(vars, function, user_params):
 
     If the call fails, a BootManagerException is raised.
     """
-    global stash
 
     try:
         api_server = vars['API_SERVER_INST']
@@ -135,13 +316,16 @@ def call_api_function(vars, function, user_params):
         raise BootManagerException("No connection to the API server exists.")
 
     if api_server is None:
-        if not stash:
-            load(vars)
-        for i in stash:
-            if i[0] == function and i[1] == user_params:
-               return i[2]
-        raise BootManagerException(
-              "Disconnected operation failed, insufficient stash.")
+        return stash_lookup(vars, function, user_params)
+
+    (hit, rc) = cache_lookup(function, user_params)
+    if hit:
+        return rc
+    cache_invalidate(function, user_params)
+
+    # the API server is believed to be down
+    if breaker_open(vars):
+        return stash_lookup(vars, function, user_params)
 
     auth = create_auth_structure(vars,user_params)
     if auth is None:
@@ -152,12 +336,15 @@ def call_api_function(vars, function, user_params):
     params = params + user_params
 
     try:
-        exec("rc= api_server.{}(*params)".format(function))
-        if stash is None:
-            stash = []
-        stash += [ [ function, user_params, rc ] ]
+        rc = call_with_policy(vars, (function,), function,
+                              lambda: getattr(api_server, function)(*params))
+        stash_result(function, user_params, rc)
+        cache_store(function, user_params, rc)
         return rc
     except xmlrpclib.Fault as fault:
+        if fault.faultCode == AUTH_FAULT and vars.get('NODE_SESSION_UNCHECKED'):
+            revalidate_session(vars)
+            return call_api_function(vars, function, user_params)
         raise BootManagerException("API Fault: {}".format(fault))
     except xmlrpclib.ProtocolError as err:
         raise BootManagerException("XML RPC protocol error: {}".format(err))
@@ -165,6 +352,241 @@ def call_api_function(vars, function, user_params):
         raise BootManagerException("XML parsing error: {}".format(err))
 
 
+def call_api_batch(vars, calls, raise_faults=True):
+    """
+    call several api functions in a single round trip to the API
+    server, using system.multicall. calls is a list of (function,
+    user_params) tuples, and the values they returned are given back
+    as a list, in the same order. Authentication and the stash are
+    handled as in call_api_function.
+
+    If a call fails, a BootManagerException is raised, unless
+    raise_faults is false, in which case the exception takes the
+    place of the value in the returned list.
+
+    When disconnected, when the API server does not support multicall,
+    or when it is believed to be down, the functions are called one
+    after the other. Reads found in the cache are not sent to the server.
+    """
+    global multicall_supported
+
+    try:
+        api_server = vars['API_SERVER_INST']
+    except KeyError as e:
+        raise BootManagerException("No connection to the API server exists.")
+
+    if api_server is None or not multicall_supported or breaker_open(vars):
+        return call_api_serial(vars, calls, raise_faults)
+
+    # the writes drop what they may change before any read is
+    # looked up, the reads found in the cache are answered locally
+    for function, user_params in calls:
+        cache_invalidate(function, user_params)
+    values = [ None ] * len(calls)
+    remote = []
+    for i, (function, user_params) in enumerate(calls):
+        (hit, rc) = cache_lookup(function, user_params)
+        if hit:
+            values[i] = rc
+        else:
+            remote.append(i)
+    if not remote:
+        return values
+
+    auth = create_auth_structure(vars, ())
+    if auth is None:
+        raise BootManagerException(
+              "Could not create auth structure, missing values.")
+
+    multicall = xmlrpclib.MultiCall(api_server)
+    for i in remote:
+        (function, user_params) = calls[i]
+        getattr(multicall, function)(auth, *user_params)
+
+    try:
+        results = call_with_policy(vars, [ calls[i][0] for i in remote ],
+                                   'system.multicall', multicall)
+    except xmlrpclib.Fault as fault:
+        # the calls themselves fault individually, see below
+        multicall_supported = False
+        serial = call_api_serial(vars, [ calls[i] for i in remote ], raise_faults)
+        for i, rc in zip(remote, serial):
+            values[i] = rc
+        return values
+    except xmlrpclib.ProtocolError as err:
+        raise BootManagerException("XML RPC protocol error: {}".format(err))
+    except xml.parsers.expat.ExpatError as err:
+        raise BootManagerException("XML parsing error: {}".format(err))
+
+    # calls rejected because of an expired session, and calls that
+    # got an answer in an unexpected shape, made again one by one
+    retry = []
+    malformed = []
+    for j, i in enumerate(remote):
+        (function, user_params) = calls[i]
+        try:
+            rc = results[j]
+        except (ValueError, TypeError, KeyError, IndexError):
+            # a fault without its code or string, neither a fault nor a
+            # one-element list, or missing altogether
+            malformed.append(i)
+            continue
+        except xmlrpclib.Fault as fault:
+            if fault.faultCode == AUTH_FAULT and vars.get('NODE_SESSION_UNCHECKED'):
+                retry.append(i)
+                continue
+            e = BootManagerException("API Fault: {}".format(fault))
+            if raise_faults:
+                raise e
+            values[i] = e
+            continue
+        stash_result(function, user_params, rc)
+        cache_store(function, user_params, rc)
+        values[i] = rc
+
+    if retry:
+        revalidate_session(vars)
+        serial = call_api_serial(vars, [ calls[i] for i in retry ], raise_faults)
+        for i, rc in zip(retry, serial):
+            values[i] = rc
+    if malformed:
+        serial = call_api_serial(vars, [ calls[i] for i in malformed ], raise_faults)
+        for i, rc in zip(malformed, serial):
+            values[i] = rc
+    return values
+
+
+def stash_lookup(vars, function, user_params):
+    """
+    return the result of the call from the stash, when the API server
+    cannot be reached
+    """
+    if not stash_loaded and vars.get('DISCONNECTED_OPERATION'):
+        load(vars)
+    key = stash_key(function, user_params)
+    if key in stash:
+        return stash[key]
+    raise BootManagerException(
+          "Disconnected operation failed, insufficient stash.")
+
+
+def is_transient(err):
+    """
+    whether err may go away if the call is made again
+    """
+    if isinstance(err, xmlrpclib.ProtocolError):
+        return err.errcode >= 500
+    return isinstance(err, (socket.error, httplib.HTTPException,
+                            xml.parsers.expat.ExpatError))
+
+def never_sent(err):
+    """
+    whether err tells that the request could not have reached the server
+    """
+    if isinstance(err, socket.gaierror):
+        return True
+    return isinstance(err, socket.error) and \
+        err.errno in (errno.ECONNREFUSED, errno.ENETUNREACH, errno.EHOSTUNREACH)
+
+def call_with_policy(vars, functions, label, send):
+    """
+    return send(), the round trip to the API server for functions,
+    made again after a growing random delay when it fails on a
+    transient error, as long as all functions are idempotent or the
+    request was never sent. label is the name under which the latency
+    and the retries are counted.
+
+    The last error is raised once the retries are exhausted, and
+    counts as a failure of the API server for the circuit breaker.
+    """
+    global breaker_failures, breaker_opened, breaker_trips
+
+    retries = min(int(vars.get('API_RETRIES_' + function,
+                               vars.get('API_RETRIES', DEFAULT_API_RETRIES)))
+                  for function in functions)
+    idempotent = all(function in IDEMPOTENT_FUNCTIONS for function in functions)
+    delay = float(vars.get('API_RETRY_DELAY', DEFAULT_API_RETRY_DELAY))
+    max_delay = float(vars.get('API_RETRY_MAX_DELAY', DEFAULT_API_RETRY_MAX_DELAY))
+
+    attempt = 0
+    while True:
+        start = time.time()
+        try:
+            result = send()
+        except xmlrpclib.Fault:
+            # the server is up, and said no
+            record_latency(label, time.time() - start)
+            breaker_failures = 0
+            breaker_opened = None
+            raise
+        except Exception as err:
+            record_latency(label, time.time() - start)
+            if not is_transient(err):
+                raise
+            if attempt < retries and (idempotent or never_sent(err)):
+                attempt += 1
+                api_retries[label] = api_retries.get(label, 0) + 1
+                # full jitter, so that nodes do not retry in lockstep
+                time.sleep(random.uniform(0, min(max_delay, delay * 2 ** (attempt - 1))))
+                continue
+            breaker_failures += 1
+            threshold = int(vars.get('API_BREAKER_THRESHOLD',
+                                     DEFAULT_API_BREAKER_THRESHOLD))
+            if breaker_failures >= threshold:
+                if breaker_opened is None:
+                    breaker_trips += 1
+                breaker_opened = time.time()
+            raise
+        record_latency(label, time.time() - start)
+        breaker_failures = 0
+        breaker_opened = None
+        return result
+
+def breaker_open(vars):
+    """
+    whether the API server failed too often lately to be tried again
+    yet; once the cooldown is over, one call is let through, and the
+    breaker closes if it succeeds, or opens again if it fails
+    """
+    if breaker_opened is None:
+        return False
+    cooldown = float(vars.get('API_BREAKER_COOLDOWN', DEFAULT_API_BREAKER_COOLDOWN))
+    return time.time() - breaker_opened < cooldown
+
+def record_latency(label, elapsed):
+    counts = api_latencies.setdefault(label, [0] * (len(LATENCY_BUCKETS) + 1))
+    counts[bisect.bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+
+def policy_counters():
+    """
+    return the latency histogram and the number of retries per
+    function, and how many times the circuit breaker opened
+    """
+    names = [ "<={}".format(bound) for bound in LATENCY_BUCKETS ] \
+            + [ ">{}".format(LATENCY_BUCKETS[-1]) ]
+    return {
+        'latency': dict((label, dict(zip(names, counts)))
+                        for label, counts in api_latencies.items()),
+        'retries': dict(api_retries),
+        'breaker_trips': breaker_trips,
+        }
+
+
+def call_api_serial(vars, calls, raise_faults=True):
+    """
+    same as call_api_batch, with one call_api_function per call
+    """
+    values = []
+    for function, user_params in calls:
+        try:
+            values.append(call_api_function(vars, function, user_params))
+        except BootManagerException as e:
+            if raise_faults:
+                raise
+            values.append(e)
+    return values
+
+
 class Stash(file):
     mntpnt = '/tmp/stash'
     def __init__(self, vars, mode):
@@ -183,15 +605,260 @@ class Stash(file):
         file.close(self)
         utils.sysexec_noerr('umount {}'.format(self.mntpnt))
 
+def canonical_params(params):
+    """
+    return a hashable version of params, where dicts no longer depend
+    on the order of their keys
+    """
+    if isinstance(params, dict):
+        return ('dict',) + tuple(sorted((key, canonical_params(value))
+                                        for key, value in params.items()))
+    if isinstance(params, (list, tuple)):
+        return tuple(canonical_params(param) for param in params)
+    return params
+
+def stash_key(function, user_params):
+    return (function, canonical_params(user_params))
+
+def stash_result(function, user_params, rc):
+    """
+    remember the result of an api call, to be saved on the Stash device
+    """
+    key = stash_key(function, user_params)
+    stash[key] = rc
+    stash_pending.append((key, rc))
+
+def cache_lookup(function, user_params):
+    """
+    return (True, result) if the result of this read is in the cache,
+    (False, None) otherwise
+    """
+    if function not in CACHED_FUNCTIONS:
+        return (False, None)
+    counters = api_cache_counters.setdefault(function, [0, 0, 0])
+    key = stash_key(function, user_params)
+    event = prefetching.get(key)
+    if event is not None:
+        event.wait(PREFETCH_WAIT)
+    if key in api_cache:
+        counters[0] += 1
+        # callers are free to modify what they get
+        return (True, copy.deepcopy(api_cache[key]))
+    counters[1] += 1
+    return (False, None)
+
+def cache_generation(function):
+    """
+    return what cache_store compares to tell whether the results of
+    function may have been invalidated in the meantime
+    """
+    return (api_cache_generation, api_cache_generations.get(function, 0))
+
+def cache_store(function, user_params, rc, generation=None):
+    """
+    keep the result of a read in the cache; with generation, as
+    returned by cache_generation when the read was sent, only if its
+    results were not invalidated since
+    """
+    if function not in CACHED_FUNCTIONS:
+        return
+    with api_cache_lock:
+        if generation is None or generation == cache_generation(function):
+            api_cache[stash_key(function, user_params)] = copy.deepcopy(rc)
+
+def cache_invalidate(function, user_params=()):
+    """
+    drop the cached results that a call to function with user_params
+    may change
+    """
+    global api_cache_generation
+    if function in CACHED_FUNCTIONS:
+        return
+    with api_cache_lock:
+        if function not in INVALIDATED_BY:
+            api_cache_generation += 1
+            api_cache.clear()
+            return
+        invalidated = INVALIDATED_BY[function]
+        if function in NODE_FIELDS:
+            fields = set()
+            for param in user_params:
+                if isinstance(param, dict):
+                    fields.update(param.keys())
+            if fields.issubset(NODE_FIELDS[function]):
+                invalidated = ('GetNodes',)
+        for name in invalidated:
+            api_cache_generations[name] = api_cache_generations.get(name, 0) + 1
+        for key in api_cache.keys():
+            if key[0] in invalidated:
+                del api_cache[key]
+
+def cache_counters():
+    """
+    return the number of cache hits and misses, and of results
+    prefetched, per function
+    """
+    return dict((function, { 'hits': hits, 'misses': misses,
+                             'prefetched': prefetched })
+                for function, (hits, misses, prefetched)
+                in api_cache_counters.items())
+
+def prefetch(vars, calls, followup=None):
+    """
+    fetch the results of the cached calls, a list of (function,
+    user_params) tuples, in the background, and load them into the
+    cache, so that they are at hand when a later step makes these
+    calls. followup, if set, is given the list of results (None for
+    the calls that failed), and returns the list of calls to prefetch
+    next.
+
+    This uses a connection of its own, and the current authentication
+    structure. A call made while the same call is being prefetched
+    waits for it.
+    """
+    if vars.get('API_SERVER_INST') is None:
+        return
+    auth = create_auth_structure(vars, ())
+    if auth is None:
+        return
+    (api_server, transport) = connect(vars['BOOT_API_SERVER'])
+
+    def _register(calls):
+        for function, user_params in calls:
+            prefetching.setdefault(stash_key(function, user_params),
+                                   threading.Event())
+
+    def _fetch(calls):
+        if multicall_supported:
+            multicall = xmlrpclib.MultiCall(api_server)
+            for function, user_params in calls:
+                getattr(multicall, function)(auth, *user_params)
+            results = multicall()
+        else:
+            results = [ getattr(api_server, function)(auth, *user_params)
+                        for function, user_params in calls ]
+        values = []
+        for i in range(len(calls)):
+            try:
+                values.append(results[i])
+            except xmlrpclib.Fault:
+                values.append(None)
+        return values
+
+    def _run(calls, followup):
+        while calls:
+            generations = [ cache_generation(function) for function, user_params in calls ]
+            try:
+                values = _fetch(calls)
+            except Exception:
+                # best effort, the steps will make the calls themselves
+                values = [ None ] * len(calls)
+            for (function, user_params), rc, generation in zip(calls, values, generations):
+                if rc is not None:
+                    stash_result(function, user_params, rc)
+                    cache_store(function, user_params, rc, generation)
+                    api_cache_counters.setdefault(function, [0, 0, 0])[2] += 1
+            done = calls
+            calls = []
+            if followup is not None:
+                try:
+                    calls = followup(values)
+                except Exception:
+                    pass
+                followup = None
+                _register(calls)
+            # only now, so that the calls that follow are known to be
+            # on their way by the time the waiting steps go on
+            for function, user_params in done:
+                event = prefetching.pop(stash_key(function, user_params), None)
+                if event is not None:
+                    event.set()
+
+    _register(calls)
+    thread = threading.Thread(target=_run, args=(calls, followup))
+    thread.daemon = True
+    thread.start()
+
+def read_journal(f):
+    """
+    return the list of (key, result) records in the journal f, oldest
+    first, and whether f is in the current format
+    """
+    header = f.readline()
+    if not header:
+        return ([], True)
+
+    if not header.startswith(STASH_MAGIC):
+        # a pickled list of [function, user_params, rc], as saved by
+        # older versions
+        f.seek(0)
+        return ([ (stash_key(function, user_params), rc)
+                  for (function, user_params, rc) in cPickle.load(f) ], False)
+
+    version = int(header.split()[1])
+    if version != STASH_VERSION:
+        raise BootManagerException("Unsupported API-cache version {}".format(version))
+
+    records = []
+    while True:
+        # a truncated record raises EOFError too
+        position = f.tell()
+        if not f.read(1):
+            break
+        f.seek(position)
+        try:
+            records.append(cPickle.load(f))
+        except Exception:
+            # the last save was interrupted half-way, the journal
+            # needs to be rewritten before anything is appended
+            return (records, False)
+    return (records, True)
+
 def load(vars):
-    global stash
-    s = Stash(vars, 'r')
-    stash = cPickle.load(s)
-    s.close()
+    global stash, stash_loaded
+    s = Stash(vars, 'rb')
+    try:
+        (records, current) = read_journal(s)
+    finally:
+        s.close()
+
+    # what this run got from the API server is more recent
+    loaded = dict(records)
+    loaded.update(stash)
+    stash = loaded
+    stash_loaded = True
 
 def save(vars):
-    global stash
-    if vars['DISCONNECTED_OPERATION']:
-        s = Stash(vars, 'w')
-        cPickle.dump(stash, s)
+    """
+    append the results obtained since the last save to the journal on
+    the Stash device, and rewrite it with only the latest result per
+    call once it holds more than twice as many records as calls
+    """
+    global stash_pending
+    if not vars['DISCONNECTED_OPERATION'] or not stash_pending:
+        return
+
+    s = Stash(vars, 'r+b')
+    try:
+        (records, current) = read_journal(s)
+        latest = dict(records)
+        latest.update(stash_pending)
+
+        if current and len(records) + len(stash_pending) <= 2 * len(latest):
+            if not records:
+                s.seek(0)
+                s.truncate()
+                s.write("{} {}\n".format(STASH_MAGIC, STASH_VERSION))
+            s.seek(0, os.SEEK_END)
+            for record in stash_pending:
+                cPickle.dump(record, s, cPickle.HIGHEST_PROTOCOL)
+        else:
+            compacted = s.name + ".new"
+            with open(compacted, 'wb') as f:
+                f.write("{} {}\n".format(STASH_MAGIC, STASH_VERSION))
+                for record in latest.items():
+                    cPickle.dump(record, f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(compacted, s.name)
+    finally:
         s.close()
+    stash_pending = []
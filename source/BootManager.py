@@ -9,19 +9,37 @@
 from __future__ import print_function
 
 import sys, os
+
+# time the imports from here on, see ImportProfile
+IMPORT_PROFILE = "--import-profile" in sys.argv
+if IMPORT_PROFILE:
+    import ImportProfile
+    ImportProfile.install()
+
 import traceback
 import string
 import time
 import gzip
+import json
+import atexit
+import threading
+import Queue
 
+import steps
 from steps import *
 from Exceptions import *
 import notify_messages
 import BootServerRequest
+import BootAPI
 import utils
+import Timeline
+from StepScheduler import StepScheduler, Step
+from InstallCheckpoint import InstallCheckpoint
 
 # all output is written to this file
 BM_NODE_LOG = "/tmp/bm.log"
+# and the time spent in each step and command, to this one
+BM_NODE_TIMELINE = "/tmp/bm-timeline.json"
 VARS_FILE = "configuration"
 
 # the new contents of PATH when the boot manager is running
@@ -68,43 +86,117 @@ def read_configuration_file(filename):
 
     return vars
 
+# time every step as it gets imported, see Timeline
+steps.import_hooks.append(Timeline.instrument)
+
+# the vars that tell, in the timeline, which node and which run it is about
+TIMELINE_VARS = ('NODE_ID', 'BOOT_STATE', 'RUN_LEVEL', 'VERSION',
+                 'BOOT_CD_VERSION', 'nodefamily')
+
 ##############################
+class LogFile:
+    """
+    what log.OutputFile stands for: what is written there goes to the
+    log file only, in order with the log entries
+    """
+
+    def __init__(self, log):
+        self.log = log
+
+    def write(self, str):
+        self.log.queue.put((log.ENTRY, str, None, False))
+
+    def flush(self):
+        self.log.flush()
+
+    def close(self):
+        self.log.close()
+
+
 class log:
 
     format = "%H:%M:%S(%Z) "
 
+    # what the writer thread gets from the queue
+    ENTRY, FLUSH, CLOSE, STOP = range(4)
+
+    # the file is flushed once that many bytes were written to it, or
+    # that many seconds after the first one that was not flushed
+    flush_size = 65536
+    flush_interval = 2.0
+    # at most that many bytes per second are shown on the screen; the
+    # rest is only in the file
+    screen_rate = 4096
+    # a shorter LOG_FLUSH_INTERVAL would keep the writer thread spinning
+    min_flush_interval = 0.1
+
+    # display_screen for the entries shown whatever screen_rate says
+    ALWAYS = 2
+
     def __init__(self, OutputFilePath=None):
+        # entries are written by a thread of their own, so that a slow
+        # console does not hold back the boot
+        self.queue = Queue.Queue()
+        self.file = None
+        self.stamp = (None, "")
         try:
-            self.OutputFile = open(OutputFilePath, "w")
+            self.file = open(OutputFilePath, "w")
+            self.OutputFile = LogFile(self)
             self.OutputFilePath = OutputFilePath
         except:
             print("bootmanager log : Unable to open output file {}, continuing"\
                   .format(OutputFilePath))
             self.OutputFile = None
 
+        # the settings are read before the writer thread starts using them;
+        # what gets logged meanwhile waits in the queue
         self.VARS = None
         try:
             vars = read_configuration_file(VARS_FILE)
             self.VARS = vars
         except Exception, e:
             self.LogEntry(str(e))
-            return
+        else:
+            self.Configure(vars)
 
-    def LogEntry(self, str, inc_newline = 1, display_screen = 1):
-        now = time.strftime(log.format, time.localtime())
-        if self.OutputFile:
-            self.OutputFile.write(now + str)
-        if display_screen:
-            sys.stdout.write(now + str)
+        self.writer = threading.Thread(target=self.Drain, name="log")
+        self.writer.setDaemon(True)
+        self.writer.start()
+        # whatever happens, do not lose the end of the log
+        atexit.register(self.Wait, log.STOP)
 
-        if inc_newline:
-            if display_screen:
-                sys.stdout.write("\n")
-            if self.OutputFile:
-                self.OutputFile.write("\n")
+    def Configure(self, vars):
+        """
+        take the LOG_* settings from vars
+        """
+        try:
+            flush_size = int(vars.get('LOG_FLUSH_SIZE', self.flush_size))
+            flush_interval = max(log.min_flush_interval,
+                                 float(vars.get('LOG_FLUSH_INTERVAL', self.flush_interval)))
+            screen_rate = int(vars.get('LOG_SCREEN_RATE', self.screen_rate))
+        except ValueError as e:
+            self.LogEntry("Invalid log setting, using defaults: {}".format(e))
+            return
+        (self.flush_size, self.flush_interval, self.screen_rate) = \
+            (flush_size, flush_interval, screen_rate)
 
-        if self.OutputFile:
-            self.OutputFile.flush()
+    def LogEntry(self, str, inc_newline = 1, display_screen = 1, when = None):
+        """
+        log str, stamped with the current time or with when, a time
+        as returned by time.time(); with display_screen set to
+        log.ALWAYS, str is shown on the screen even past screen_rate
+        """
+        # strftime once per second at most
+        now = int(time.time() if when is None else when)
+        if self.stamp[0] != now:
+            self.stamp = (now, time.strftime(log.format, time.localtime(now)))
+        entry = self.stamp[1] + str
+        if inc_newline:
+            entry += "\n"
+        self.queue.put((log.ENTRY,
+                        entry if self.OutputFile else None,
+                        entry if display_screen else None,
+                        display_screen == log.ALWAYS))
 
     def write(self, str):
         """
@@ -113,51 +205,204 @@ class log:
         """
         self.LogEntry(str, 0, 1)
 
+    def LogError(self, str):
+        """
+        same as write, for errors, that are always shown on the screen
+        """
+        self.LogEntry(str, 0, log.ALWAYS)
+
+    def flush(self):
+        """
+        wait until everything logged so far is in the file and on the screen
+        """
+        self.Wait(log.FLUSH)
+
+    def close(self):
+        """
+        flush, and close the file; entries are shown on the screen only
+        from then on
+        """
+        self.Wait(log.CLOSE)
+        self.OutputFile = None
+
+    def Wait(self, kind):
+        done = threading.Event()
+        self.queue.put((kind, done, None, False))
+        # a timeout keeps the wait interruptible
+        while self.writer.is_alive() and not done.wait(1):
+            pass
+
+    def Drain(self):
+        """
+        the writer thread: write the entries to the file and, as long
+        as screen_rate allows, on the screen
+        """
+        unflushed = 0
+        first_unflushed = None
+        budget = self.screen_rate
+        last_refill = time.time()
+        hidden = 0
+        while True:
+            try:
+                (kind, text, screen, always) = self.queue.get(True, self.flush_interval)
+            except Queue.Empty:
+                (kind, text, screen, always) = (None, None, None, False)
+            now = time.time()
+
+            if kind == log.ENTRY:
+                if text and self.file:
+                    self.file.write(text)
+                    unflushed += len(text)
+                    if first_unflushed is None:
+                        first_unflushed = now
+                if screen:
+                    budget = min(self.screen_rate,
+                                 budget + (now - last_refill) * self.screen_rate)
+                    last_refill = now
+                    if len(screen) <= budget or always:
+                        budget = max(0, budget - len(screen))
+                        if hidden:
+                            sys.stdout.write("[{} bytes not shown, see {}]\n"
+                                             .format(hidden, BM_NODE_LOG))
+                            hidden = 0
+                        sys.stdout.write(screen)
+                    else:
+                        hidden += len(screen)
+
+            forced = kind in (log.FLUSH, log.CLOSE, log.STOP)
+            if self.file and unflushed and \
+                   (forced or unflushed >= self.flush_size
+                    or now - first_unflushed >= self.flush_interval):
+                self.file.flush()
+                unflushed = 0
+                first_unflushed = None
+            if forced:
+                if hidden:
+                    sys.stdout.write("[{} bytes not shown, see {}]\n"
+                                     .format(hidden, BM_NODE_LOG))
+                    hidden = 0
+                sys.stdout.flush()
+                if kind != log.FLUSH and self.file:
+                    self.file.close()
+                    self.file = None
+                text.set()
+                if kind == log.STOP:
+                    return
+
     def print_stack(self):
         """
         dump current stack in log
         """
-        self.write(traceback.format_exc())
+        self.LogError(traceback.format_exc())
+        self.flush()
+
+    def LogTransfers(self):
+        """
+        dump in the log, one json record per line, the telemetry of the
+        transfers made with the boot servers so far, and the counters of
+        the calls made to the API server, of its cache, and the latencies
+        and retries seen by the calls
+        """
+        transport = self.VARS.get('API_TRANSPORT')
+        if transport is not None:
+            self.LogEntry("api " + json.dumps(transport.counters(), sort_keys=True),
+                          display_screen = 0)
+        self.LogEntry("api cache " + json.dumps(BootAPI.cache_counters(), sort_keys=True),
+                      display_screen = 0)
+        self.LogEntry("api policy " + json.dumps(BootAPI.policy_counters(), sort_keys=True),
+                      display_screen = 0)
+
+        transfers = BootServerRequest.BootServerRequest.TRANSFERS
+        if not transfers:
+            return
+        self.LogEntry("Transfer telemetry for {} requests:".format(len(transfers)),
+                      display_screen = 0)
+        for record in transfers:
+            self.LogEntry("transfer " + json.dumps(record, sort_keys=True),
+                          display_screen = 0)
+        del transfers[:]
+
+    def LogImportProfile(self):
+        """
+        with --import-profile, log how long each module took to import
+        """
+        if not IMPORT_PROFILE:
+            return
+        self.LogEntry("Import profile (own ms, cumulative ms, module):")
+        for (name, own, total) in ImportProfile.report():
+            self.LogEntry("{:10.1f} {:10.1f}  {}".format(own * 1000, total * 1000, name))
+
+    def SaveTimeline(self):
+        """
+        write the timeline of the steps and commands run so far,
+        return True if it could be saved
+        """
+        info = dict((name, self.VARS.get(name)) for name in TIMELINE_VARS)
+        settings = self.VARS.get('INTERFACE_SETTINGS', {})
+        info['hostname'] = "{}.{}".format(settings.get('hostname'),
+                                          settings.get('domainname'))
+        try:
+            Timeline.save(BM_NODE_TIMELINE, info)
+        except (IOError, TypeError, ValueError) as e:
+            self.LogEntry("Unable to save the timeline: {}".format(e))
+            return False
+        self.LogEntry("Timeline saved in {}".format(BM_NODE_TIMELINE),
+                      display_screen = 0)
+        return True
 
     # bm log uploading is available back again, as of nodeconfig-5.0-2
     def Upload(self, extra_file=None):
         """
-        upload the contents of the log to the server
+        upload the contents of the log to the server, and the timeline
+        next to it
         """
         if self.OutputFile is not None:
-            self.OutputFile.flush()
+            self.LogTransfers()
+            self.LogImportProfile()
+            timeline = self.SaveTimeline()
 
             self.LogEntry("Uploading logs to {}".format(self.VARS['UPLOAD_LOG_SCRIPT']))
 
-            self.OutputFile.close()
-            self.OutputFile = None
+            self.close()
 
             hostname = self.VARS['INTERFACE_SETTINGS']['hostname'] + "." + \
                        self.VARS['INTERFACE_SETTINGS']['domainname']
-            bs_request = BootServerRequest.BootServerRequest(self.VARS)
-            try:
-                # this was working until f10
-                bs_request.MakeRequest(PartialPath = self.VARS['UPLOAD_LOG_SCRIPT'],
-                                       GetVars = None, PostVars = None,
-                                       DoSSL = True, DoCertCheck = True,
-                                       FormData = ["log=@" + self.OutputFilePath,
-                                                   "hostname=" + hostname,
-                                                   "type=bm.log"])
-            except:
-                # new pycurl
-                import pycurl
-                bs_request.MakeRequest(PartialPath = self.VARS['UPLOAD_LOG_SCRIPT'],
-                                       GetVars = None, PostVars = None,
-                                       DoSSL = True, DoCertCheck = True,
-                                       FormData = [('log',(pycurl.FORM_FILE, self.OutputFilePath)),
-                                                   ("hostname",hostname),
-                                                   ("type","bm.log")])
+            self.UploadFile(self.OutputFilePath, hostname, "bm.log")
+            if timeline:
+                # the log is closed already, and this is optional anyway
+                try:
+                    self.UploadFile(BM_NODE_TIMELINE, hostname, "bm.timeline")
+                except:
+                    pass
         if extra_file is not None:
             # NOTE: for code-reuse, evoke the bash function 'upload_logs';
             # by adding --login, bash reads .bash_profile before execution.
             # Also, never fail, since this is an optional feature.
             utils.sysexec_noerr("""bash --login -c "upload_logs {}" """.format(extra_file), self)
 
+    def UploadFile(self, path, hostname, type):
+        """
+        post a file to the log upload script
+        """
+        bs_request = BootServerRequest.BootServerRequest(self.VARS)
+        try:
+            # this was working until f10
+            bs_request.MakeRequest(PartialPath = self.VARS['UPLOAD_LOG_SCRIPT'],
+                                   GetVars = None, PostVars = None,
+                                   DoSSL = True, DoCertCheck = True,
+                                   FormData = ["log=@" + path,
+                                               "hostname=" + hostname,
+                                               "type=" + type])
+        except:
+            # new pycurl
+            import pycurl
+            bs_request.MakeRequest(PartialPath = self.VARS['UPLOAD_LOG_SCRIPT'],
+                                   GetVars = None, PostVars = None,
+                                   DoSSL = True, DoCertCheck = True,
+                                   FormData = [('log',(pycurl.FORM_FILE, path)),
+                                               ("hostname",hostname),
+                                               ("type",type)])
+
 
 ##############################
 class BootManager:
@@ -215,6 +460,9 @@ class BootManager:
         at the top of each of the invididual step functions.
         """
 
+        # runs the independent steps side by side, see StepScheduler
+        scheduler = StepScheduler(self.VARS, self.LOG)
+
         def _nodeNotInstalled(message='MSG_NODE_NOT_INSTALLED'):
             # called by the _xxxState() functions below upon failure
             self.VARS['RUN_LEVEL'] = 'failboot'
@@ -232,25 +480,24 @@ class BootManager:
             # starting the fallback/debug ssh daemon for safety:
             # if the node install somehow hangs, or if it simply takes ages,
             # we can still enter and investigate
-            try:
-                StartDebug.Run(self.VARS, self.LOG, last_resort = False)
-            except:
-                pass
-
-            InstallInit.Run(self.VARS, self.LOG)
-            ret = ValidateNodeInstall.Run(self.VARS, self.LOG)
+            ret = scheduler.run([
+                Step(StartDebug, last_resort = False, optional = True),
+                Step(InstallInit),
+                Step(ValidateNodeInstall)])[-1]
             if ret == 1:
+                boot_steps = []
 # Thierry - feb. 2013 turning off WriteModprobeConfig for now on lxc
 # for one thing this won't work at all with f18, as modules.pcimap
 # has disappeared (Daniel suggested modules.aliases could be used instead)
 # and second, in any case it's been years now that modprobe.conf was deprecated
 # so most likely this code has no actual effect
                 if self.VARS['virt'] == 'vs':
-                    WriteModprobeConfig.Run(self.VARS, self.LOG)
-                WriteNetworkConfig.Run(self.VARS, self.LOG)
-                CheckForNewDisks.Run(self.VARS, self.LOG)
-                SendHardwareConfigToPLC.Run(self.VARS, self.LOG)
-                ChainBootNode.Run(self.VARS, self.LOG)
+                    boot_steps.append(Step(WriteModprobeConfig))
+                boot_steps += [Step(WriteNetworkConfig),
+                               Step(CheckForNewDisks),
+                               Step(SendHardwareConfigToPLC),
+                               Step(ChainBootNode)]
+                scheduler.run(boot_steps)
             elif ret == -1:
                 _nodeNotInstalled('MSG_NODE_FILESYSTEM_CORRUPT')
             elif ret == -2:
@@ -262,31 +509,50 @@ class BootManager:
 
         def _reinstallRun(upgrade=False):
 
-            # starting the fallback/debug ssh daemon for safety:
-            # if the node install somehow hangs, or if it simply takes ages,
-            # we can still enter and investigate
-            try:
-                StartDebug.Run(self.VARS, self.LOG, last_resort = False)
-            except:
-                pass
-
             # implements the reinstall logic, which will check whether
             # the min. hardware requirements are met, install the
             # software, and upon correct installation will switch too
             # 'boot' state and chainboot into the production system
-            if not CheckHardwareRequirements.Run(self.VARS, self.LOG):
+
+            # starting the fallback/debug ssh daemon for safety:
+            # if the node install somehow hangs, or if it simply takes ages,
+            # we can still enter and investigate
+            ret = scheduler.run([
+                Step(StartDebug, last_resort = False, optional = True),
+                Step(CheckHardwareRequirements)])[-1]
+            if not ret:
                 self.VARS['RUN_LEVEL'] = 'failboot'
                 raise BootManagerException("Hardware requirements not met.")
 
             # runinstaller
-            InstallInit.Run(self.VARS, self.LOG)
+            scheduler.run([Step(InstallInit)])
+
+            # resume where a previous attempt at this reinstall failed;
+            # an upgrade cleans up the disk before extracting again, so
+            # it always starts over
+            checkpoint = InstallCheckpoint(self.VARS, self.LOG)
+            if upgrade:
+                checkpoint.invalidate()
+            else:
+                checkpoint.load()
+
+            install_steps = []
             # do not erase disks in upgrade mode
-            if not upgrade:
-                InstallPartitionDisks.Run(self.VARS, self.LOG)
+            if not upgrade and not checkpoint.completed('InstallPartitionDisks'):
+                checkpoint.invalidate()
+                install_steps.append(Step(InstallPartitionDisks))
             # pass upgrade boolean to this step so we can do extra cleanup
-            InstallBootstrapFS.Run(self.VARS, upgrade, self.LOG)
-            InstallWriteConfig.Run(self.VARS, self.LOG)
-            InstallUninitHardware.Run(self.VARS, self.LOG)
+            install_steps += [Step(InstallBootstrapFS, upgrade,
+                                   extracted = checkpoint.completed('InstallBootstrapFS'),
+                                   resumed = checkpoint.completed('InstallPartitionDisks')),
+                              Step(InstallWriteConfig),
+                              Step(InstallUninitHardware)]
+            for step in install_steps:
+                scheduler.run([step])
+                if not upgrade:
+                    checkpoint.record(step.name)
+            # the install is done, a later reinstall must start afresh
+            checkpoint.invalidate()
             self.VARS['BOOT_STATE'] = 'boot'
             self.VARS['STATE_CHANGE_NOTIFY'] = 1
             self.VARS['STATE_CHANGE_NOTIFY_MESSAGE'] = \
@@ -329,12 +595,12 @@ class BootManager:
 
         success = 0
         try:
-            InitializeBootManager.Run(self.VARS, self.LOG)
-            ReadNodeConfiguration.Run(self.VARS, self.LOG)
-            AuthenticateWithPLC.Run(self.VARS, self.LOG)
-            UpdateLastBootOnce.Run(self.VARS, self.LOG)
-            StartRunlevelAgent.Run(self.VARS, self.LOG)
-            GetAndUpdateNodeDetails.Run(self.VARS, self.LOG)
+            scheduler.run([Step(InitializeBootManager),
+                           Step(ReadNodeConfiguration),
+                           Step(AuthenticateWithPLC),
+                           Step(UpdateLastBootOnce),
+                           Step(StartRunlevelAgent),
+                           Step(GetAndUpdateNodeDetails)])
 
             # override machine's current state from the command line
             if self.forceState is not None:
@@ -346,29 +612,29 @@ class BootManager:
             success = 1
 
         except KeyError as e:
-            self.LOG.write("\n\nKeyError while running: {}\n".format(e))
+            self.LOG.LogError("\n\nKeyError while running: {}\n".format(e))
             self.LOG.print_stack()
         except BootManagerException as e:
-            self.LOG.write("\n\nException while running: {}\n".format(e))
+            self.LOG.LogError("\n\nException while running: {}\n".format(e))
             self.LOG.print_stack()
         except BootManagerAuthenticationException as e:
-            self.LOG.write("\n\nFailed to Authenticate Node: {}\n".format(e))
+            self.LOG.LogError("\n\nFailed to Authenticate Node: {}\n".format(e))
             self.LOG.print_stack()
             # sets /tmp/CANCEL_BOOT flag
             StartDebug.Run(self.VARS, self.LOG)
             # Return immediately b/c any other calls to API will fail
             return success
         except:
-            self.LOG.write("\n\nImplementation Error\n")
+            self.LOG.LogError("\n\nImplementation Error\n")
             self.LOG.print_stack()
 
         if not success:
             try:
                 _debugRun()
             except BootManagerException, e:
-                self.LOG.write("\n\nException while running: {}\n".format(e))
+                self.LOG.LogError("\n\nException while running: {}\n".format(e))
             except:
-                self.LOG.write("\n\nImplementation Error\n")
+                self.LOG.LogError("\n\nImplementation Error\n")
                 traceback.print_exc(file=self.LOG.OutputFile)
                 traceback.print_exc()
 
@@ -384,6 +650,8 @@ def main(argv):
     # set to 1 if error occurred
     error = 0
 
+    argv = [ arg for arg in argv if arg != "--import-profile" ]
+
     # all output goes through this class so we can save it and post
     # the data back to PlanetLab central
     LOG = log(BM_NODE_LOG)
@@ -432,6 +700,8 @@ def main(argv):
     LOG.LogEntry("BootManager finished at: {}"\
                  .format(time.strftime("%a, %d %b %Y %H:%M:%S +0000", time.gmtime())))
     LOG.Upload()
+    # do not leave it to atexit only
+    LOG.flush()
 
     return error
 
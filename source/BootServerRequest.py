@@ -13,6 +13,8 @@ import re
 import string
 import urllib
 import tempfile
+import time
+import threading
 
 import pycurl
 
@@ -24,6 +26,73 @@ except:
 
 
 
+class LazyFile:
+    """
+    file-like object that opens (and possibly truncates) its file
+    only when it gets written to
+    """
+    def __init__(self, path, mode):
+        self.path = path
+        self.mode = mode
+        self.file = None
+
+    def write(self, data):
+        if self.file is None:
+            self.file = open(self.path, self.mode)
+        self.file.write(data)
+
+    def create(self):
+        """
+        make sure the file exists, even if nothing was written to it
+        """
+        if self.file is None:
+            self.file = open(self.path, self.mode)
+            self.file.close()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+class SpillBuffer:
+    """
+    file-like object that keeps what gets written to it in memory,
+    and moves it to an anonymous temporary file once it grows past
+    max_size bytes
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.buffer = StringIO()
+        self.spilled = False
+
+    def write(self, data):
+        self.size += len(data)
+        if not self.spilled and self.size > self.max_size:
+            spill = tempfile.TemporaryFile(prefix="MakeRequest-")
+            spill.write(self.buffer.getvalue())
+            self.buffer.close()
+            self.buffer = spill
+            self.spilled = True
+        self.buffer.write(data)
+
+    def reset(self):
+        """
+        drop everything written so far
+        """
+        self.close()
+        self.__init__(self.max_size)
+
+    def getvalue(self):
+        if not self.spilled:
+            return self.buffer.getvalue()
+        self.buffer.seek(0)
+        return self.buffer.read()
+
+    def close(self):
+        self.buffer.close()
+
+
 class BootServerRequest:
 
     # all possible places to check the cdrom mount point.
@@ -34,14 +103,53 @@ class BootServerRequest:
     MONITORSERVER_CERTS = {}
     BOOTCD_VERSION = ""
     HTTP_SUCCESS = 200
+    HTTP_PARTIAL_CONTENT = 206
+    HTTP_NOT_MODIFIED = 304
     HAS_BOOTCD = 0
     USE_PROXY = 0
     PROXY = 0
+    PROXY_CHECKED = 0
+
+    # per-thread pools of curl handles, keyed on the server and the
+    # ssl/cert settings, as a handle must not be used by two threads at
+    # once; all handles are attached to one CurlShare so that DNS
+    # lookups and TLS sessions are reused across requests and threads,
+    # and the handles are kept open so that connections stay alive
+    # between calls
+    CURL_POOL = threading.local()
+    CURL_SHARE = None
+
+    # the server that answered last (or won the last race), per kind
+    # of server ('boot' or 'monitor'), so that later requests go
+    # straight to it
+    PREFERRED_SERVERS = {}
+
+    # boot servers ranked on their latency and success rate, as
+    # {server: {'rtt': seconds or None, 'success': rate, 'time': probed}};
+    # loaded from, and saved to, BOOT_SERVER_RANKING_FILE so that the
+    # next boot starts with the best mirror, see LoadRanking
+    RANKING = None
+    RANKING_FRESH = False
+    RANKING_LOCK = threading.Lock()
+    # weight of the last probe in the success rate of a server
+    RANKING_DECAY = 0.3
+
+    # timings and sizes of all the transfers made by this process,
+    # as measured by curl, see RecordTransfer
+    TRANSFERS = []
+
+    # in bytes, size above which MakeRequest spills the response
+    # to a temporary file, unless MAKEREQUEST_MAX_MEMORY is set
+    DEFAULT_MAKEREQUEST_MAX_MEMORY = 1048576
 
     # in seconds, how maximum time allowed for connect
     DEFAULT_CURL_CONNECT_TIMEOUT = 30
     # in seconds, maximum time allowed for any transfer
     DEFAULT_CURL_MAX_TRANSFER_TIME = 3600
+    # in seconds, delay before resuming a broken transfer; doubled
+    # after each attempt up to the max
+    RESUME_INITIAL_DELAY = 5
+    RESUME_MAX_DELAY = 300
     # location of curl executable, if pycurl isn't available
     # and the DownloadFile method is called (backup, only
     # really need for the boot cd environment where pycurl
@@ -55,6 +163,14 @@ class BootServerRequest:
 
         self.VERBOSE = verbose
         self.VARS = vars
+
+        # a threading.Event that, once set, aborts the transfers of
+        # this instance, including the one in progress
+        self.Abort = None
+
+        # whether to probe all the servers concurrently rather than
+        # trying them one after the other
+        self.RACE_SERVERS = self.VARS.get('RACE_BOOT_SERVERS', '0') == '1'
             
         # see if we have a boot cd mounted by checking for the version file
         # if HAS_BOOTCD == 0 then either the machine doesn't have
@@ -97,6 +213,10 @@ class BootServerRequest:
             self.Message("Getting server from configuration")
             
             bootservers = [ self.VARS['BOOT_SERVER'] ]
+            # additional mirrors, ordered by LoadRanking
+            mirrors = self.VARS.get('BOOT_SERVER_MIRRORS', '')
+            bootservers += [ mirror for mirror in mirrors.split(",")
+                             if mirror.strip() ]
             for bootserver in bootservers:
                 bootserver = string.strip(bootserver)
                 cacert_path = "{}/{}/{}".format(
@@ -126,18 +246,427 @@ class BootServerRequest:
 
     def CheckProxy(self):
         # see if we have any proxy info from the machine
-        self.USE_PROXY = 0
+        # this is done only once per process
+        if BootServerRequest.PROXY_CHECKED:
+            return
+
+        BootServerRequest.USE_PROXY = 0
         self.Message("Checking existance of proxy config file...")
         
         if os.access(self.VARS['PROXY_FILE'], os.R_OK) and \
                os.path.isfile(self.VARS['PROXY_FILE']):
-            self.PROXY = string.strip(file(self.VARS['PROXY_FILE'], 'r').readline())
-            self.USE_PROXY = 1
+            BootServerRequest.PROXY = \
+                string.strip(file(self.VARS['PROXY_FILE'], 'r').readline())
+            BootServerRequest.USE_PROXY = 1
             self.Message("Using proxy {}.".format(self.PROXY))
         else:
             self.Message("Not using any proxy.")
 
+        BootServerRequest.PROXY_CHECKED = 1
+
+
+    def GetCurlShare(self):
+        """
+        return the CurlShare object common to all pooled handles,
+        creating it on first use
+        """
+        if BootServerRequest.CURL_SHARE is None:
+            share = pycurl.CurlShare()
+            share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+            # not available with older pycurl/libcurl
+            if hasattr(pycurl, 'LOCK_DATA_SSL_SESSION'):
+                share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+            BootServerRequest.CURL_SHARE = share
+        return BootServerRequest.CURL_SHARE
+
+    def CurlPool(self):
+        """
+        return the pool of curl handles of the current thread
+        """
+        return BootServerRequest.CURL_POOL.__dict__.setdefault('handles', {})
+
+    def GetCurl(self, server, DoSSL, DoCertCheck, certpath):
+        """
+        return a curl handle from the pool for this server and ssl
+        settings; a reused handle gets its options reset, but keeps
+        its live connections and its ssl session cache
+        """
+        key = (server, DoSSL, DoCertCheck, certpath)
+        pool = self.CurlPool()
+        curl = pool.get(key)
+        if curl is None:
+            self.Message("Creating new curl handle for {}".format(server))
+            curl = pycurl.Curl()
+            curl.setopt(pycurl.SHARE, self.GetCurlShare())
+            pool[key] = curl
+        else:
+            # reset() keeps the handle attached to the share, which
+            # cannot be attached twice
+            self.Message("Reusing curl handle for {}".format(server))
+            curl.reset()
+
+        if hasattr(pycurl, 'TCP_KEEPALIVE'):
+            curl.setopt(pycurl.TCP_KEEPALIVE, 1)
+        return curl
+
+    def DropCurl(self, server, DoSSL, DoCertCheck, certpath):
+        """
+        remove a handle from the pool, typically after a curl error
+        left it in an unknown state
+        """
+        key = (server, DoSSL, DoCertCheck, certpath)
+        curl = self.CurlPool().pop(key, None)
+        if curl is not None:
+            curl.close()
+
+    def BuildURL(self, server, PartialPath, getstr, DoSSL):
+        if DoSSL:
+            return "https://{}/{}{}".format(server, PartialPath, getstr)
+        else:
+            return "http://{}/{}{}".format(server, PartialPath, getstr)
+
+    def SetupCurl(self, curl, url, certpath, DoSSL, DoCertCheck,
+                  ConnectTimeout, MaxTransferTime):
+        """
+        set the options common to all requests on a curl handle
+        """
+        # don't want curl sending any signals
+        curl.setopt(pycurl.NOSIGNAL, 1)
+
+        curl.setopt(pycurl.CONNECTTIMEOUT, ConnectTimeout)
+        curl.setopt(pycurl.TIMEOUT, MaxTransferTime)
+
+        # do not follow location when attempting to download a file
+        curl.setopt(pycurl.FOLLOWLOCATION, 0)
+
+        if self.USE_PROXY:
+            curl.setopt(pycurl.PROXY, self.PROXY)
+
+        if DoSSL:
+            curl.setopt(pycurl.SSLVERSION, self.CURL_SSL_VERSION)
 
+            if DoCertCheck:
+                curl.setopt(pycurl.CAINFO, certpath)
+                curl.setopt(pycurl.SSL_VERIFYPEER, 2)
+            else:
+                curl.setopt(pycurl.SSL_VERIFYPEER, 0)
+
+        curl.setopt(pycurl.URL, url)
+
+        if self.Abort is not None:
+            # called about once a second, a non-zero return aborts
+            curl.setopt(pycurl.NOPROGRESS, 0)
+            curl.setopt(pycurl.PROGRESSFUNCTION,
+                        lambda *progress: int(self.Abort.is_set()))
+
+    def Aborted(self):
+        """
+        whether the transfers of this instance were aborted
+        """
+        return self.Abort is not None and self.Abort.is_set()
+
+    def SetupValidators(self, curl, Validators):
+        """
+        make the request on curl conditional on the etag and/or mtime
+        found in Validators
+        """
+        if Validators.get('etag'):
+            curl.setopt(pycurl.HTTPHEADER,
+                        ["If-None-Match: {}".format(Validators['etag'])])
+        if Validators.get('mtime'):
+            curl.setopt(pycurl.TIMECONDITION, pycurl.TIMECONDITION_IFMODSINCE)
+            curl.setopt(pycurl.TIMEVALUE, int(Validators['mtime']))
+
+    def UpdateValidators(self, curl, response_headers, Validators, DestFilePath):
+        """
+        record the validators of a modified resource in Validators, and
+        set the mtime of DestFilePath (if any) accordingly
+        """
+        Validators['modified'] = True
+        Validators['etag'] = None
+        Validators['mtime'] = None
+        for header in response_headers:
+            parts = header.split(":", 1)
+            if len(parts) == 2 and parts[0].strip().lower() == "etag":
+                Validators['etag'] = parts[1].strip()
+        filetime = curl.getinfo(pycurl.INFO_FILETIME)
+        if filetime > 0:
+            Validators['mtime'] = filetime
+            if DestFilePath:
+                try:
+                    os.utime(DestFilePath, (filetime, filetime))
+                except OSError:
+                    pass
+
+    def ConditionUnmet(self, curl):
+        """
+        whether curl dropped the answer to a conditional request, as it
+        does with a 200 that is not newer than the mtime asked for, from
+        a server that ignores If-Modified-Since
+        """
+        try:
+            return bool(curl.getinfo(pycurl.CONDITION_UNMET))
+        except (AttributeError, ValueError):
+            # not known to older pycurl; then the body is missing
+            return curl.getinfo(pycurl.SIZE_DOWNLOAD) == 0 \
+                   and curl.getinfo(pycurl.CONTENT_LENGTH_DOWNLOAD) > 0
+
+    def OrderServers(self, kind, cert_list):
+        """
+        return the servers in cert_list, the one that last answered
+        successfully (or won the last race) first
+        """
+        servers = list(cert_list)
+        if kind == 'boot' and BootServerRequest.RANKING:
+            servers.sort(key=self.RankingScore)
+        preferred = BootServerRequest.PREFERRED_SERVERS.get(kind)
+        if preferred in servers:
+            servers.remove(preferred)
+            servers.insert(0, preferred)
+        return servers
+
+    def RankingScore(self, server):
+        """
+        sort key of server in the ranking: its latency, penalized by its
+        failures; unknown or unreachable servers come last
+        """
+        entry = BootServerRequest.RANKING.get(server)
+        if entry is None or entry['rtt'] is None:
+            return float('inf')
+        return entry['rtt'] / max(entry['success'], 0.05)
+
+    def LoadRanking(self, cert_list, DoSSL, DoCertCheck, ConnectTimeout):
+        """
+        read the boot server ranking saved by a previous boot; this is
+        done only once per process. If some server in cert_list is missing
+        from it, or was probed more than BOOT_SERVER_RANKING_TTL seconds
+        ago, the servers are probed again in the background, and until
+        then the ranking is only used to order them.
+        """
+        if BootServerRequest.RANKING is not None:
+            return
+        BootServerRequest.RANKING = {}
+
+        path = self.VARS.get('BOOT_SERVER_RANKING_FILE')
+        if not path or len(cert_list) < 2:
+            return
+
+        try:
+            with open(path) as ranking_file:
+                for line in ranking_file:
+                    parts = line.split()
+                    if len(parts) != 4 or line.startswith("#"):
+                        continue
+                    (server, rtt, success, probed) = parts
+                    BootServerRequest.RANKING[server] = {
+                        'rtt': None if rtt == "-" else float(rtt),
+                        'success': float(success),
+                        'time': float(probed),
+                        }
+        except (IOError, ValueError) as err:
+            self.Message("Ignoring boot server ranking {}: {}".format(path, err))
+            BootServerRequest.RANKING = {}
+
+        ttl = int(self.VARS.get('BOOT_SERVER_RANKING_TTL', 86400))
+        now = time.time()
+        stale = [ server for server in cert_list
+                  if server not in BootServerRequest.RANKING
+                  or now - BootServerRequest.RANKING[server]['time'] > ttl ]
+        if not stale:
+            self.Message("Using boot server ranking from {}".format(path))
+            BootServerRequest.RANKING_FRESH = True
+            return
+
+        self.Message("Boot server ranking is stale, probing {} in the background"
+                     .format(list(cert_list)))
+        probe = threading.Thread(target=self.ProbeRanking,
+                                 args=(dict(cert_list), DoSSL, DoCertCheck,
+                                       ConnectTimeout))
+        probe.daemon = True
+        probe.start()
+
+    def ProbeRanking(self, cert_list, DoSSL, DoCertCheck, ConnectTimeout):
+        """
+        measure the tcp connect time of all servers in cert_list at once,
+        with HEAD requests on handles of their own, and save the updated
+        ranking. Meant to run in its own thread, so never raises.
+        """
+        try:
+            multi = pycurl.CurlMulti()
+            probes = {}
+            for server in cert_list:
+                curl = pycurl.Curl()
+                self.SetupCurl(curl, self.BuildURL(server, "", "", DoSSL),
+                               cert_list[server], DoSSL, DoCertCheck,
+                               ConnectTimeout, ConnectTimeout)
+                curl.setopt(pycurl.NOBODY, 1)
+                multi.add_handle(curl)
+                probes[curl] = server
+
+            results = {}
+            pending = len(probes)
+            while pending:
+                while True:
+                    ret, num_handles = multi.perform()
+                    if ret != pycurl.E_CALL_MULTI_PERFORM:
+                        break
+                while True:
+                    num_q, ok_list, err_list = multi.info_read()
+                    for curl in ok_list:
+                        pending -= 1
+                        self.RecordTransfer(curl, probes[curl], 'HEAD')
+                        results[probes[curl]] = curl.getinfo(pycurl.CONNECT_TIME) \
+                                                - curl.getinfo(pycurl.NAMELOOKUP_TIME)
+                    for curl, errno, errstr in err_list:
+                        pending -= 1
+                        self.RecordTransfer(curl, probes[curl], 'HEAD', errstr)
+                        results[probes[curl]] = None
+                    if num_q == 0:
+                        break
+                if pending:
+                    multi.select(1.0)
+
+            for curl in probes:
+                multi.remove_handle(curl)
+                curl.close()
+            multi.close()
+
+            self.UpdateRanking(results)
+        except Exception as err:
+            self.Error("Probing boot servers failed: {}".format(err))
+
+    def UpdateRanking(self, results):
+        """
+        fold the probe results, {server: rtt or None}, into the ranking
+        and save it
+        """
+        now = time.time()
+        decay = self.RANKING_DECAY
+        with BootServerRequest.RANKING_LOCK:
+            ranking = dict(BootServerRequest.RANKING)
+            for server, rtt in results.items():
+                success = 1.0 if rtt is not None else 0.0
+                if server in ranking:
+                    success = (1 - decay) * ranking[server]['success'] + decay * success
+                ranking[server] = { 'rtt': rtt, 'success': success, 'time': now }
+            BootServerRequest.RANKING = ranking
+
+            path = self.VARS.get('BOOT_SERVER_RANKING_FILE')
+            try:
+                with open(path + ".new", "w") as ranking_file:
+                    ranking_file.write("# server rtt success-rate probe-time\n")
+                    for server in sorted(ranking, key=self.RankingScore):
+                        entry = ranking[server]
+                        rtt = "-" if entry['rtt'] is None else "{:.6f}".format(entry['rtt'])
+                        ranking_file.write("{} {} {:.3f} {}\n"
+                                           .format(server, rtt, entry['success'],
+                                                   int(entry['time'])))
+                os.rename(path + ".new", path)
+            except (IOError, OSError) as err:
+                self.Error("Unable to save boot server ranking to {}: {}"
+                           .format(path, err))
+                return
+        self.Message("Saved boot server ranking to {}".format(path))
+
+    def RaceServers(self, kind, cert_list, PartialPath, getstr,
+                    DoSSL, DoCertCheck, ConnectTimeout):
+        """
+        probe all servers in cert_list concurrently with a HEAD request
+        for PartialPath, and remember the first one that answers with
+        a 200 as the preferred server; the other probes are cancelled.
+
+        Return the winning server, or None if no server answered.
+        """
+        self.Message("Racing servers {}".format(list(cert_list)))
+
+        multi = pycurl.CurlMulti()
+        probes = {}
+        for server in cert_list:
+            certpath = cert_list[server]
+            curl = self.GetCurl(server, DoSSL, DoCertCheck, certpath)
+            self.SetupCurl(curl, self.BuildURL(server, PartialPath, getstr, DoSSL),
+                           certpath, DoSSL, DoCertCheck,
+                           ConnectTimeout, ConnectTimeout)
+            curl.setopt(pycurl.NOBODY, 1)
+            multi.add_handle(curl)
+            probes[curl] = (server, certpath)
+
+        winner = None
+        pending = dict(probes)
+        while winner is None and pending:
+            while True:
+                ret, num_handles = multi.perform()
+                if ret != pycurl.E_CALL_MULTI_PERFORM:
+                    break
+            while True:
+                num_q, ok_list, err_list = multi.info_read()
+                for curl in ok_list:
+                    server, certpath = pending.pop(curl)
+                    self.RecordTransfer(curl, server, 'HEAD')
+                    http_result = curl.getinfo(pycurl.HTTP_CODE)
+                    self.Message("Server {} answered with http code {}"
+                                 .format(server, http_result))
+                    if winner is None and http_result == self.HTTP_SUCCESS:
+                        winner = server
+                for curl, errno, errstr in err_list:
+                    server, certpath = pending.pop(curl)
+                    self.RecordTransfer(curl, server, 'HEAD', errstr)
+                    self.Message("Server {} failed; curl error {}: '{}'"
+                                 .format(server, errno, errstr))
+                if num_q == 0:
+                    break
+            if winner is None and pending:
+                multi.select(1.0)
+
+        for curl in probes:
+            multi.remove_handle(curl)
+        multi.close()
+
+        # probes that were cancelled half-way are not reusable
+        for curl in pending:
+            server, certpath = pending[curl]
+            self.DropCurl(server, DoSSL, DoCertCheck, certpath)
+
+        if winner is not None:
+            self.Message("Server {} won the race".format(winner))
+            BootServerRequest.PREFERRED_SERVERS[kind] = winner
+        else:
+            self.Message("No server answered the race")
+        return winner
+
+
+    def RecordTransfer(self, curl, server, method, error=None):
+        """
+        append to TRANSFERS what curl measured for the transfer it just
+        completed, or failed, so that it can be told whether the time
+        goes into name resolution, connection setup, the server or the
+        transfer itself. Times are in seconds since the start of the
+        transfer, as reported by curl.
+        """
+        try:
+            record = {
+                'time': int(time.time()),
+                'server': server,
+                'method': method,
+                'url': curl.getinfo(pycurl.EFFECTIVE_URL),
+                'http_code': curl.getinfo(pycurl.HTTP_CODE),
+                'dns': curl.getinfo(pycurl.NAMELOOKUP_TIME),
+                'connect': curl.getinfo(pycurl.CONNECT_TIME),
+                'tls': curl.getinfo(pycurl.APPCONNECT_TIME),
+                'ttfb': curl.getinfo(pycurl.STARTTRANSFER_TIME),
+                'total': curl.getinfo(pycurl.TOTAL_TIME),
+                'bytes_down': int(curl.getinfo(pycurl.SIZE_DOWNLOAD)),
+                'bytes_up': int(curl.getinfo(pycurl.SIZE_UPLOAD)),
+                'speed_down': int(curl.getinfo(pycurl.SPEED_DOWNLOAD)),
+                'speed_up': int(curl.getinfo(pycurl.SPEED_UPLOAD)),
+                }
+        except (pycurl.error, AttributeError) as err:
+            # telemetry must never break a transfer
+            self.Message("Unable to get transfer info: {}".format(err))
+            return
+        if error is not None:
+            record['error'] = error
+        BootServerRequest.TRANSFERS.append(record)
 
     def Message(self, Msg):
         if(self.VERBOSE):
@@ -153,41 +682,80 @@ class BootServerRequest:
                     PostVars, DoSSL, DoCertCheck,
                     ConnectTimeout = DEFAULT_CURL_CONNECT_TIMEOUT,
                     MaxTransferTime = DEFAULT_CURL_MAX_TRANSFER_TIME,
-                    FormData = None):
+                    FormData = None,
+                    Validators = None):
+        """
+        same as DownloadFile, but return the result as a string, or None
+        on failure. With Validators (see DownloadFile), an empty string is
+        returned when the resource was not modified.
 
-        fd, buffer_name = tempfile.mkstemp("MakeRequest-XXXXXX")
-        os.close(fd)
-        buffer = open(buffer_name, "w+b")
+        The result is collected in memory, and only goes through a
+        temporary file when larger than MAKEREQUEST_MAX_MEMORY bytes.
+        """
 
-        # the file "buffer_name" will be deleted by DownloadFile()
+        max_memory = int(self.VARS.get('MAKEREQUEST_MAX_MEMORY',
+                                       self.DEFAULT_MAKEREQUEST_MAX_MEMORY))
+        buffer = SpillBuffer(max_memory)
 
         ok = self.DownloadFile(PartialPath, GetVars, PostVars,
-                               DoSSL, DoCertCheck, buffer_name,
+                               DoSSL, DoCertCheck, None,
                                ConnectTimeout,
                                MaxTransferTime,
-                               FormData)
+                               FormData,
+                               DestStream = buffer,
+                               Validators = Validators)
 
         # check the ok code, return the string only if it was successfull
         if ok:
-            buffer.seek(0)
-            ret = buffer.read()
+            ret = buffer.getvalue()
         else:
             ret = None
 
         buffer.close()
-        try:
-            # just in case it is not deleted by DownloadFile()
-            os.unlink(buffer_name)
-        except OSError:
-            pass
-            
         return ret
 
     def DownloadFile(self, PartialPath, GetVars, PostVars,
                      DoSSL, DoCertCheck, DestFilePath,
                      ConnectTimeout = DEFAULT_CURL_CONNECT_TIMEOUT,
                      MaxTransferTime = DEFAULT_CURL_MAX_TRANSFER_TIME,
-                     FormData = None):
+                     FormData = None,
+                     MaxResumes = 0,
+                     ResumeTimeBudget = None,
+                     DigestSink = None,
+                     DestStream = None,
+                     Validators = None):
+        """
+        fetch PartialPath from the first server that answers, and store
+        the result in DestFilePath.
+
+        If Validators is set, it is a dict that may hold the 'etag' and/or
+        the 'mtime' (in seconds since the epoch) of the copy the caller
+        already has, and the request is made conditional on them. If the
+        server answers 304, the call succeeds without touching DestFilePath
+        and Validators['modified'] is set to False. Otherwise the data goes
+        to a temporary file next to DestFilePath, that replaces it only once
+        the transfer succeeded; Validators['modified'] is then set to True,
+        'etag' and 'mtime' are updated from the response, and the mtime of
+        DestFilePath is set to the one reported by the server. On failure,
+        DestFilePath and Validators are left alone.
+
+        If DestStream is set, the data is written to that file-like object
+        instead (DestFilePath is then ignored), e.g. the stdin of a process
+        that consumes it on the fly. If DestStream has a reset() method,
+        a transfer that broke half-way can still be made again from
+        another server, after reset() is called.
+
+        If DigestSink is set (see utils.DigestSink), the data is fed into
+        it as it is received, so that its digest is available as soon as
+        the transfer completes.
+
+        If MaxResumes is set, a transfer that breaks half-way is resumed
+        up to that many times with a Range request for the missing bytes,
+        keeping the partial file, as long as ResumeTimeBudget (in seconds,
+        None for no limit) is not exhausted.
+
+        Return 1 if successful, 0 otherwise.
+        """
 
         self.Message("Attempting to retrieve {}".format(PartialPath))
 
@@ -217,14 +785,37 @@ class BootServerRequest:
             getstr = "?" + urllib.urlencode(GetVars)
             self.Message("Get data:\n{}\n".format(getstr))
 
+        if dopostdata or FormData:
+            method = 'POST'
+        else:
+            method = 'GET'
+
         # now, attempt to make the request, starting at the first
         # server in the list
         if FormData:
+            kind = 'monitor'
             cert_list = self.MONITORSERVER_CERTS
         else:
+            kind = 'boot'
             cert_list = self.BOOTSERVER_CERTS
-        
-        for server in cert_list:
+
+        if kind == 'boot':
+            self.LoadRanking(cert_list, DoSSL, DoCertCheck, ConnectTimeout)
+
+        # for plain GET requests, and unless a server already won a
+        # previous race or a fresh ranking tells which one to use,
+        # probe all candidates at once and start with the fastest one
+        if self.RACE_SERVERS and not dopostdata and not FormData \
+               and len(cert_list) > 1 \
+               and kind not in BootServerRequest.PREFERRED_SERVERS \
+               and not (kind == 'boot' and BootServerRequest.RANKING_FRESH):
+            self.RaceServers(kind, cert_list, PartialPath, getstr,
+                             DoSSL, DoCertCheck, ConnectTimeout)
+
+        for server in self.OrderServers(kind, cert_list):
+            if self.Aborted():
+                self.Error("Transfer of {} aborted\n".format(PartialPath))
+                return 0
             self.Message("Contacting server {}.".format(server))
                         
             certpath = cert_list[server]
@@ -234,86 +825,462 @@ class BootServerRequest:
             self.Message("Connect timeout is {} seconds".format(ConnectTimeout))
             self.Message("Max transfer time is {} seconds".format(MaxTransferTime))
 
+            url = self.BuildURL(server, PartialPath, getstr, DoSSL)
             if DoSSL:
-                url = "https://{}/{}{}".format(server, PartialPath, getstr)
-                
                 if DoCertCheck:
                     self.Message("Using SSL version {} and verifying peer."
                                  .format(self.CURL_SSL_VERSION))
                 else:
                     self.Message("Using SSL version {}."
                                  .format(self.CURL_SSL_VERSION))
-            else:
-                url = "http://{}/{}{}".format(server, PartialPath, getstr)
                 
             self.Message("URL: {}".format(url))
             
-            # setup a new pycurl instance
-            curl = pycurl.Curl()
-
-            # don't want curl sending any signals
-            curl.setopt(pycurl.NOSIGNAL, 1)
-
-            curl.setopt(pycurl.CONNECTTIMEOUT, ConnectTimeout)
-            curl.setopt(pycurl.TIMEOUT, MaxTransferTime)
-
-            # do not follow location when attempting to download a file
-            curl.setopt(pycurl.FOLLOWLOCATION, 0)
-
-            if self.USE_PROXY:
-                curl.setopt(pycurl.PROXY, self.PROXY)
-
-            if DoSSL:
-                curl.setopt(pycurl.SSLVERSION, self.CURL_SSL_VERSION)
-                
-                if DoCertCheck:
-                    curl.setopt(pycurl.CAINFO, certpath)
-                    curl.setopt(pycurl.SSL_VERIFYPEER, 2)
-                else:
-                    curl.setopt(pycurl.SSL_VERIFYPEER, 0)
+            # when resuming, the transfer is restarted from the current
+            # size of the partial file, with a growing delay in between
+            offset = 0
+            resumes = 0
+            delay = self.RESUME_INITIAL_DELAY
+            time_beg = time.time()
+
+            # bytes written to DestStream, that cannot be taken back
+            streamed = [0]
+
+            # where the data goes; the caller's copy is kept as it is
+            # until a conditional request brings a complete new one
+            target = DestFilePath
+            if DestStream is None and Validators is not None:
+                target = DestFilePath + ".new"
+
+            while True:
+                # get a (possibly already connected) pycurl instance
+                curl = self.GetCurl(server, DoSSL, DoCertCheck, certpath)
+                self.SetupCurl(curl, url, certpath, DoSSL, DoCertCheck,
+                               ConnectTimeout, MaxTransferTime)
                 
-            if dopostdata:
-                curl.setopt(pycurl.POSTFIELDS, postdata)
+                if dopostdata:
+                    curl.setopt(pycurl.POSTFIELDS, postdata)
 
-            # setup multipart/form-data upload
-            if FormData:
-                curl.setopt(pycurl.HTTPPOST, FormData)
+                # setup multipart/form-data upload
+                if FormData:
+                    curl.setopt(pycurl.HTTPPOST, FormData)
 
-            curl.setopt(pycurl.URL, url)
-
-            try:
-                # setup the output file
-                with open(DestFilePath,"wb") as outfile:
-                
-                    self.Message("Opened output file {}".format(DestFilePath))
-            
-                    curl.setopt(pycurl.WRITEDATA, outfile)
-            
-                    self.Message("Fetching...")
-                    curl.perform()
-                    self.Message("Done.")
+                if offset:
+                    self.Message("Resuming at byte {}".format(offset))
+                    curl.setopt(pycurl.RESUME_FROM_LARGE, offset)
+                    mode = "ab"
+                else:
+                    mode = "wb"
+                    if DigestSink is not None:
+                        DigestSink.reset()
+
+                # conditional request, only on the first attempt; the
+                # validators of a resumed transfer come from its last part
+                conditional = Validators is not None and not offset
+                response_headers = []
+                if conditional:
+                    self.SetupValidators(curl, Validators)
+                if Validators is not None:
+                    # so that we know the mtime of the new copy
+                    curl.setopt(pycurl.OPT_FILETIME, 1)
+                    curl.setopt(pycurl.HEADERFUNCTION, response_headers.append)
+
+                try:
+                    # setup the output, either the caller's stream or a file
+                    if DestStream is not None:
+                        outfile = DestStream
+                        # never send an error page down the stream
+                        curl.setopt(pycurl.FAILONERROR, 1)
+                    elif conditional:
+                        # no file at all if not modified
+                        outfile = LazyFile(target, mode)
+                    else:
+                        outfile = open(target, mode)
+                        self.Message("Opened output file {}".format(target))
+
+                    try:
+                        if DigestSink is not None or DestStream is not None \
+                           or conditional:
+                            # hash/count the data on its way out
+                            def _write(data, outfile=outfile):
+                                outfile.write(data)
+                                streamed[0] += len(data)
+                                if DigestSink is not None:
+                                    DigestSink.update(data)
+                            curl.setopt(pycurl.WRITEFUNCTION, _write)
+                        else:
+                            curl.setopt(pycurl.WRITEDATA, outfile)
             
-                    http_result = curl.getinfo(pycurl.HTTP_CODE)
-                    curl.close()
+                        self.Message("Fetching...")
+                        curl.perform()
+                        self.Message("Done.")
             
-                self.Message("Results saved in {}".format(DestFilePath))
-
-                # check the code, return 1 if successfull
-                if http_result == self.HTTP_SUCCESS:
-                    self.Message("Successfull!")
-                    return 1
-                else:
-                    self.Message("Failure, resultant http code: {}"
-                                 .format(http_result))
-
-            except pycurl.error as err:
-                errno, errstr = err
-                self.Error("connect to {} failed; curl error {}: '{}'\n"
-                           .format(server, errno, errstr))
+                        self.RecordTransfer(curl, server, method)
+                        http_result = curl.getinfo(pycurl.HTTP_CODE)
+                    finally:
+                        if DestStream is None:
+                            outfile.close()
+
+                    if conditional and (http_result == self.HTTP_NOT_MODIFIED
+                                        or self.ConditionUnmet(curl)):
+                        self.Message("Not modified, keeping {}".format(DestFilePath))
+                        if target != DestFilePath and os.path.exists(target):
+                            os.unlink(target)
+                        Validators['modified'] = False
+                        BootServerRequest.PREFERRED_SERVERS[kind] = server
+                        return 1
+
+                    # check the code, return 1 if successfull
+                    if http_result == self.HTTP_SUCCESS or \
+                       (offset and http_result == self.HTTP_PARTIAL_CONTENT):
+                        if DestStream is None:
+                            if conditional:
+                                outfile.create()
+                            if target != DestFilePath:
+                                os.rename(target, DestFilePath)
+                            self.Message("Results saved in {}".format(DestFilePath))
+                        if Validators is not None:
+                            self.UpdateValidators(curl, response_headers, Validators,
+                                                  DestStream is None and DestFilePath)
+                        self.Message("Successfull!")
+                        BootServerRequest.PREFERRED_SERVERS[kind] = server
+                        return 1
+                    else:
+                        self.Message("Failure, resultant http code: {}"
+                                     .format(http_result))
+                    break
+
+                except pycurl.error as err:
+                    errno, errstr = err
+                    self.Error("connect to {} failed; curl error {}: '{}'\n"
+                               .format(server, errno, errstr))
+                    self.RecordTransfer(curl, server, method, errstr)
+                    self.DropCurl(server, DoSSL, DoCertCheck, certpath)
+
+                    if self.Aborted():
+                        self.Error("Transfer of {} aborted\n".format(PartialPath))
+                        return 0
+                    # the consumer of the data gave up, no point in retrying
+                    if resumes >= MaxResumes or errno == pycurl.E_WRITE_ERROR:
+                        break
+                    if ResumeTimeBudget is not None and \
+                       time.time() - time_beg + delay > ResumeTimeBudget:
+                        self.Error("Resume time budget of {} seconds exhausted\n"
+                                   .format(ResumeTimeBudget))
+                        break
+
+                    if DestStream is not None:
+                        offset = streamed[0]
+                        if errno == pycurl.E_RANGE_ERROR:
+                            self.Error("Server ignores Range, cannot resume stream\n")
+                            return 0
+                    elif errno == pycurl.E_RANGE_ERROR:
+                        # server ignores Range, start over
+                        offset = 0
+                    else:
+                        try:
+                            offset = os.path.getsize(target)
+                        except OSError:
+                            offset = 0
+                    # nothing received, try the next server instead
+                    if not offset and errno != pycurl.E_RANGE_ERROR:
+                        break
+
+                    resumes += 1
+                    self.Message("Retrying in {} seconds ({}/{})"
+                                 .format(delay, resumes, MaxResumes))
+                    if self.Abort is not None:
+                        self.Abort.wait(delay)
+                    else:
+                        time.sleep(delay)
+                    delay = min(2 * delay, self.RESUME_MAX_DELAY)
+
+            # what a failed conditional request brought is dropped
+            if target != DestFilePath and os.path.exists(target):
+                os.unlink(target)
+
+            # data already sent down the stream cannot be fetched again
+            # from another server, unless the stream can be taken back
+            if DestStream is not None and streamed[0]:
+                if not hasattr(DestStream, 'reset'):
+                    self.Error("Stream to {} broken half-way\n".format(server))
+                    return 0
+                DestStream.reset()
     
         self.Error("Unable to successfully contact any boot servers.\n")
         return 0
 
+    def ProbeSize(self, server, certpath, url, DoSSL, DoCertCheck,
+                  ConnectTimeout):
+        """
+        issue a HEAD request for url, and return a (size, ranges) tuple,
+        where ranges tells whether the server advertises byte ranges.
+        size is 0 if unknown, and -1 if the request failed.
+        """
+        headers = []
+        curl = self.GetCurl(server, DoSSL, DoCertCheck, certpath)
+        self.SetupCurl(curl, url, certpath, DoSSL, DoCertCheck,
+                       ConnectTimeout, ConnectTimeout)
+        curl.setopt(pycurl.NOBODY, 1)
+        curl.setopt(pycurl.HEADERFUNCTION, headers.append)
+        try:
+            curl.perform()
+        except pycurl.error as err:
+            errno, errstr = err
+            self.Error("HEAD on {} failed; curl error {}: '{}'\n"
+                       .format(server, errno, errstr))
+            self.RecordTransfer(curl, server, 'HEAD', errstr)
+            self.DropCurl(server, DoSSL, DoCertCheck, certpath)
+            return (-1, False)
+        self.RecordTransfer(curl, server, 'HEAD')
+
+        if curl.getinfo(pycurl.HTTP_CODE) != self.HTTP_SUCCESS:
+            return (-1, False)
+
+        # -1 when the server does not tell
+        size = max(int(curl.getinfo(pycurl.CONTENT_LENGTH_DOWNLOAD)), 0)
+        ranges = False
+        for header in headers:
+            parts = header.split(":", 1)
+            if len(parts) == 2 \
+               and parts[0].strip().lower() == "accept-ranges" \
+               and parts[1].strip().lower() == "bytes":
+                ranges = True
+        return (size, ranges)
+
+    def PreferredServer(self, PartialPath, DoSSL, DoCertCheck, ConnectTimeout):
+        """
+        return the (server, certpath) tuple of the boot server to use
+        first for PartialPath, racing them if needed, or None if no
+        request can be made with these settings
+        """
+        # same preconditions as DownloadFile
+        if (DoSSL and DoCertCheck and not self.HAS_BOOTCD) or ConnectTimeout <= 0:
+            return None
+
+        self.CheckProxy()
+
+        kind = 'boot'
+        cert_list = self.BOOTSERVER_CERTS
+        self.LoadRanking(cert_list, DoSSL, DoCertCheck, ConnectTimeout)
+        if self.RACE_SERVERS and len(cert_list) > 1 \
+               and kind not in BootServerRequest.PREFERRED_SERVERS \
+               and not BootServerRequest.RANKING_FRESH:
+            self.RaceServers(kind, cert_list, PartialPath, "",
+                             DoSSL, DoCertCheck, ConnectTimeout)
+
+        servers = self.OrderServers(kind, cert_list)
+        if not servers:
+            return None
+        return (servers[0], cert_list[servers[0]])
+
+    def ProbeFile(self, PartialPath, DoSSL, DoCertCheck,
+                  ConnectTimeout = DEFAULT_CURL_CONNECT_TIMEOUT):
+        """
+        check with a HEAD request whether the preferred boot server
+        has PartialPath
+
+        Return its size, 0 if unknown, or -1 if it is not available.
+        """
+        preferred = self.PreferredServer(PartialPath, DoSSL, DoCertCheck,
+                                         ConnectTimeout)
+        if preferred is None:
+            return -1
+        (server, certpath) = preferred
+        url = self.BuildURL(server, PartialPath, "", DoSSL)
+        (size, ranges) = self.ProbeSize(server, certpath, url,
+                                        DoSSL, DoCertCheck, ConnectTimeout)
+        return size
+
+    def SegmentHeaderCheck(self, start, end):
+        """
+        return a curl header callback for the segment start-end, that
+        aborts the transfer as soon as the server answers with anything
+        else than 206: a 200 would carry the whole file, and have it
+        written over the other segments
+        """
+        def _check(header):
+            words = header.split()
+            if not header.startswith("HTTP/") or len(words) < 2 \
+               or not words[1].isdigit():
+                return None
+            http_result = int(words[1])
+            # ignore interim answers, e.g. 100 Continue
+            if http_result < 200 or http_result == self.HTTP_PARTIAL_CONTENT:
+                return None
+            self.Error("Segment {}-{} rejected, http code {}\n"
+                       .format(start, end, http_result))
+            # anything else than the length aborts the transfer
+            return 0
+        return _check
+
+    def DownloadFileSegmented(self, PartialPath, DoSSL, DoCertCheck,
+                              DestFilePath, Segments,
+                              MinSize = 0,
+                              ConnectTimeout = DEFAULT_CURL_CONNECT_TIMEOUT,
+                              MaxTransferTime = DEFAULT_CURL_MAX_TRANSFER_TIME,
+                              MaxResumes = 0,
+                              ResumeTimeBudget = None,
+                              DigestSink = None):
+        """
+        same as DownloadFile (without get/post vars), but fetch the file
+        as Segments byte ranges in parallel, each one written at its own
+        offset in a preallocated DestFilePath.
+
+        Files smaller than MinSize, servers that do not support ranges,
+        or any failure of a segment, fall back to a single stream
+        DownloadFile, which is passed MaxResumes, ResumeTimeBudget and
+        DigestSink. A DigestSink is fed in file order: the data of the
+        segment that starts where the digest stops goes straight into
+        it, and whatever a later segment got ahead of that is read back
+        from the file as soon as the segments before it are complete.
+
+        Return 1 if successful, 0 otherwise.
+        """
+
+        def _single_stream():
+            return self.DownloadFile(PartialPath, None, None,
+                                     DoSSL, DoCertCheck, DestFilePath,
+                                     ConnectTimeout, MaxTransferTime,
+                                     MaxResumes = MaxResumes,
+                                     ResumeTimeBudget = ResumeTimeBudget,
+                                     DigestSink = DigestSink)
+
+        if Segments <= 1:
+            return _single_stream()
+
+        preferred = self.PreferredServer(PartialPath, DoSSL, DoCertCheck,
+                                         ConnectTimeout)
+        if preferred is None:
+            return _single_stream()
+        (server, certpath) = preferred
+        url = self.BuildURL(server, PartialPath, "", DoSSL)
+
+        (size, ranges) = self.ProbeSize(server, certpath, url,
+                                        DoSSL, DoCertCheck, ConnectTimeout)
+        if size <= 0 or size < MinSize or not ranges:
+            self.Message("Not using segments for {} (size={}, ranges={})"
+                         .format(url, size, ranges))
+            return _single_stream()
+
+        self.Message("Fetching {} ({} bytes) in {} segments from {}"
+                     .format(PartialPath, size, Segments, server))
+
+        # preallocate the file, so that each segment can be written
+        # in place through its own file object
+        with open(DestFilePath, "wb") as outfile:
+            outfile.truncate(size)
+
+        segment_size = (size + Segments - 1) // Segments
+        multi = pycurl.CurlMulti()
+        segments = {}
+        # [start, end, outfile, bytes written so far], in file order
+        order = []
+        # how far into the file the digest goes
+        hashed = [0]
+        if DigestSink is not None:
+            DigestSink.reset()
+
+        def _writer(segment):
+            def _write(data):
+                (start, end, outfile, written) = segment
+                outfile.write(data)
+                segment[3] += len(data)
+                if DigestSink is not None and start + written == hashed[0]:
+                    DigestSink.update(data)
+                    hashed[0] += len(data)
+            return _write
+
+        def _catch_up():
+            # feed the digest with what got written ahead of it, up to
+            # the first segment that is still in progress
+            for (start, end, outfile, written) in order:
+                if hashed[0] > end:
+                    continue
+                if hashed[0] < start + written:
+                    outfile.flush()
+                    with open(DestFilePath, "rb") as infile:
+                        infile.seek(hashed[0])
+                        while hashed[0] < start + written:
+                            block = infile.read(min(256 * 1024,
+                                                    start + written - hashed[0]))
+                            if not block:
+                                break
+                            DigestSink.update(block)
+                            hashed[0] += len(block)
+                if hashed[0] <= end:
+                    break
+
+        try:
+            for start in range(0, size, segment_size):
+                end = min(start + segment_size, size) - 1
+                outfile = open(DestFilePath, "r+b")
+                outfile.seek(start)
+                segment = [start, end, outfile, 0]
+                order.append(segment)
+                # not pooled, but still sharing dns and tls sessions
+                curl = pycurl.Curl()
+                curl.setopt(pycurl.SHARE, self.GetCurlShare())
+                self.SetupCurl(curl, url, certpath, DoSSL, DoCertCheck,
+                               ConnectTimeout, MaxTransferTime)
+                curl.setopt(pycurl.RANGE, "{}-{}".format(start, end))
+                curl.setopt(pycurl.HEADERFUNCTION,
+                            self.SegmentHeaderCheck(start, end))
+                curl.setopt(pycurl.WRITEFUNCTION, _writer(segment))
+                multi.add_handle(curl)
+                segments[curl] = segment
+
+            pending = len(segments)
+            failed = 0
+            while pending and not failed:
+                while True:
+                    ret, num_handles = multi.perform()
+                    if ret != pycurl.E_CALL_MULTI_PERFORM:
+                        break
+                while True:
+                    num_q, ok_list, err_list = multi.info_read()
+                    for curl in ok_list:
+                        pending -= 1
+                        (start, end, outfile, written) = segments[curl]
+                        self.RecordTransfer(curl, server, 'GET')
+                        http_result = curl.getinfo(pycurl.HTTP_CODE)
+                        received = int(curl.getinfo(pycurl.SIZE_DOWNLOAD))
+                        if http_result != self.HTTP_PARTIAL_CONTENT \
+                           or received != end - start + 1:
+                            self.Error("Segment {}-{} failed, http code {}, {} bytes\n"
+                                       .format(start, end, http_result, received))
+                            failed = 1
+                        elif DigestSink is not None:
+                            _catch_up()
+                    for curl, errno, errstr in err_list:
+                        pending -= 1
+                        (start, end, outfile, written) = segments[curl]
+                        self.RecordTransfer(curl, server, 'GET', errstr)
+                        self.Error("Segment {}-{} failed; curl error {}: '{}'\n"
+                                   .format(start, end, errno, errstr))
+                        failed = 1
+                    if num_q == 0:
+                        break
+                if pending and not failed:
+                    multi.select(1.0)
+        finally:
+            for curl in segments:
+                multi.remove_handle(curl)
+                curl.close()
+                segments[curl][2].close()
+            multi.close()
+
+        if self.Aborted():
+            self.Error("Transfer of {} aborted\n".format(PartialPath))
+            return 0
+        if failed:
+            self.Message("Segmented download failed, using a single stream")
+            return _single_stream()
+
+        self.Message("Successfull!")
+        BootServerRequest.PREFERRED_SERVERS['boot'] = server
+        return 1
+
 
 
 def usage():
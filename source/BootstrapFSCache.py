@@ -0,0 +1,118 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2004-2007 The Trustees of Princeton University
+# All rights reserved.
+
+"""
+content-addressed cache of bootstrapfs tarballs
+
+tarballs are stored under their sha1, so that a reinstall or an upgrade
+with the same nodefamily and the same image does not need to fetch it
+again from the boot server. The cache lives on the node's hard drive,
+in a place that upgrade preserves; its size is bounded, and the least
+recently used tarballs are evicted first.
+"""
+
+import os
+
+from Exceptions import *
+import utils
+
+
+class BootstrapFSCache:
+
+    # suffix of the tarballs being downloaded into the cache
+    PARTIAL_SUFFIX = ".part"
+
+    def __init__(self, path, max_size, log):
+        self.path = path
+        self.max_size = max_size
+        self.log = log
+        utils.makedirs(self.path)
+
+        # leftovers from interrupted downloads
+        for name in os.listdir(self.path):
+            if name.endswith(self.PARTIAL_SUFFIX):
+                self.log.write("removing stale bootstrapfs cache file {}\n".format(name))
+                os.unlink(os.path.join(self.path, name))
+
+    def _path(self, sha1):
+        return os.path.join(self.path, sha1)
+
+    def partial_path(self, sha1):
+        """
+        where to download a tarball before it makes it into the cache
+        """
+        return self._path(sha1) + self.PARTIAL_SUFFIX
+
+    def lookup(self, sha1):
+        """
+        return the path of the cached tarball with this sha1, after
+        checking its integrity, or None if it is not in the cache
+        """
+        path = self._path(sha1)
+        if not os.path.isfile(path):
+            self.log.write("bootstrapfs cache miss for {}\n".format(sha1))
+            return None
+
+        if utils.sha1_file(path) != sha1:
+            self.log.write("bootstrapfs cache entry {} is corrupt, discarding\n"
+                           .format(sha1))
+            self.discard(sha1)
+            return None
+
+        # record the access for LRU eviction
+        os.utime(path, None)
+        self.log.write("bootstrapfs cache hit for {}\n".format(sha1))
+        return path
+
+    def commit(self, sha1):
+        """
+        move a tarball fully downloaded in partial_path(sha1) into the cache,
+        and evict other entries if needed
+
+        Return its path in the cache
+        """
+        path = self._path(sha1)
+        try:
+            os.rename(self.partial_path(sha1), path)
+        except OSError as e:
+            raise BootManagerException("Unable to add {} to bootstrapfs cache: {}"
+                                       .format(sha1, e))
+        self.evict(keep=path)
+        return path
+
+    def discard(self, sha1):
+        """
+        remove any trace of sha1 from the cache
+        """
+        for path in (self._path(sha1), self.partial_path(sha1)):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def evict(self, keep=None):
+        """
+        remove the least recently used entries, but keep, until the cache
+        fits in max_size
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            if name.endswith(self.PARTIAL_SUFFIX) or path == keep:
+                continue
+            st = os.stat(path)
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        if keep is not None:
+            total += os.path.getsize(keep)
+
+        entries.sort()
+        while entries and total > self.max_size:
+            (mtime, size, path) = entries.pop(0)
+            self.log.write("evicting {} from bootstrapfs cache\n"
+                           .format(os.path.basename(path)))
+            os.unlink(path)
+            total -= size
@@ -0,0 +1,59 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2004-2007 The Trustees of Princeton University
+# All rights reserved.
+
+"""
+how long each module takes to import, for BootManager --import-profile
+
+install() replaces the import function with one that times the imports
+that load a new module; report() then tells, for each of them, the time
+spent running the module itself and the time including the imports it
+made in turn.
+"""
+
+import sys
+import time
+import threading
+import __builtin__
+
+original_import = None
+# name -> [own seconds, cumulative seconds]
+profile = {}
+# the imports in progress, per thread, with the time spent in theirs
+frames = threading.local()
+
+
+def timed_import(name, *args, **kwargs):
+    stack = frames.__dict__.setdefault('stack', [])
+    loaded = len(sys.modules)
+    children = [0.0]
+    stack.append(children)
+    start = time.time()
+    try:
+        return original_import(name, *args, **kwargs)
+    finally:
+        elapsed = time.time() - start
+        stack.pop()
+        if stack:
+            stack[-1][0] += elapsed
+        if len(sys.modules) > loaded:
+            times = profile.setdefault(name, [0.0, 0.0])
+            times[0] += elapsed - children[0]
+            times[1] += elapsed
+
+
+def install():
+    global original_import
+    if original_import is None:
+        original_import = __builtin__.__import__
+        __builtin__.__import__ = timed_import
+
+
+def report():
+    """
+    return a list of (module, own seconds, cumulative seconds), the
+    most expensive first
+    """
+    return sorted([ (name, own, total) for (name, (own, total)) in profile.items() ],
+                  key=lambda (name, own, total): own, reverse=True)
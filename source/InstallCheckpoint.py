@@ -0,0 +1,246 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2004-2007 The Trustees of Princeton University
+# All rights reserved.
+
+"""
+checkpoint journal of a reinstall, so that an attempt that fails late
+does not start over from partitioning the disks
+
+The journal is kept on the node's root filesystem, next to
+bm-install.txt. Its first line tells which disks and which nodefamily
+it was written for; each of the following lines records a step that
+completed, with a digest of the vars its outcome depends on, and the
+sha1 of the bootstrapfs tarballs found extracted at the time. On the
+next attempt, a step is skipped only if its record is there and all of
+this still matches, the sha1 of the tarballs being checked against the
+ones the boot server publishes now.
+
+The journal is removed once the install is done, and as soon as the
+disks or the nodefamily change.
+"""
+
+import os
+import glob
+import json
+import hashlib
+
+from Exceptions import *
+import utils
+import BootServerRequest
+
+JOURNAL_NAME = "bm-install.checkpoint"
+JOURNAL_MAGIC = "bootmanager-checkpoint"
+JOURNAL_VERSION = 1
+
+# the vars the outcome of each step depends on; the disks and the
+# nodefamily are checked for the journal as a whole
+STEP_VARS = {
+    'InstallPartitionDisks': ('ONE_PARTITION', 'SWAP_SIZE', 'VSERVERS_SIZE',
+                              'NODE_MODEL_OPTIONS', 'virt'),
+    'InstallBootstrapFS': ('extensions', 'plain', 'virt', 'ONE_PARTITION'),
+    'InstallWriteConfig': ('INTERFACE_SETTINGS', 'ONE_PARTITION', 'VERSION', 'virt'),
+    'InstallUninitHardware': (),
+}
+
+
+def digest(values):
+    return hashlib.sha1(json.dumps(values, sort_keys=True)).hexdigest()
+
+
+class InstallCheckpoint:
+
+    def __init__(self, vars, log):
+        self.vars = vars
+        self.log = log
+        # step -> record, for the steps found completed by load()
+        self.completed_steps = {}
+
+    def disks_digest(self):
+        """
+        a digest of the block devices found usable for the install, as
+        set by CheckHardwareRequirements, with their sizes, and of the
+        way they get partitioned
+        """
+        disks = []
+        for device in sorted(self.vars.get('USABLE_BLOCK_DEVICES', [])):
+            try:
+                size = file("/sys/block/{}/size"
+                            .format(os.path.basename(device))).read().strip()
+            except IOError:
+                size = None
+            disks.append((device, size))
+        root_size = self.vars.get("{}_ROOT_SIZE".format(self.vars.get('virt')))
+        return digest([disks, root_size])
+
+    def step_digest(self, step):
+        return digest([self.vars.get(name) for name in STEP_VARS.get(step, ())])
+
+    def tarballs(self, root):
+        """
+        the sha1 of the bootstrapfs tarballs extracted on root, as left
+        there by InstallBootstrapFS
+        """
+        sha1s = {}
+        for path in glob.glob("{}/bootstrapfs-*.sha1sum".format(root)):
+            try:
+                sha1s[os.path.basename(path)] = file(path).read().split()[0]
+            except (IOError, IndexError):
+                pass
+        return sha1s
+
+    def published_tarballs(self, names):
+        """
+        the sha1 of the bootstrapfs tarballs, given the names of their
+        sha1sum files, as published by the boot server now; None for
+        the ones that could not be fetched
+        """
+        bs_request = BootServerRequest.BootServerRequest(self.vars)
+        sha1s = {}
+        for name in names:
+            answer = bs_request.MakeRequest("/boot/{}".format(name), None, None, 1, 1)
+            try:
+                sha1s[name] = answer.split()[0]
+            except (AttributeError, IndexError):
+                sha1s[name] = None
+        return sha1s
+
+    def mount(self):
+        """
+        return the path where the root filesystem is mounted, and
+        whether it was mounted just for us, or None if it can't be found
+        """
+        if self.vars.get('ROOT_MOUNTED'):
+            return (self.vars['SYSIMG_PATH'], False)
+        root = self.vars['PARTITIONS']["root"]
+        if not os.path.exists(root):
+            utils.sysexec_noerr("vgscan --mknodes", self.log)
+            utils.sysexec_noerr("vgchange -ay planetlab", self.log)
+        if not os.path.exists(root):
+            return (None, False)
+        path = "{}/checkpoint".format(self.vars['TEMP_PATH'])
+        utils.makedirs(path)
+        if not utils.sysexec_noerr("mount -t ext3 {} {}".format(root, path), self.log):
+            return (None, False)
+        return (path, True)
+
+    def unmount(self, path, mounted):
+        if mounted:
+            utils.sysexec_noerr("umount {}".format(path), self.log)
+
+    def load(self):
+        """
+        read the journal left by a previous attempt, if any, and keep
+        the steps that are still valid; a journal written for other
+        disks or another nodefamily is removed
+        """
+        self.completed_steps = {}
+        (root, mounted) = self.mount()
+        if root is None:
+            return
+        try:
+            path = os.path.join(root, JOURNAL_NAME)
+            try:
+                lines = file(path).read().splitlines()
+            except IOError:
+                return
+            try:
+                records = [ json.loads(line) for line in lines ]
+                header = records.pop(0)
+                if header.get('magic') != JOURNAL_MAGIC \
+                       or header.get('version') != JOURNAL_VERSION:
+                    raise ValueError("unknown format")
+            except (ValueError, IndexError, AttributeError) as e:
+                self.log.write("Discarding unreadable install checkpoint: {}\n".format(e))
+                utils.removefile(path)
+                return
+
+            if header.get('disks') != self.disks_digest():
+                self.log.write("Disks changed since the last install attempt, "
+                               "discarding its checkpoint\n")
+                utils.removefile(path)
+                return
+            if header.get('nodefamily') != self.vars.get('nodefamily'):
+                self.log.write("Nodefamily changed from {} to {} since the last "
+                               "install attempt, discarding its checkpoint\n"
+                               .format(header.get('nodefamily'), self.vars.get('nodefamily')))
+                utils.removefile(path)
+                return
+
+            tarballs = self.tarballs(root)
+            published = None
+            for record in records:
+                step = record.get('step')
+                current = record.get('digest') == self.step_digest(step)
+                # the tarballs that were there must not have changed
+                # since, on the disk nor on the boot server
+                if current and record.get('tarballs'):
+                    if published is None:
+                        published = self.published_tarballs(tarballs.keys())
+                    current = record['tarballs'] == tarballs == published
+                if not current:
+                    self.log.write("Checkpoint for {} is out of date\n".format(step))
+                    continue
+                self.completed_steps[step] = record
+            if self.completed_steps:
+                self.log.write("Resuming install, already completed: {}\n"
+                               .format(", ".join(sorted(self.completed_steps))))
+        finally:
+            self.unmount(root, mounted)
+
+    def completed(self, step):
+        """
+        whether a previous attempt completed step, as found by load()
+        """
+        return step in self.completed_steps
+
+    def record(self, step):
+        """
+        add to the journal that step just completed
+        """
+        (root, mounted) = self.mount()
+        if root is None:
+            self.log.write("Unable to record install checkpoint for {}\n".format(step))
+            return
+        try:
+            path = os.path.join(root, JOURNAL_NAME)
+            lines = []
+            if not os.path.exists(path):
+                lines.append({ 'magic': JOURNAL_MAGIC,
+                               'version': JOURNAL_VERSION,
+                               'disks': self.disks_digest(),
+                               'nodefamily': self.vars.get('nodefamily') })
+            lines.append({ 'step': step,
+                           'digest': self.step_digest(step),
+                           'tarballs': self.tarballs(root) })
+            journal = file(path, 'a')
+            try:
+                for line in lines:
+                    journal.write(json.dumps(line, sort_keys=True) + "\n")
+                journal.flush()
+                os.fsync(journal.fileno())
+            finally:
+                journal.close()
+            self.completed_steps[step] = lines[-1]
+        except (IOError, OSError) as e:
+            self.log.write("Unable to record install checkpoint for {}: {}\n"
+                           .format(step, e))
+        finally:
+            self.unmount(root, mounted)
+
+    def invalidate(self):
+        """
+        remove the journal, as the disks or what is installed on them
+        are about to change
+        """
+        self.completed_steps = {}
+        (root, mounted) = self.mount()
+        if root is None:
+            return
+        try:
+            path = os.path.join(root, JOURNAL_NAME)
+            if os.path.exists(path):
+                self.log.write("Removing install checkpoint\n")
+                utils.removefile(path)
+        finally:
+            self.unmount(root, mounted)
@@ -0,0 +1,93 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2004-2007 The Trustees of Princeton University
+# All rights reserved.
+
+"""
+xmlrpclib transport that keeps one HTTP/1.1 connection open to the
+API server across calls, so that the tcp and tls handshakes are made
+once rather than for every call.
+
+A connection that was left idle for longer than max_idle seconds is
+not trusted anymore, and is replaced before the next call; one that
+the server closed behind our back is dropped, and the next call opens
+a fresh one. Each call is timed, and the counters are available per
+method through counters().
+"""
+
+import re
+import time
+import socket
+import httplib
+import xmlrpclib
+
+
+class KeepAliveTransport(xmlrpclib.SafeTransport):
+
+    # the name of the method being called, in the xml-rpc request body
+    METHOD_NAME = re.compile(r"<methodName>([^<]*)</methodName>")
+
+    def __init__(self, url, use_datetime=0, context=None, max_idle=60):
+        """
+        url is the one of the API server, and tells whether to use
+        https; context, if set, is the ssl context to use (python >= 2.7.9)
+        """
+        if context is not None:
+            xmlrpclib.SafeTransport.__init__(self, use_datetime, context=context)
+        else:
+            xmlrpclib.SafeTransport.__init__(self, use_datetime)
+        self.secure = url.startswith("https:")
+        self.max_idle = max_idle
+        self.last_used = 0
+        self.connects = 0
+        self.errors = 0
+        # method -> [calls, total seconds, max seconds]
+        self.latencies = {}
+
+    def make_connection(self, host):
+        if self._connection and self._connection[0] == host \
+               and time.time() - self.last_used > self.max_idle:
+            self.close()
+        if not self._connection or self._connection[0] != host:
+            self.connects += 1
+        if self.secure:
+            return xmlrpclib.SafeTransport.make_connection(self, host)
+        else:
+            return xmlrpclib.Transport.make_connection(self, host)
+
+    def request(self, host, handler, request_body, verbose=0):
+        match = self.METHOD_NAME.search(request_body)
+        method = match.group(1) if match else "unknown"
+        start = time.time()
+        try:
+            # retries once on a connection that the server just closed
+            return xmlrpclib.SafeTransport.request(self, host, handler,
+                                                   request_body, verbose)
+        except (socket.error, httplib.HTTPException):
+            # in an unknown state, start over on the next call
+            self.errors += 1
+            self.close()
+            raise
+        finally:
+            self.last_used = time.time()
+            elapsed = self.last_used - start
+            latency = self.latencies.setdefault(method, [0, 0.0, 0.0])
+            latency[0] += 1
+            latency[1] += elapsed
+            latency[2] = max(latency[2], elapsed)
+
+    def counters(self):
+        """
+        return the number of connections opened, of calls that failed
+        at the transport level, and per method, the number of calls and
+        their total and max latency in seconds
+        """
+        return {
+            'connects': self.connects,
+            'errors': self.errors,
+            'methods': dict((method, { 'calls': calls,
+                                       'total': total,
+                                       'max': longest })
+                            for method, (calls, total, longest)
+                            in self.latencies.items()),
+            }
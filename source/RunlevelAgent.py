@@ -18,6 +18,9 @@ import os
 import string
 import ssl
 
+import KeepAliveTransport
+import BootAPI
+
 CONFIG_FILE = "/tmp/source/configuration"
 SESSION_FILE = "/etc/planetlab/session"
 RLA_PID_FILE = "/var/run/rla.pid"
@@ -49,6 +52,7 @@ def read_config_file(filename):
 
     return vars
 
+vars = {}
 try:
     sys.path = ['/etc/planetlab'] + sys.path
     import plc_config
@@ -58,6 +62,13 @@ except:
     vars = read_config_file(filename)
     api_server_url = vars['BOOT_API_SERVER']
 
+# how long a session found valid is used again without an AuthCheck
+try:
+    session_validity_ttl = int(vars.get('SESSION_VALIDITY_TTL',
+                                        BootAPI.DEFAULT_SESSION_VALIDITY_TTL))
+except ValueError:
+    session_validity_ttl = BootAPI.DEFAULT_SESSION_VALIDITY_TTL
+
 
 class Auth:
     def __init__(self, username=None, password=None, **kwargs):
@@ -78,10 +89,12 @@ class PLC:
         # Using a self signed certificate
         # https://www.python.org/dev/peps/pep-0476/
         if hasattr(ssl, '_create_unverified_context'):
-            self.api = xmlrpclib.Server(self.url, verbose=False, allow_none=True,
-                                           context=ssl._create_unverified_context())
+            self.transport = KeepAliveTransport.KeepAliveTransport(
+                self.url, context=ssl._create_unverified_context())
         else :
-            self.api = xmlrpclib.Server(self.url, verbose=False, allow_none=True)
+            self.transport = KeepAliveTransport.KeepAliveTransport(self.url)
+        self.api = xmlrpclib.Server(self.url, verbose=False, allow_none=True,
+                                    transport=self.transport)
 
     def __getattr__(self, name):
         method = getattr(self.api, name)
@@ -115,10 +128,11 @@ def save_pid():
         print("Uuuhhh.... this should not occur.")
         sys.exit(1)
 
-def start_and_run():
-
-    save_pid()
-
+def authenticate():
+    """
+    return a PLC object for the session found in SESSION_FILE, once it
+    was found valid
+    """
     # Keep trying to authenticate session, waiting for NM to re-write the
     # session file, or DNS to succeed, until AuthCheck succeeds.
     while True:
@@ -126,15 +140,26 @@ def start_and_run():
             f = open(SESSION_FILE, 'r')
             session_str = f.read().strip()
             api = PLC(Auth(session=session_str), api_server_url)
+            # no need to check a session that was found valid recently
+            if BootAPI.session_known_good(session_str, api_server_url,
+                                          session_validity_ttl):
+                return api
             # NOTE: What should we do if this call fails?
             # TODO: handle dns failure here.
             api.AuthCheck()
-            break
+            BootAPI.mark_session_good(session_str, api_server_url)
+            return api
         except:
             print("Retry in 30 seconds: ", os.popen("uptime").read().strip())
             traceback.print_exc(limit=5)
             time.sleep(30)
 
+def start_and_run():
+
+    save_pid()
+
+    api = authenticate()
+
     try:
         env = 'production'
         if len(sys.argv) > 2:
@@ -176,6 +201,15 @@ def start_and_run():
             else:
                 api.ReportRunlevel({'run_level' : 'failboot'})
                 
+        except xmlrpclib.Fault as fault:
+            print("reporting error: ", os.popen("uptime").read().strip())
+            traceback.print_exc()
+            # the session was rejected, read it again and check it
+            # until a valid one shows up
+            if fault.faultCode == BootAPI.AUTH_FAULT:
+                BootAPI.forget_session_validity()
+                api = authenticate()
+                continue
         except:
             print("reporting error: ", os.popen("uptime").read().strip())
             traceback.print_exc()
@@ -0,0 +1,263 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2004-2007 The Trustees of Princeton University
+# All rights reserved.
+
+"""
+runs a sequence of steps, overlapping the ones that do not depend on
+each other
+
+Each module in steps/ declares in READS and WRITES the vars that its
+Run function reads and writes, along with the pseudo-resources, between
+angle brackets, that it uses (see steps/__init__.py). A step depends on
+the earlier steps that write something it reads or writes, or that
+read something it writes; a module that declares nothing, or '*', is a
+barrier, that waits for all the earlier steps and that all the later
+ones wait for.
+
+Ready steps are started in program order on at most STEP_WORKERS
+threads. The log output of a step is held back until all the steps
+before it are done, so that the log reads as if the steps had been run
+one after the other. With STEP_WORKERS=1, the steps are run in
+sequence in the calling thread, as they always were.
+"""
+
+import sys
+import time
+import traceback
+import threading
+import Queue
+
+DEFAULT_STEP_WORKERS = 4
+
+# declared by a module that touches everything, or assumed for one
+# that declares nothing
+BARRIER = '*'
+
+
+class BufferedLog:
+    """
+    stands for the log while a step runs in the background: entries are
+    kept aside, with the time they were made, until go_live(), and
+    passed on to the log from then on
+    """
+
+    def __init__(self, log):
+        self.log = log
+        self.lock = threading.Lock()
+        # (str, inc_newline, display_screen, time) per entry, with an
+        # inc_newline of None for what goes to the log file only
+        self.chunks = []
+        self.live = False
+        # for traceback.print_exc(file=log.OutputFile)
+        self.OutputFile = None
+        if log.OutputFile is not None:
+            self.OutputFile = BufferedLogFile(self)
+
+    def LogEntry(self, str, inc_newline = 1, display_screen = 1):
+        with self.lock:
+            if not self.live:
+                self.chunks.append((str, inc_newline, display_screen, time.time()))
+                return
+        self.log.LogEntry(str, inc_newline, display_screen)
+
+    def write(self, str):
+        self.LogEntry(str, 0, 1)
+
+    def LogError(self, str):
+        self.LogEntry(str, 0, self.log.ALWAYS)
+
+    def write_file(self, str):
+        """
+        write str to the log file only
+        """
+        with self.lock:
+            if not self.live:
+                self.chunks.append((str, None, None, None))
+                return
+        if self.log.OutputFile is not None:
+            self.log.OutputFile.write(str)
+
+    def flush(self):
+        with self.lock:
+            live = self.live
+        if live:
+            self.log.flush()
+
+    def print_stack(self):
+        """
+        dump current stack in log
+        """
+        self.LogError(traceback.format_exc())
+        self.flush()
+
+    def go_live(self):
+        """
+        write out what was kept aside so far, and stop buffering
+        """
+        with self.lock:
+            for (str, inc_newline, display_screen, when) in self.chunks:
+                if inc_newline is None:
+                    if self.log.OutputFile is not None:
+                        self.log.OutputFile.write(str)
+                else:
+                    self.log.LogEntry(str, inc_newline, display_screen, when = when)
+            del self.chunks[:]
+            self.live = True
+
+    def __getattr__(self, name):
+        return getattr(self.log, name)
+
+
+class BufferedLogFile:
+    """
+    what BufferedLog.OutputFile stands for: what is written there goes
+    to the log file only, in order with the entries
+    """
+
+    def __init__(self, log):
+        self.log = log
+
+    def write(self, str):
+        self.log.write_file(str)
+
+    def flush(self):
+        self.log.flush()
+
+
+class Step:
+    """
+    one call to a step module, module.Run(vars, *args, log, **kwargs);
+    the exceptions raised by an optional step are ignored
+    """
+
+    def __init__(self, module, *args, **kwargs):
+        self.module = module
+        self.name = module.__name__.split('.')[-1]
+        self.args = args
+        self.optional = kwargs.pop('optional', False)
+        self.kwargs = kwargs
+        self.reads = set(getattr(module, 'READS', [BARRIER]))
+        self.writes = set(getattr(module, 'WRITES', [BARRIER]))
+
+    def is_barrier(self):
+        return BARRIER in self.reads or BARRIER in self.writes
+
+    def depends_on(self, earlier):
+        """
+        whether this step must wait for an earlier one
+        """
+        if self.is_barrier() or earlier.is_barrier():
+            return True
+        return bool(earlier.writes & (self.reads | self.writes)) \
+            or bool(earlier.reads & self.writes)
+
+    def run(self, vars, log):
+        try:
+            return self.module.Run(vars, *(self.args + (log,)), **self.kwargs)
+        except:
+            if not self.optional:
+                raise
+
+
+class StepScheduler:
+
+    def __init__(self, vars, log, workers=None):
+        self.vars = vars
+        self.log = log
+        if workers is None:
+            try:
+                workers = int(vars.get('STEP_WORKERS', DEFAULT_STEP_WORKERS))
+            except ValueError:
+                workers = DEFAULT_STEP_WORKERS
+        self.workers = workers
+
+    def run(self, steps):
+        """
+        run steps, a list of Step, and return the list of their results
+
+        The first failure, in program order, is raised once the steps
+        already running are done; no other step is started after a
+        failure.
+        """
+        if self.workers <= 1 or len(steps) <= 1:
+            return [step.run(self.vars, self.log) for step in steps]
+
+        count = len(steps)
+        depends = [[j for j in range(i) if steps[i].depends_on(steps[j])]
+                   for i in range(count)]
+        logs = [BufferedLog(self.log) for step in steps]
+        results = [None] * count
+        started = [False] * count
+        done = [False] * count
+        failures = {}
+
+        todo = Queue.Queue()
+        finished = Queue.Queue()
+        workers = []
+        for i in range(min(self.workers, count)):
+            worker = threading.Thread(target=self._work,
+                                      args=(steps, logs, todo, finished))
+            worker.setDaemon(True)
+            worker.start()
+            workers.append(worker)
+
+        head = 0
+        logs[head].go_live()
+        running = 0
+        try:
+            while True:
+                if not failures:
+                    for i in range(count):
+                        if not started[i] and all(done[j] for j in depends[i]):
+                            started[i] = True
+                            running += 1
+                            todo.put(i)
+                if running == 0:
+                    break
+
+                # a timeout keeps the wait interruptible
+                while True:
+                    try:
+                        (i, result, failure) = finished.get(True, 1)
+                        break
+                    except Queue.Empty:
+                        pass
+                running -= 1
+                done[i] = True
+                if failure is not None:
+                    failures[i] = failure
+                else:
+                    results[i] = result
+
+                while head < count and done[head]:
+                    head += 1
+                    if head < count:
+                        logs[head].go_live()
+        finally:
+            for worker in workers:
+                todo.put(None)
+        # all the steps started are done, the workers only have to exit
+        for worker in workers:
+            worker.join()
+
+        # after a failure, the steps past it that did complete
+        for i in range(head, count):
+            if done[i]:
+                logs[i].go_live()
+
+        if failures:
+            (type, value, tb) = failures[min(failures)]
+            raise type, value, tb
+        return results
+
+    def _work(self, steps, logs, todo, finished):
+        while True:
+            i = todo.get()
+            if i is None:
+                return
+            try:
+                outcome = (i, steps[i].run(self.vars, logs[i]), None)
+            except:
+                outcome = (i, None, sys.exc_info())
+            finished.put(outcome)
@@ -0,0 +1,126 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2004-2007 The Trustees of Princeton University
+# All rights reserved.
+
+"""
+timeline of a boot manager run, in the chrome trace event format
+
+Each call to the Run function of a step (see instrument), and each
+command run through utils.sysexec, is recorded as a complete event
+with its wall time, the cpu time and peak rss it used, and its outcome.
+save() writes the events as a json file that chrome://tracing or
+perfetto can load, and that can be aggregated across nodes.
+
+The cpu time and peak rss of a step are those of the whole boot manager
+process and of the commands it waited for, so they include whatever
+ran at the same time on other threads; the ones of a command are its
+own.
+"""
+
+import os
+import time
+import json
+import resource
+import threading
+import functools
+
+# the events, and the names of the threads they were recorded on
+events = []
+threads = {}
+lock = threading.Lock()
+
+# timestamps are in microseconds since the module was loaded
+origin = time.time()
+
+
+def record(name, category, start, end, args):
+    """
+    add a complete event, between start and end as returned by time.time()
+    """
+    thread = threading.current_thread()
+    event = { 'name': name,
+              'cat': category,
+              'ph': 'X',
+              'ts': int((start - origin) * 1000000),
+              'dur': int((end - start) * 1000000),
+              'pid': os.getpid(),
+              'tid': thread.ident,
+              'args': args,
+              }
+    with lock:
+        events.append(event)
+        threads[thread.ident] = thread.name
+
+
+def instrument(module):
+    """
+    replace the Run function of a step module with one that records
+    each call
+    """
+    run = module.Run
+    if getattr(run, 'timed', False):
+        return
+    name = module.__name__.split('.')[-1]
+
+    @functools.wraps(run)
+    def timed_run(*args, **kwargs):
+        outcome = {}
+        start = time.time()
+        before = os.times()
+        try:
+            result = run(*args, **kwargs)
+            if result is None or isinstance(result, (int, long)):
+                outcome['result'] = result
+            else:
+                outcome['result'] = repr(result)
+            return result
+        except BaseException as e:
+            outcome['error'] = e.__class__.__name__
+            raise
+        finally:
+            after = os.times()
+            outcome['cpu'] = (after[0] - before[0]) + (after[1] - before[1])
+            outcome['children_cpu'] = (after[2] - before[2]) + (after[3] - before[3])
+            outcome['maxrss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            outcome['children_maxrss_kb'] = \
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+            record(name, 'step', start, time.time(), outcome)
+
+    timed_run.timed = True
+    module.Run = timed_run
+
+
+def command(cmd, start, returncode, rusage):
+    """
+    record a command run since start, given its exit code and its
+    resource usage as returned by os.wait4
+    """
+    args = { 'cmd': cmd, 'exit': returncode }
+    if rusage is not None:
+        args['cpu'] = rusage.ru_utime + rusage.ru_stime
+        args['maxrss_kb'] = rusage.ru_maxrss
+    words = cmd.split()
+    name = os.path.basename(words[0]) if words else cmd
+    record(name, 'sysexec', start, time.time(), args)
+
+
+def save(path, info):
+    """
+    write the timeline to path, with info, a dict, attached as
+    otherData to tell which node and which run it comes from
+    """
+    with lock:
+        trace = [ { 'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(),
+                    'tid': ident, 'args': { 'name': name } }
+                  for (ident, name) in threads.items() ]
+        trace += events
+        document = { 'traceEvents': trace,
+                     'displayTimeUnit': 'ms',
+                     'otherData': info,
+                     }
+        out = open(path, 'w')
+        try:
+            json.dump(document, out, sort_keys=True)
+        finally:
+            out.close()
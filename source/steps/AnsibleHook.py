@@ -7,6 +7,9 @@ from Exceptions import *
 import utils
 import systeminfo
 
+READS = ['ANSIBLE_PATH', 'ANSIBLE_HASH', 'RUN_LEVEL']
+WRITES = ['*']
+
 def run_ansible(ansible_path, ansible_hash, playbook_name, log):
     try:
         if (ansible_hash):
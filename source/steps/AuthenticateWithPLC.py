@@ -12,6 +12,10 @@ import os
 from Exceptions import *
 import BootAPI
 
+READS = ['NODE_ID', 'NODE_KEY', 'DISCONNECTED_OPERATION',
+         'NUM_AUTH_FAILURES_BEFORE_DEBUG', 'API_PREFETCH']
+WRITES = ['API_SERVER_INST', '<plc>', '<session>']
+
 
 AUTH_FAILURE_COUNT_FILE = "/tmp/authfailurecount"
 
@@ -52,6 +56,9 @@ def Run(vars, log):
                 os.unlink(AUTH_FAILURE_COUNT_FILE)
             except OSError as e:
                 pass
+
+            if vars.get('API_PREFETCH', '0') == '1':
+                Prefetch(vars, log)
             
             return 1
     except BootManagerException as e:
@@ -87,3 +94,29 @@ def Run(vars, log):
         log.write("Canceling boot process and going into debug mode.\n")
 
     raise BootManagerException("Unable to authenticate node.")
+
+
+def Prefetch(vars, log):
+    """
+    start fetching in the background the data that later steps read
+    from PLC, so that it is in the BootAPI cache by the time they need
+    it; the calls have to match the ones made by these steps
+    """
+    node_id = vars['NODE_ID']
+
+    def _interface_tags(results):
+        # plnet, called by WriteNetworkConfig, reads the tags of each interface
+        interfaces = results[0] or []
+        return [ ("GetInterfaceTags", ({'interface_tag_id': interface['interface_tag_ids']},))
+                 for interface in interfaces if interface['interface_tag_ids'] ]
+
+    log.write("Prefetching node data from PLC.\n")
+    try:
+        BootAPI.prefetch(vars, [
+            # GetAndUpdateNodeDetails
+            ("GetInterfaces", ({'node_id': node_id},)),
+            # InstallPartitionDisks
+            ("GetNodeTags", ({'node_id': node_id},)),
+            ], _interface_tags)
+    except BootManagerException as e:
+        log.write("Unable to prefetch node data: {}.\n".format(e))
@@ -23,6 +23,9 @@ import UpdateNodeConfiguration
 import StopRunlevelAgent
 import MakeInitrd
 
+READS = ['*']
+WRITES = ['*']
+
 def Run(vars, log):
     """
     Load the kernel off of a node and boot to it.
@@ -314,6 +317,8 @@ def Run(vars, log):
 
     utils.sysexec_noerr('hwclock --systohc --utc ', log)
 #    utils.breakpoint("Before kexec");
+    # nothing that is still queued in the log would make it past kexec
+    log.flush()
     try:
         utils.sysexec('kexec --force --initrd=/tmp/initrd --append="{}" /tmp/kernel'.format(kargs), log)
     except BootManagerException as e:
@@ -8,13 +8,17 @@
 
 import string
 
-import InstallPartitionDisks
 from Exceptions import *
 import systeminfo
 import utils
 import os
 
 import ModelOptions
+import InstallCheckpoint
+
+READS = ['SYSIMG_PATH', 'PARTITIONS', 'ROOT_MOUNTED', 'MINIMUM_DISK_SIZE',
+         'NODE_MODEL_OPTIONS']
+WRITES = ['ROOT_MOUNTED', '<sysimg>', '<disks>']
 
 
 def Run(vars, log):
@@ -51,6 +55,10 @@ def Run(vars, log):
         raise BootManagerException("Variable in vars, shouldn't be: {}\n".format(var))
 
     devices_dict = systeminfo.get_block_devices_dict(vars, log)
+
+    # imported here, not at the top, so that loading this step does not
+    # load the install steps (see steps/__init__.py)
+    import InstallPartitionDisks
     
     # will contain the new devices to add to the volume group
     new_devices = []
@@ -140,6 +148,9 @@ def Run(vars, log):
     if len(new_devices) > 0:
 
         log.write("Extending planetlab volume group.\n")
+
+        # what a reinstall left on the disks is not to be trusted anymore
+        InstallCheckpoint.InstallCheckpoint(vars, log).invalidate()
         
         log.write("Unmounting disks.\n")
         try:
@@ -17,6 +17,10 @@ import utils
 import notify_messages
 import BootAPI
 
+READS = ['NODE_ID', 'virt', 'MINIMUM_MEMORY', 'MINIMUM_DISK_SIZE',
+         'SKIP_HARDWARE_REQUIREMENT_CHECK', '<disks>']
+WRITES = ['INSTALL_BLOCK_DEVICES', 'USABLE_BLOCK_DEVICES', '<plc>']
+
 
 def Run(vars, log):
     """
@@ -42,6 +46,7 @@ def Run(vars, log):
                             If set, don't check if minimum requirements are met
     Sets the following variables:
     INSTALL_BLOCK_DEVICES    list of block devices to install onto
+    USABLE_BLOCK_DEVICES     the same list, left as is by the later steps
     """
 
     log.write("\n\nStep: Checking if hardware requirements met.\n")        
@@ -208,8 +213,11 @@ def Run(vars, log):
     log.write("Usable block devices:\n")
     log.write(repr(install_devices.keys()) + "\n")
 
-    # save the list of devices for the following steps
+    # save the list of devices for the following steps; InstallPartitionDisks
+    # narrows down INSTALL_BLOCK_DEVICES to the ones it used, while the
+    # install checkpoint needs the list as found here (see InstallCheckpoint)
     vars["INSTALL_BLOCK_DEVICES"] = install_devices.keys()
+    vars["USABLE_BLOCK_DEVICES"] = sorted(install_devices.keys())
 
 
     # ensure the total disk size is large enough. if
@@ -10,6 +10,9 @@ from __future__ import print_function
 
 from Exceptions import *
 
+READS = []
+WRITES = ['<console>']
+
 welcome_message= \
 """
 ********************************************************************************
@@ -51,6 +54,8 @@ def Run(vars, log):
     try:
         confirmation = ""
         install = 0
+        # the log must be out before the question
+        log.flush()
         print(welcome_message)
         
         while confirmation not in ("yes","no"):
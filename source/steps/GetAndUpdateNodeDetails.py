@@ -13,6 +13,12 @@ from Exceptions import *
 import BootAPI
 import ModelOptions
 
+READS = ['NODE_ID', 'INTERFACE_SETTINGS', 'WAS_NODE_ID_IN_CONF',
+         'WAS_NODE_KEY_IN_CONF', 'SKIP_HARDWARE_REQUIREMENT_CHECK']
+WRITES = ['BOOT_STATE', 'RUN_LEVEL', 'SITE_ID', 'INTERFACES', 'NODE_MODEL',
+          'NODE_MODEL_OPTIONS', 'SKIP_HARDWARE_REQUIREMENT_CHECK', 'virt',
+          'nodefamily', 'extensions', 'plain', '<plc>']
+
 def Run(vars, log):
     """
 
@@ -69,9 +75,23 @@ def Run(vars, log):
     except ValueError as var:
         raise BootManagerException("Variable in vars, shouldn't be: {}\n".format(var))
 
-    node_details = BootAPI.call_api_function(vars, "GetNodes", 
-                                             (vars['NODE_ID'], 
-                                              ['boot_state', 'nodegroup_ids', 'interface_ids', 'model', 'site_id']))[0]
+    # a single round trip for the node, its interfaces and its flavour
+    (node_details, interfaces, node_flavour) = BootAPI.call_api_batch(vars, [
+        ("GetNodes", (vars['NODE_ID'],
+                      ['boot_state', 'nodegroup_ids', 'interface_ids', 'model', 'site_id'])),
+        ("GetInterfaces", ({'node_id': vars['NODE_ID']},)),
+        ("GetNodeFlavour", (vars['NODE_ID'],)),
+        ], raise_faults = False)
+
+    if isinstance(node_details, BootManagerException):
+        raise node_details
+    node_details = node_details[0]
+
+    if isinstance(interfaces, BootManagerException):
+        # the way GetInterfaces used to be called, and the way it is
+        # found in the stashes saved by older boot managers
+        interfaces = BootAPI.call_api_function(vars, "GetInterfaces",
+                                               (node_details['interface_ids'],))
 
     vars['BOOT_STATE'] = node_details['boot_state']
     vars['RUN_LEVEL'] = node_details['boot_state']
@@ -93,7 +113,6 @@ def Run(vars, log):
 
     # this contains all the node networks, for now, we are only concerned
     # in the primary network
-    interfaces = BootAPI.call_api_function(vars, "GetInterfaces", (node_details['interface_ids'],))
     got_primary = 0
     for network in interfaces:
         if network['is_primary'] == 1:
@@ -106,12 +125,10 @@ def Run(vars, log):
 
     vars['INTERFACES'] = interfaces
     
-    # call getNodeFlavour and store in VARS['node_flavour']
-    try:
-        node_flavour = BootAPI.call_api_function(vars, "GetNodeFlavour", (vars['NODE_ID'],))
-    except:
+    # GetNodeFlavour, to be stored in vars
+    if isinstance(node_flavour, BootManagerException):
         log.write("GetNodeFlavour failed, not fatal if the node flavour is available in ``configuration''\n")
-        pass
+        node_flavour = None
     
     flavour_keys = [
             'virt',# 'vs' or 'lxc'
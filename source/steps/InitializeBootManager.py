@@ -16,6 +16,10 @@ import string
 
 from Exceptions import *
 import utils
+import BootAPI
+
+READS = ['*']
+WRITES = ['*']
 
 
 # locations of boot os version files
@@ -63,25 +67,10 @@ def Run(vars, log):
     except:
         raise BootManagerException("configuration file does not specify API server URL")
         
-    api_inst = None
-    # preferred strategy : select tlsv1 as the encryption protocol
-    try:
-        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
-        api_inst = xmlrpclib.ServerProxy(server_url,
-                                         context=ssl_context,
-                                         verbose=0)
-    # this is only supported in python >= 2.7.9 though, so allow for failure
-    except:
-        print("Default xmlrpclib strategy failed")
-        import traceback
-        traceback.print_exc()
-        pass
-
-    # if that failed, resort to the old-fashioned code
-    if api_inst is None:
-        api_inst = xmlrpclib.ServerProxy(server_url, verbose=0)
+    (api_inst, transport) = BootAPI.connect(server_url)
 
     vars['API_SERVER_INST'] = api_inst
+    vars['API_TRANSPORT'] = transport
 
     if not __check_boot_version(vars, log):
         raise BootManagerException("Boot CD version insufficient to run the Boot Manager")
@@ -7,20 +7,48 @@
 # All rights reserved.
 # expected /proc/partitions format
 
-import os, string
+import os, sys, string
 import popen2
 import shutil
 import traceback 
 import time
+import stat
+import shlex
+import subprocess
+import tempfile
+import threading
+import Queue
 
 from Exceptions import *
 import utils
 import systeminfo
 import BootServerRequest
 import BootAPI
-
-
-def Run(vars, upgrade, log):
+import BootstrapFSCache
+import InstallCheckpoint
+
+READS = ['SYSIMG_PATH', 'PARTITIONS', 'NODE_ID', 'VERSION', 'ONE_PARTITION',
+         'virt', 'nodefamily', 'extensions', 'plain']
+WRITES = ['ROOT_MOUNTED', '<sysimg>', '<bootserver>']
+
+# how many times a broken tarball download gets resumed
+DOWNLOAD_MAX_RESUMES = 10
+# where tarballs get extracted in pipeline mode, relative to SYSIMG_PATH
+STAGING_DIR = ".bootstrapfs-staging"
+
+# compressed formats for bootstrapfs images, preferred first, as
+# (name, suffix, program needed on the node, tar uncompress option)
+CODECS = [
+    ('zst',    '.tar.zst', 'zstd',   '--use-compress-program=zstd'),
+    ('lbzip2', '.tar.bz2', 'lbzip2', '--use-compress-program=lbzip2'),
+    ('pbzip2', '.tar.bz2', 'pbzip2', '--use-compress-program=pbzip2'),
+    ('xz',     '.tar.xz',  'xz',     '-J'),
+]
+# always available, on the node and on the server
+DEFAULT_CODEC = ('bzip2', '.tar.bz2', 'bzip2', '-j')
+
+
+def Run(vars, upgrade, log, extracted=False, resumed=False):
     """
     Download core + extensions bootstrapfs tarballs and install on the hard drive
 
@@ -30,6 +58,14 @@ def Run(vars, upgrade, log):
     this is because the running system may have extraneous files
     that is to say, files that are *not* present in the bootstrapfs
     and that can impact/clobber the resulting upgrade
+
+    extracted is True when a previous attempt at this reinstall already
+    extracted the tarballs (see InstallCheckpoint); the filesystems are
+    then just mounted and set up again
+
+    resumed is True when the filesystems were made by a previous attempt;
+    unless the tarballs were extracted, that attempt may have stopped
+    halfway through, so the filesystems are emptied before extracting
     
     Expect the following variables from the store:
     SYSIMG_PATH          the path where the system image will be mounted
@@ -132,13 +168,14 @@ def Run(vars, upgrade, log):
     # the 'plain' option is for tests mostly
     plain = vars['plain']
     if plain:
-        download_suffix = ".tar"
-        uncompress_option = ""
         log.write("Using plain bootstrapfs images\n")
     else:
-        download_suffix = ".tar.bz2"
-        uncompress_option = "-j"
         log.write("Using compressed bootstrapfs images\n")
+        # restrict the codecs to try, e.g. BOOTSTRAPFS_CODECS=zst,lbzip2
+        codec_names = [ codec.strip() for codec in
+                        vars.get('BOOTSTRAPFS_CODECS', '').split(',') if codec.strip() ]
+        codecs = [ codec for codec in CODECS
+                   if not codec_names or codec[0] in codec_names ]
 
     log.write ("Using nodefamily={}\n".format(nodefamily))
     if not extensions:
@@ -146,56 +183,128 @@ def Run(vars, upgrade, log):
     else:
         log.write("Requested extensions {}\n".format(extensions))
     
-    bootstrapfs_names = [ nodefamily ] + extensions
+    if extracted:
+        log.write("Bootstrapfs tarballs already extracted, skipping\n")
+        bootstrapfs_names = []
+    else:
+        bootstrapfs_names = [ nodefamily ] + extensions
 
-    for name in bootstrapfs_names:
-        tarball = "bootstrapfs-{}{}".format(name, download_suffix)
-        source_file = "/boot/{}".format(tarball)
-        dest_file = "{}/{}".format(SYSIMG_PATH, tarball)
+    try:
+        download_segments = int(vars.get('DOWNLOAD_SEGMENTS', 1))
+        download_segments_min_size = int(vars.get('DOWNLOAD_SEGMENTS_MIN_SIZE', 0))
+    except ValueError as var:
+        raise BootManagerException("Invalid download segments setting: {}\n".format(var))
 
-        source_hash_file = "/boot/{}.sha1sum".format(tarball)
-        dest_hash_file = "{}/{}.sha1sum".format(SYSIMG_PATH, tarball)
+    # stream tarballs straight into tar, rather than going through disk
+    pipeline = vars.get('BOOTSTRAPFS_PIPELINE', '0') == '1'
 
-        time_beg = time.time()
-        log.write("downloading {}\n".format(source_file))
-        # 30 is the connect timeout, 14400 is the max transfer time in
-        # seconds (4 hours)
-        result = bs_request.DownloadFile(source_file, None, None,
-                                         1, 1, dest_file,
-                                         30, 14400)
-        time_end = time.time()
-        duration = int(time_end - time_beg)
-        log.write("Done downloading ({} seconds)\n".format(duration))
-        if result:
-            # Download SHA1 checksum file
-            log.write("downloading sha1sum for {}\n".format(source_file))
-            result = bs_request.DownloadFile(source_hash_file, None, None,
-                                             1, 1, dest_hash_file,
-                                             30, 14400)
- 
-            log.write("verifying sha1sum for {}\n".format(source_file))
-            if not utils.check_file_hash(dest_file, dest_hash_file):
-                raise BootManagerException(
-                    "FATAL: SHA1 checksum does not match between {} and {}"\
-                    .format(source_file, source_hash_file))
-                
-            
-            time_beg = time.time()
-            log.write("extracting {} in {}\n".format(dest_file, SYSIMG_PATH))
-            result = utils.sysexec("tar -C {} -xpf {} {}".format(SYSIMG_PATH, dest_file, uncompress_option), log)
-            time_end = time.time()
-            duration = int(time_end - time_beg)
-            log.write("Done extracting ({} seconds)\n".format(duration))
-            utils.removefile(dest_file)
+    # how many downloaded tarballs may wait for extraction, when not
+    # streaming; 0 means download and extract strictly one after the other
+    try:
+        prefetch_depth = int(vars.get('BOOTSTRAPFS_PREFETCH_DEPTH', 0))
+    except ValueError as var:
+        raise BootManagerException("Invalid prefetch depth setting: {}\n".format(var))
+
+    tarballs = []
+    for name in bootstrapfs_names:
+        if plain:
+            (download_suffix, uncompress_option) = (".tar", "")
         else:
+            (download_suffix, uncompress_option) = \
+                SelectCodec(bs_request, name, codecs, log)
+        tarball = "bootstrapfs-{}{}".format(name, download_suffix)
+        tarballs.append({
+            'name' : name,
+            'source_file' : "/boot/{}".format(tarball),
+            'dest_file' : "{}/{}".format(SYSIMG_PATH, tarball),
+            'source_hash_file' : "/boot/{}.sha1sum".format(tarball),
+            'dest_hash_file' : "{}/{}.sha1sum".format(SYSIMG_PATH, tarball),
+            'uncompress_option' : uncompress_option,
+            })
+
+    def _check_result(tarball, result):
+        if not result:
             # the main tarball is required
-            if name == nodefamily:
+            if tarball['name'] == nodefamily:
                 raise BootManagerException(
                     "FATAL: Unable to download main tarball {} from server."\
-                    .format(source_file))
+                    .format(tarball['source_file']))
             # for extensions, just issue a warning
             else:
-                log.write("WARNING: tarball for extension {} not found\n".format(name))
+                log.write("WARNING: tarball for extension {} not found\n"
+                          .format(tarball['name']))
+
+    # tarballs are kept by sha1 on a partition that upgrade preserves;
+    # reinstall wipes the disks though, so the cache starts afresh then
+    cache = None
+    try:
+        cache_size = int(vars.get('BOOTSTRAPFS_CACHE_SIZE', 0))
+    except ValueError as var:
+        raise BootManagerException("Invalid cache size setting: {}\n".format(var))
+    if cache_size > 0:
+        cache_dir = "{}/{}".format(SYSIMG_PATH,
+                                   vars.get('BOOTSTRAPFS_CACHE_DIR', 'vservers/.bootstrapfs-cache'))
+        log.write("Using bootstrapfs cache in {} (max {} bytes)\n".format(cache_dir, cache_size))
+        cache = BootstrapFSCache.BootstrapFSCache(cache_dir, cache_size, log)
+
+    if resumed and not extracted:
+        # keep the journal, and the tarballs the previous attempt got
+        # into the cache
+        keep = [ "{}/{}".format(SYSIMG_PATH, InstallCheckpoint.JOURNAL_NAME) ]
+        if cache is not None:
+            keep.append(cache.path)
+        log.write("Removing what a previous attempt left in {}\n".format(SYSIMG_PATH))
+        WipeSysimg(SYSIMG_PATH, keep)
+
+    if pipeline:
+        # each tarball is a single stream, that tar consumes as it comes
+        if download_segments > 1 or prefetch_depth > 0:
+            log.write("Streaming tarballs, not using DOWNLOAD_SEGMENTS={}"
+                      " nor BOOTSTRAPFS_PREFETCH_DEPTH={}\n"
+                      .format(download_segments, prefetch_depth))
+        # the cache is filled while streaming, which writes each tarball
+        # to disk anyway; without that, a cache that starts empty would
+        # stay empty
+        fill_cache = vars.get('BOOTSTRAPFS_CACHE_STREAMED', '1') == '1'
+        for tarball in tarballs:
+            result = StreamTarball(bs_request, tarball['source_file'],
+                                   tarball['source_hash_file'],
+                                   tarball['dest_hash_file'], SYSIMG_PATH,
+                                   tarball['uncompress_option'], cache,
+                                   fill_cache, log)
+            _check_result(tarball, result)
+    else:
+        # with its own request, so that stopping the prefetcher aborts
+        # the transfer it has in progress, and only that one
+        prefetch_request = BootServerRequest.BootServerRequest(vars)
+
+        def _fetch(tarball):
+            return FetchTarball(prefetch_request, tarball['source_file'],
+                                tarball['dest_file'],
+                                tarball['source_hash_file'],
+                                tarball['dest_hash_file'], cache,
+                                download_segments, download_segments_min_size,
+                                log)
+
+        def _discard(tarball):
+            if os.path.exists(tarball['dest_file']):
+                utils.removefile(tarball['dest_file'])
+
+        # tarball N+1 gets downloaded while tarball N is extracted,
+        # extraction order is preserved so extensions overlay the core
+        prefetcher = TarballPrefetcher(_fetch, _discard, tarballs, prefetch_depth)
+        prefetch_request.Abort = prefetcher.stopping
+        prefetcher.start()
+        try:
+            for (tarball, path) in prefetcher.results():
+                if path:
+                    ExtractTarball(path, SYSIMG_PATH,
+                                   tarball['uncompress_option'], log)
+                    if path == tarball['dest_file']:
+                        utils.removefile(path)
+                _check_result(tarball, path)
+        finally:
+            prefetcher.stop()
 
     # copy resolv.conf from the base system into our temp dir
     # so DNS lookups work correctly while we are chrooted
@@ -248,6 +357,459 @@ def Run(vars, upgrade, log):
 
     return 1
 
+def FindProgram(program):
+    """
+    return the full path of program if it can be found in PATH, None otherwise
+    """
+    for path in os.environ.get('PATH', '').split(':'):
+        candidate = os.path.join(path, program)
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return candidate
+    return None
+
+def SelectCodec(bs_request, name, codecs, log):
+    """
+    pick the first codec in codecs that can be used on this node and that
+    the boot server offers for the bootstrapfs image name, or DEFAULT_CODEC
+
+    Return a (suffix, uncompress_option) tuple.
+    """
+    offered = { DEFAULT_CODEC[1] : True }
+    for (codec, suffix, program, option) in codecs:
+        if FindProgram(program) is None:
+            continue
+        if suffix not in offered:
+            size = bs_request.ProbeFile("/boot/bootstrapfs-{}{}".format(name, suffix),
+                                        1, 1, 30)
+            offered[suffix] = size >= 0
+        if offered[suffix]:
+            log.write("Using {} for bootstrapfs-{}{}\n".format(codec, name, suffix))
+            return (suffix, option)
+    log.write("Using {} for bootstrapfs-{}{}\n"
+              .format(DEFAULT_CODEC[0], name, DEFAULT_CODEC[1]))
+    return (DEFAULT_CODEC[1], DEFAULT_CODEC[3])
+
+class TarballPrefetcher(threading.Thread):
+    """
+    download tarballs in a background thread, in order, while the
+    caller extracts the previous ones; at most depth downloaded
+    tarballs wait in the queue, so that at any time no more than
+    depth + 2 tarballs are on disk. With a depth of 0, each tarball
+    is downloaded by results() right before being returned.
+
+    fetch should give up as soon as the stopping event is set; stop()
+    then passes each tarball to discard, so that the ones downloaded
+    ahead, or partly, do not stay on disk.
+    """
+    def __init__(self, fetch, discard, tarballs, depth):
+        threading.Thread.__init__(self, name="TarballPrefetcher")
+        self.daemon = True
+        self.fetch = fetch
+        self.discard = discard
+        self.tarballs = tarballs
+        self.depth = depth
+        self.queue = Queue.Queue(max(depth, 1))
+        self.stopping = threading.Event()
+
+    def start(self):
+        if self.depth > 0:
+            threading.Thread.start(self)
+
+    def run(self):
+        for tarball in self.tarballs:
+            if self.stopping.is_set():
+                return
+            try:
+                item = (tarball, self.fetch(tarball), None)
+            except:
+                item = (tarball, 0, sys.exc_info())
+            while not self.stopping.is_set():
+                try:
+                    self.queue.put(item, True, 1)
+                    break
+                except Queue.Full:
+                    pass
+            if item[2] is not None:
+                return
+
+    def results(self):
+        """
+        yield (tarball, fetch result) tuples in the original order,
+        re-raising in the caller any exception raised while fetching
+        """
+        for tarball in self.tarballs:
+            if self.depth > 0:
+                (tarball, result, exc_info) = self.queue.get()
+                if exc_info is not None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+            else:
+                result = self.fetch(tarball)
+            yield (tarball, result)
+
+    def stop(self):
+        """
+        abort the download in progress, wait for the thread to be done,
+        and discard the tarballs left
+        """
+        self.stopping.set()
+        if self.is_alive():
+            self.join()
+        for tarball in self.tarballs:
+            try:
+                self.discard(tarball)
+            except BootManagerException:
+                pass
+
+def FetchHash(bs_request, source_hash_file, dest_hash_file, log):
+    """
+    download source_hash_file into dest_hash_file, unless the copy
+    left there by a previous install is still up to date
+
+    Return the sha1 it contains, or None if it could not be downloaded.
+    """
+    validators = {}
+    if os.path.isfile(dest_hash_file):
+        validators['mtime'] = os.path.getmtime(dest_hash_file)
+    log.write("downloading {}\n".format(source_hash_file))
+    if not bs_request.DownloadFile(source_hash_file, None, None,
+                                   1, 1, dest_hash_file,
+                                   30, 14400,
+                                   Validators = validators):
+        return None
+    if not validators.get('modified', True):
+        log.write("{} not modified\n".format(source_hash_file))
+    return utils.read_digest(dest_hash_file)
+
+def FetchTarball(bs_request, source_file, dest_file,
+                 source_hash_file, dest_hash_file, cache,
+                 download_segments, download_segments_min_size, log):
+    """
+    download source_file into dest_file, and check it against the sha1
+    found in source_hash_file, itself downloaded into dest_hash_file.
+    With a cache, the tarball is looked up by sha1 and only downloaded,
+    into the cache, when missing.
+
+    Return the path of the tarball to extract, which is dest_file when not
+    using the cache, or None if the tarball could not be downloaded.
+    Raise a BootManagerException if the sha1 does not match.
+    """
+    expected = FetchHash(bs_request, source_hash_file, dest_hash_file, log)
+    if expected is None:
+        return None
+
+    if cache is not None:
+        cached = cache.lookup(expected)
+        if cached is not None:
+            return cached
+        dest_file = cache.partial_path(expected)
+
+    # the sha1 is computed while downloading
+    digest = utils.DigestSink('sha1')
+
+    time_beg = time.time()
+    log.write("downloading {}\n".format(source_file))
+    # 30 is the connect timeout, 14400 is the max transfer time in
+    # seconds (4 hours); a broken transfer is resumed where it stopped
+    # as long as the overall download fits in these 4 hours
+    # large tarballs are fetched as several parallel byte ranges
+    result = bs_request.DownloadFileSegmented(source_file, 1, 1, dest_file,
+                                              download_segments,
+                                              download_segments_min_size,
+                                              30, 14400,
+                                              MaxResumes = DOWNLOAD_MAX_RESUMES,
+                                              ResumeTimeBudget = 14400,
+                                              DigestSink = digest)
+    time_end = time.time()
+    duration = int(time_end - time_beg)
+    log.write("Done downloading ({} seconds)\n".format(duration))
+    if not result:
+        if cache is not None:
+            cache.discard(expected)
+        return None
+
+    log.write("verifying sha1sum for {}\n".format(source_file))
+    if digest.hexdigest() != expected:
+        if cache is not None:
+            cache.discard(expected)
+        raise BootManagerException(
+            "FATAL: SHA1 checksum does not match between {} and {}"\
+            .format(source_file, source_hash_file))
+
+    if cache is not None:
+        return cache.commit(expected)
+    return dest_file
+
+def ExtractTarball(dest_file, sysimg, uncompress_option, log):
+    """
+    extract a downloaded tarball in sysimg
+    """
+    time_beg = time.time()
+    log.write("extracting {} in {}\n".format(dest_file, sysimg))
+    utils.sysexec("tar -C {} -xpf {} {}".format(sysimg, dest_file, uncompress_option), log)
+    time_end = time.time()
+    duration = int(time_end - time_beg)
+    log.write("Done extracting ({} seconds)\n".format(duration))
+
+class TeeStream:
+    """
+    file-like object that writes to stream, and to a copy for as long
+    as writing to the copy works
+    """
+    def __init__(self, stream, copy, log):
+        self.stream = stream
+        self.copy = copy
+        self.log = log
+
+    def write(self, data):
+        self.stream.write(data)
+        if self.copy is not None:
+            try:
+                self.copy.write(data)
+            except IOError as e:
+                self.log.write("Giving up on copy of stream: {}\n".format(e))
+                self.close_copy()
+
+    def close_copy(self):
+        """
+        close the copy, return True if it was written completely
+        """
+        if self.copy is None:
+            return False
+        try:
+            self.copy.close()
+            return True
+        except IOError:
+            return False
+        finally:
+            self.copy = None
+
+def StreamTarball(bs_request, source_file, source_hash_file, dest_hash_file,
+                  sysimg, uncompress_option, cache, fill_cache, log):
+    """
+    download source_file straight into the stdin of a tar process that
+    extracts it in a staging area, computing its sha1 on the way; the
+    staged tree is moved into sysimg only if the sha1 matches the one
+    in source_hash_file, and is discarded otherwise.
+    The staging area has a part on each filesystem mounted in sysimg
+    (see StagingMounts), so that committing it only renames files.
+    With a cache, a cached tarball is extracted directly, and with
+    fill_cache, a missing one is copied into the cache while being
+    streamed.
+
+    Return 1 if successful, 0 if the tarball could not be downloaded.
+    Raise a BootManagerException if the sha1 does not match or if
+    the extraction fails.
+    """
+    expected = FetchHash(bs_request, source_hash_file, dest_hash_file, log)
+    if expected is None:
+        return 0
+
+    if cache is not None:
+        cached = cache.lookup(expected)
+        if cached is not None:
+            ExtractTarball(cached, sysimg, uncompress_option, log)
+            return 1
+
+    staging = "{}/{}".format(sysimg, STAGING_DIR)
+    mounts = StagingMounts(sysimg)
+    PrepareStaging(staging, sysimg, mounts, log)
+
+    digest = utils.DigestSink('sha1')
+    errors = tempfile.TemporaryFile()
+    cmd = "tar -C {} -xpf - {}".format(staging, uncompress_option)
+
+    time_beg = time.time()
+    log.write("streaming {} into {}\n".format(source_file, cmd))
+    try:
+        tar = subprocess.Popen(shlex.split(cmd), stdin=subprocess.PIPE, stderr=errors)
+    except OSError:
+        ReleaseStaging(staging, sysimg, mounts, log)
+        RemoveStaging(staging, mounts)
+        raise BootManagerException("Unable to run {}".format(cmd))
+
+    stream = tar.stdin
+    if cache is not None and fill_cache:
+        stream = TeeStream(tar.stdin, open(cache.partial_path(expected), "wb"), log)
+    try:
+        result = bs_request.DownloadFile(source_file, None, None,
+                                         1, 1, None,
+                                         30, 14400,
+                                         MaxResumes = DOWNLOAD_MAX_RESUMES,
+                                         ResumeTimeBudget = 14400,
+                                         DigestSink = digest,
+                                         DestStream = stream)
+    finally:
+        try:
+            tar.stdin.close()
+        except IOError:
+            pass
+        returncode = tar.wait()
+        cached = cache is not None and fill_cache and stream.close_copy()
+        ReleaseStaging(staging, sysimg, mounts, log)
+    time_end = time.time()
+    duration = int(time_end - time_beg)
+    log.write("Done downloading and extracting ({} seconds)\n".format(duration))
+
+    errors.seek(0)
+    stderrdata = errors.read()
+    errors.close()
+    if stderrdata:
+        log.write("==========stderr\n" + stderrdata)
+
+    def _discard():
+        RemoveStaging(staging, mounts)
+        if cache is not None and fill_cache:
+            cache.discard(expected)
+
+    if not result:
+        _discard()
+        return 0
+    if returncode != 0:
+        _discard()
+        raise BootManagerException("Running {} failed (rc={})".format(cmd, returncode))
+
+    log.write("verifying sha1sum for {}\n".format(source_file))
+    if digest.hexdigest() != expected:
+        log.write("Discarding staged tree {}\n".format(staging))
+        _discard()
+        raise BootManagerException(
+            "FATAL: SHA1 checksum does not match between {} and {}"\
+            .format(source_file, source_hash_file))
+
+    log.write("committing staged tree {} into {}\n".format(staging, sysimg))
+    try:
+        CommitStagedTree(staging, sysimg, log)
+        for mount in mounts:
+            mount_staging = os.path.join(mount, STAGING_DIR)
+            CommitStagedTree(mount_staging, mount, log)
+            CopyDirAttributes(mount_staging, mount)
+    except (OSError, IOError) as e:
+        raise BootManagerException("Unable to commit staged tree: {}".format(e))
+    RemoveStaging(staging, mounts)
+
+    if cached:
+        cache.commit(expected)
+    elif cache is not None and fill_cache:
+        cache.discard(expected)
+    return 1
+
+def StagingMounts(sysimg):
+    """
+    return the mount points of the disk filesystems mounted below
+    sysimg, e.g. sysimg/vservers, parents first
+    """
+    prefix = os.path.realpath(sysimg).rstrip('/') + '/'
+    mounts = []
+    try:
+        for line in file("/proc/mounts"):
+            fields = line.split()
+            # leave out proc, sysfs and the like
+            if len(fields) < 2 or not fields[0].startswith('/'):
+                continue
+            # spaces and the like are octal-escaped in /proc/mounts
+            mount = fields[1].decode('string_escape')
+            if mount.startswith(prefix) and len(mount) > len(prefix) \
+               and STAGING_DIR not in mount:
+                mounts.append(mount)
+    except IOError:
+        pass
+    return sorted(set(mounts))
+
+def PrepareStaging(staging, sysimg, mounts, log):
+    """
+    create the staging area for sysimg; for each filesystem mounted
+    below sysimg, the matching directory of the staging area is a bind
+    mount of a staging directory on that filesystem, so that tar
+    extracts the files there directly
+    """
+    # in case a previous attempt was interrupted
+    ReleaseStaging(staging, sysimg, mounts, log)
+    RemoveStaging(staging, mounts)
+    utils.makedirs(staging)
+    for mount in mounts:
+        mount_staging = os.path.join(mount, STAGING_DIR)
+        utils.makedirs(mount_staging)
+        # so that the mount point keeps its attributes, unless
+        # the tarball has its own
+        CopyDirAttributes(mount, mount_staging)
+        bind = os.path.join(staging, os.path.relpath(mount, os.path.realpath(sysimg)))
+        utils.makedirs(bind)
+        utils.sysexec("mount --bind {} {}".format(mount_staging, bind), log)
+
+def ReleaseStaging(staging, sysimg, mounts, log):
+    """
+    undo the bind mounts of PrepareStaging, leaving each part of the
+    staging area in place on its own filesystem
+    """
+    for mount in reversed(mounts):
+        bind = os.path.join(staging, os.path.relpath(mount, os.path.realpath(sysimg)))
+        if os.path.ismount(bind):
+            utils.sysexec_noerr("umount {}".format(bind), log)
+
+def RemoveStaging(staging, mounts):
+    """
+    remove the staging area, once released
+    """
+    utils.removedir(staging)
+    for mount in mounts:
+        utils.removedir(os.path.join(mount, STAGING_DIR))
+
+def CopyDirAttributes(src, dst):
+    """
+    give the directory dst the owner, mode and times of src
+    """
+    st = os.lstat(src)
+    os.chown(dst, st.st_uid, st.st_gid)
+    os.chmod(dst, stat.S_IMODE(st.st_mode))
+    os.utime(dst, (st.st_atime, st.st_mtime))
+
+def CommitStagedTree(staging, target, log):
+    """
+    move the contents of staging into target, merging directories and
+    replacing anything else, just like tar does when extracting in place;
+    the mount points below target are left alone, as their contents
+    were staged on their own filesystem
+    """
+    for name in os.listdir(staging):
+        src = os.path.join(staging, name)
+        dst = os.path.join(target, name)
+        if os.path.isdir(src) and not os.path.islink(src) \
+           and os.path.isdir(dst) and not os.path.islink(dst):
+            if os.path.ismount(dst):
+                os.rmdir(src)
+                continue
+            CommitStagedTree(src, dst, log)
+            # the directory attributes are the ones from the tarball
+            CopyDirAttributes(src, dst)
+            os.rmdir(src)
+            continue
+        if os.path.lexists(dst):
+            if os.path.isdir(dst) and not os.path.islink(dst):
+                shutil.rmtree(dst)
+            else:
+                os.unlink(dst)
+        os.rename(src, dst)
+
+def WipeSysimg(path, keep):
+    """
+    remove everything below path, except lost+found, the paths in keep,
+    and the directories that lead to them or that other filesystems
+    are mounted on
+    """
+    keep = [ os.path.normpath(kept) for kept in keep ]
+    for name in os.listdir(path):
+        entry = os.path.normpath(os.path.join(path, name))
+        if name == 'lost+found' or entry in keep:
+            continue
+        if os.path.isdir(entry) and not os.path.islink(entry):
+            if os.path.ismount(entry) or \
+               [ kept for kept in keep if kept.startswith(entry + "/") ]:
+                WipeSysimg(entry, keep)
+            else:
+                shutil.rmtree(entry)
+        else:
+            os.remove(entry)
+
 # the upgrade hook
 def CleanupSysimgBeforeUpgrade(sysimg, target_nodefamily, log):
 
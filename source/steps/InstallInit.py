@@ -12,6 +12,9 @@ import os, sys, string
 import utils
 from Exceptions import *
 
+READS = ['TEMP_PATH', 'SYSIMG_PATH', 'PLCONF_DIR']
+WRITES = ['ROOT_MOUNTED', '<sysimg>']
+
 def Run(vars, log):
     """
     Setup the install environment:
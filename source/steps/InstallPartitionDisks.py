@@ -18,6 +18,11 @@ import BootServerRequest
 import BootAPI
 import ModelOptions
 
+READS = ['NODE_ID', 'TEMP_PATH', 'SWAP_SIZE', 'VSERVERS_SIZE',
+         'ONE_PARTITION', 'NODE_MODEL_OPTIONS', 'virt']
+WRITES = ['INSTALL_BLOCK_DEVICES', '<sysimg>', '<disks>', '<plc>',
+          '<bootserver>']
+
 def Run(vars, log):
     """
     Setup the block devices for install, partition them w/ LVM
@@ -204,7 +209,8 @@ def Run(vars, log):
     return 1
 
 
-import parted
+# parted is imported by the functions that use it, so that a boot
+# that needs no partitioning does not load it
 def single_partition_device(device, vars, log):
     """
     initialize a disk by removing the old partition tables,
@@ -212,6 +218,7 @@ def single_partition_device(device, vars, log):
 
     return 1 if sucessful, 0 otherwise
     """
+    import parted
 
     # two forms, depending on which version of pyparted we have
     # v1 does not have a 'version' method
@@ -230,6 +237,7 @@ def single_partition_device(device, vars, log):
         raise
 
 def single_partition_device_1_x (device, vars, log):
+    import parted
     
     lvm_flag = parted.partition_flag_get_by_name('lvm')
     
@@ -276,6 +284,7 @@ def single_partition_device_1_x (device, vars, log):
 
 
 def single_partition_device_2_x (device, vars, log):
+    import parted
     try:
         log.write("Using pyparted 2.x\n")
 
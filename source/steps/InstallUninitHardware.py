@@ -12,6 +12,9 @@ import os
 from Exceptions import *
 import utils
 
+READS = ['TEMP_PATH', 'SYSIMG_PATH', 'PARTITIONS']
+WRITES = ['<sysimg>', '<disks>']
+
 
 
 def Run(vars, log):
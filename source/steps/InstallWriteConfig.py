@@ -15,6 +15,10 @@ import utils
 import BootAPI
 import ModelOptions
 
+READS = ['SYSIMG_PATH', 'PLCONF_DIR', 'INTERFACE_SETTINGS', 'PARTITIONS',
+         'ONE_PARTITION', 'VERSION', 'virt', '<sysimg>']
+WRITES = []
+
 def Run(vars, log):
 
     """
@@ -14,6 +14,9 @@ from Exceptions import *
 import utils
 import systeminfo
 
+READS = ['SYSIMG_PATH', 'PARTITIONS']
+WRITES = ['<sysimg>']
+
 # for centos5.3
 # 14:42:27(UTC) No module dm-mem-cache found for kernel 2.6.22.19-vs2.3.0.34.33.onelab, aborting.
 # http://kbase.redhat.com/faq/docs/DOC-16528;jsessionid=7E984A99DE8DB094D9FB08181C71717C.ab46478d
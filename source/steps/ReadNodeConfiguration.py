@@ -19,6 +19,12 @@ import BootAPI
 import notify_messages
 import UpdateRunLevelWithPLC
 
+READS = ['DISCONNECTED_OPERATION']
+WRITES = ['INTERFACE_SETTINGS', 'NODE_ID', 'NODE_KEY', 'WAS_NODE_ID_IN_CONF',
+          'WAS_NODE_KEY_IN_CONF', 'DISCONNECTED_OPERATION', 'RUN_LEVEL',
+          'STATE_CHANGE_NOTIFY', 'STATE_CHANGE_NOTIFY_MESSAGE', '<disks>',
+          '<bootserver>', '<plc>']
+
 
 # two possible names of the configuration files
 NEW_CONF_FILE_NAME = "plnode.txt"
@@ -8,6 +8,9 @@
 
 from Exceptions import *
 
+READS = []
+WRITES = ['<plc>']
+
 def Run(vars, log):
 
     log.write("\n\nStep: Sending hardware configuration to PLC.\n")
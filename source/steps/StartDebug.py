@@ -13,6 +13,9 @@ import os
 from Exceptions import *
 import utils
 
+READS = ['BM_SOURCE_DIR']
+WRITES = ['<sshd>']
+
 
 warning_message = \
 """
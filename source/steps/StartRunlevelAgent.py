@@ -12,6 +12,9 @@ import os
 from Exceptions import *
 import BootAPI
 
+READS = ['BM_SOURCE_DIR', '<session>']
+WRITES = ['<runlevelagent>']
+
 def Run(vars, log):
     """
         Start the RunlevelAgent.py script.  Should follow
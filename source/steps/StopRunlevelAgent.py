@@ -12,6 +12,9 @@ import os
 from Exceptions import *
 import BootAPI
 
+READS = ['BM_SOURCE_DIR']
+WRITES = ['<runlevelagent>', '<plc>']
+
 
 def Run(vars, log):
     """
@@ -11,6 +11,9 @@ import BootAPI
 import notify_messages
 import os.path
 
+READS = []
+WRITES = ['<plc>']
+
 
 def Run(vars, log):
     """
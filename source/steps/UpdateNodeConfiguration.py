@@ -12,6 +12,9 @@ import os
 from Exceptions import *
 import utils
 
+READS = ['SYSIMG_PATH', 'INTERFACE_SETTINGS', 'ROOT_MOUNTED', '<sysimg>']
+WRITES = []
+
 
 # if this file is present in the vservers /etc directory,
 # the resolv.conf and hosts files will automatically be updated
@@ -10,6 +10,9 @@ from Exceptions import *
 import BootAPI
 import notify_messages
 
+READS = ['RUN_LEVEL', 'STATE_CHANGE_NOTIFY', 'STATE_CHANGE_NOTIFY_MESSAGE']
+WRITES = ['RUN_LEVEL', '<plc>']
+
 
 def Run(vars, log):
     """
@@ -38,11 +41,7 @@ def Run(vars, log):
     if vars['RUN_LEVEL'] in ['diag', 'diagnose', 'disabled', 'disable']:
         vars['RUN_LEVEL'] = 'safeboot'
     update_vals['run_level'] = vars['RUN_LEVEL']
-    try:
-        BootAPI.call_api_function(vars, "ReportRunlevel", (update_vals,))
-        log.write("Successfully updated run level for this node at PLC\n")
-    except BootManagerException as e:
-        log.write("Unable to update run level for this node at PLC: {}.\n".format(e))
+    calls = [ ("ReportRunlevel", (update_vals,)) ]
 
     notify = vars.get("STATE_CHANGE_NOTIFY",0)
 
@@ -52,15 +51,27 @@ def Run(vars, log):
         include_techs = 1
         include_support = 0
 
-        sent = 0
-        try:
-            sent = BootAPI.call_api_function(vars, "BootNotifyOwners",
-                                             (message,
-                                              include_pis,
-                                              include_techs,
-                                              include_support))
-        except BootManagerException as e:
-            log.write("Call to BootNotifyOwners failed: {}.\n".format(e))
+        calls.append(("BootNotifyOwners", (message,
+                                           include_pis,
+                                           include_techs,
+                                           include_support)))
+
+    # both calls in one round trip
+    try:
+        results = BootAPI.call_api_batch(vars, calls, raise_faults = False)
+    except BootManagerException as e:
+        results = [ e ] * len(calls)
+
+    if isinstance(results[0], BootManagerException):
+        log.write("Unable to update run level for this node at PLC: {}.\n".format(results[0]))
+    else:
+        log.write("Successfully updated run level for this node at PLC\n")
+
+    if notify:
+        sent = results[1]
+        if isinstance(sent, BootManagerException):
+            log.write("Call to BootNotifyOwners failed: {}.\n".format(sent))
+            sent = 0
 
         if sent == 0:
             log.write("Unable to notify site contacts of state change.\n")
@@ -13,6 +13,10 @@ import utils
 import systeminfo
 import ModelOptions
 
+READS = ['SYSIMG_PATH', 'NODE_ID', 'PLCONF_DIR', 'PARTITIONS', 'ROOT_MOUNTED',
+         'ONE_PARTITION', 'virt']
+WRITES = ['NODE_MODEL_OPTIONS', 'ROOT_MOUNTED', '<sysimg>', '<disks>']
+
 
 def Run(vars, log):
     """
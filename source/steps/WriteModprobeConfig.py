@@ -16,6 +16,9 @@ import ModelOptions
 import notify_messages
 import modprobe
 
+READS = ['SYSIMG_PATH', '<sysimg>']
+WRITES = ['RUN_LEVEL', 'STATE_CHANGE_NOTIFY', 'STATE_CHANGE_NOTIFY_MESSAGE']
+
 def Run( vars, log, filename = "/etc/modprobe.conf"):
     """
     write out the system file /etc/modprobe.conf with the current
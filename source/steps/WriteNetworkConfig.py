@@ -20,6 +20,10 @@ import ModelOptions
 import BootAPI
 import plnet
 
+READS = ['SYSIMG_PATH', 'BOOT_API_SERVER', 'INTERFACES', 'INTERFACE_SETTINGS',
+         '<sysimg>']
+WRITES = ['<plc>', '<bootserver>']
+
 class BootAPIWrap:
     def __init__(self, vars):
         self.vars = vars
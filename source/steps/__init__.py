@@ -9,8 +9,38 @@
 
 """
 This directory contains individual step classes
+
+Each step module lists in READS and WRITES the vars its Run function
+reads and writes, so that StepScheduler can run independent steps side
+by side. Shared state that is not in vars is named between angle
+brackets:
+
+  <plc>            the API server connection and session (BootAPI)
+  <session>        the session file, once the node is authenticated
+  <bootserver>     transfers from the boot servers (BootServerRequest)
+  <sysimg>         the node filesystems mounted on SYSIMG_PATH; written
+                   by the steps that mount, unmount or create them, read
+                   by the ones that write files into them
+  <disks>          block devices, partitions and volume groups
+  <sshd>           the debug ssh daemon
+  <runlevelagent>  the RunlevelAgent.py process
+  <console>        the user, on the console
+
+A step that may touch anything declares '*'.
+
+The step modules, and what they depend on (parted, pypci, ...), are
+only imported when first used: 'from steps import *' binds each name
+to a LazyStep that imports the module on first attribute access, e.g.
+when its Run function is called. READS and WRITES are the exception:
+until then, they are read from the source of the module, so that they
+must remain plain lists of strings.
 """
 
+import os
+import sys
+import ast
+import threading
+
 __all__ = ["ReadNodeConfiguration",
            "AuthenticateWithPLC",
            "GetAndUpdateNodeDetails",
@@ -37,3 +67,89 @@ __all__ = ["ReadNodeConfiguration",
            "WriteNetworkConfig",
            "WriteModprobeConfig",
            "AnsibleHook"]
+
+# called with each step module once it is imported, e.g. Timeline.instrument
+import_hooks = []
+
+hooked = set()
+load_lock = threading.RLock()
+
+
+def load(name):
+    """
+    import the step module name, and pass it and the other step modules
+    it imported to the import hooks
+    """
+    with load_lock:
+        full_name = "{}.{}".format(__name__, name)
+        __import__(full_name)
+        module = sys.modules[full_name]
+        for step in __all__:
+            loaded = sys.modules.get("{}.{}".format(__name__, step))
+            if loaded is not None and step not in hooked:
+                hooked.add(step)
+                for hook in import_hooks:
+                    hook(loaded)
+        return module
+
+
+def declarations(name):
+    """
+    the READS and WRITES lists assigned in the source of the step module
+    name, as a dict, without importing it
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "{}.py".format(name))
+    tree = ast.parse(open(path).read(), path)
+    found = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign):
+            for target in node.targets:
+                if isinstance(target, ast.Name) and target.id in ('READS', 'WRITES'):
+                    found[target.id] = ast.literal_eval(node.value)
+    return found
+
+
+class LazyStep(object):
+    """
+    stands for a step module until it is first used
+    """
+
+    def __init__(self, name):
+        self.module = None
+        self.name = name
+        self.__name__ = "{}.{}".format(__name__, name)
+        self.declared = None
+
+    def __getattr__(self, attr):
+        if self.module is None:
+            self.module = load(self.name)
+        return getattr(self.module, attr)
+
+    def declaration(self, attr):
+        if self.module is not None:
+            return getattr(self.module, attr)
+        if self.declared is None:
+            try:
+                self.declared = declarations(self.name)
+            except (IOError, SyntaxError, ValueError):
+                # no source to read, e.g. only the .pyc is there
+                self.module = load(self.name)
+                return getattr(self.module, attr)
+        try:
+            return self.declared[attr]
+        except KeyError:
+            raise AttributeError(attr)
+
+    # StepScheduler.Step reads these when the step is scheduled, which
+    # does not need the module yet
+    READS = property(lambda self: self.declaration('READS'))
+    WRITES = property(lambda self: self.declaration('WRITES'))
+
+    def __repr__(self):
+        return "<lazy step {}>".format(self.__name__)
+
+
+for name in __all__:
+    globals()[name] = LazyStep(name)
+del name
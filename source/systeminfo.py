@@ -27,7 +27,6 @@ import popen2
 import re
 import errno
 import ModelOptions
-from pypci import *
 from Exceptions import *
 
 """
@@ -50,7 +49,8 @@ BLOCKS_PER_GB = pow(10, 9) / 1024.0;
 MODULE_CLASS_NETWORK = "network"
 MODULE_CLASS_SCSI = "scsi"
 
-#PCI_* is now defined in the pypci modules
+#PCI_* is now defined in the pypci modules, imported by
+#get_system_modules only, the one function that needs them
 #PCI_BASE_CLASS_NETWORK = 0x02L
 #PCI_BASE_CLASS_STORAGE = 0x01L
 
@@ -270,7 +270,8 @@ def get_system_modules(vars = {}, log = sys.stderr):
         print("WARNING: Unable to read {}".format(modules_pcimap_path))
         return
 
-    pcimap = pypcimap.PCIMap(modules_pcimap_path)
+    import pypci
+    pcimap = pypci.pypcimap.PCIMap(modules_pcimap_path)
 
     # this is the actual data structure we return
     system_mods = {}
@@ -280,7 +281,7 @@ def get_system_modules(vars = {}, log = sys.stderr):
     scsi_mods = []
 
     # XXX: this is really similar to what BootCD/conf_files/pl_hwinit does. merge?
-    pcidevs = get_devices()
+    pcidevs = pypci.get_devices()
 
     devlist =pcidevs.keys()
     devlist.sort()
@@ -288,20 +289,20 @@ def get_system_modules(vars = {}, log = sys.stderr):
         dev = pcidevs[slot]
         base = (dev[4] & 0xff0000) >> 16
         modules = pcimap.get(dev)
-        if base not in (PCI_BASE_CLASS_STORAGE,
-                        PCI_BASE_CLASS_NETWORK):
+        if base not in (pypci.PCI_BASE_CLASS_STORAGE,
+                        pypci.PCI_BASE_CLASS_NETWORK):
             # special exception for forcedeth NICs whose base id
             # claims to be a Bridge, even though it is clearly a
             # network device
             if "forcedeth" in modules: 
-                base = PCI_BASE_CLASS_NETWORK
+                base = pypci.PCI_BASE_CLASS_NETWORK
             else:
                 continue
 
         if len(modules) > 0:
-            if base == PCI_BASE_CLASS_NETWORK:
+            if base == pypci.PCI_BASE_CLASS_NETWORK:
                 network_mods += modules
-            elif base == PCI_BASE_CLASS_STORAGE:
+            elif base == pypci.PCI_BASE_CLASS_STORAGE:
                 scsi_mods += modules
 
     system_mods[MODULE_CLASS_SCSI] = scsi_mods
@@ -10,6 +10,9 @@
 from __future__ import print_function
 
 import os, sys, shutil
+import errno
+import time
+import hashlib
 import subprocess
 import shlex
 import socket
@@ -18,6 +21,7 @@ import string
 import exceptions
 
 from Exceptions import *
+import Timeline
 
 ####################
 # the simplest way to debug is to let the node take off, 
@@ -128,6 +132,28 @@ def removedir(path):
     return 1
 
 
+class TimedPopen(subprocess.Popen):
+    """
+    Popen that keeps the resource usage of the child, as returned by
+    os.wait4, when it gets reaped
+    """
+    rusage = None
+
+    def wait(self):
+        while self.returncode is None:
+            try:
+                (pid, status, self.rusage) = os.wait4(self.pid, 0)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno != errno.ECHILD:
+                    raise
+                (pid, status) = (self.pid, 0)
+            if pid == self.pid:
+                self._handle_exitstatus(status)
+        return self.returncode
+
+
 def sysexec(cmd, log=None, fsck=False, shell=False):
     """
     execute a system command, output the results to the logger
@@ -137,19 +163,20 @@ def sysexec(cmd, log=None, fsck=False, shell=False):
     0 if failed. A BootManagerException is raised if the command
     was unable to execute or was interrupted by the user with Ctrl+C
     """
+    start = time.time()
     try:
         # Thierry - Jan. 6 2011
         # would probably make sense to look for | here as well
         # however this is fragile and hard to test thoroughly
         # let the caller set 'shell' when that is desirable
         if shell or cmd.__contains__(">"):
-            prog = subprocess.Popen(cmd, shell=True)
+            prog = TimedPopen(cmd, shell=True)
             if log is not None:
                 log.write("sysexec (shell mode) >>> {}".format(cmd))
             if VERBOSE_MODE:
                 print("sysexec (shell mode) >>> {}".format(cmd))
         else:
-            prog = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            prog = TimedPopen(shlex.split(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
             if log is not None:
                 log.write("sysexec >>> {}\n".format(cmd))
             if VERBOSE_MODE:
@@ -171,6 +198,7 @@ def sysexec(cmd, log=None, fsck=False, shell=False):
             log.write("==========stderr\n" + stderrdata)
 
     returncode = prog.wait()
+    Timeline.command(cmd, start, returncode, prog.rusage)
 
     if fsck:
        # The exit code returned by fsck is the sum of the following conditions:
@@ -283,19 +311,36 @@ def get_mac_from_interface(ifname):
         
     return ret
 
-def check_file_hash(filename, hash_filename):
-    """Check the file's integrity with a given hash."""
-    return sha1_file(filename) == open(hash_filename).read().split()[0].strip()
+def read_digest(hash_filename):
+    """Return the digest in a given hash file (sha1sum format)."""
+    try:
+        return open(hash_filename).read().split()[0].strip()
+    except (IOError, IndexError):
+        raise BootManagerException("Cannot read hash from {}".format(hash_filename))
+
+class DigestSink:
+    """
+    Accumulates the digest of some data as it gets written, typically
+    by BootServerRequest.DownloadFile; reset() is called when the
+    data is written again from the start.
+    """
+    def __init__(self, algorithm='sha1'):
+        self.algorithm = algorithm
+        self.reset()
+
+    def reset(self):
+        self.digest = hashlib.new(self.algorithm)
+
+    def update(self, data):
+        self.digest.update(data)
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
 
 def sha1_file(filename):
     """Calculate sha1 hash of file."""
     try:
-        try:
-            import hashlib
-            m = hashlib.sha1()
-        except:
-            import sha
-            m = sha.new()
+        m = hashlib.sha1()
         f = file(filename, 'rb')
         while True:
             # 256 KB seems ideal for speed/memory tradeoff
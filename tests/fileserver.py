@@ -0,0 +1,166 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2004-2007 The Trustees of Princeton University
+# All rights reserved.
+
+"""
+a local http server that stands for a boot server in the tests that
+download files through BootServerRequest, serving files from memory,
+with byte ranges and conditional requests like a real web server
+
+The ways it misbehaves on purpose are set in its attributes:
+
+  ranges       False to ignore Range, answering 200 with the whole file
+  advertise    whether to send Accept-Ranges; None to send it only when
+               ranges is True
+  errors       {path: http code} to answer with an error page
+  breaks       list of byte counts; each GET takes the first one, if any,
+               and closes the connection after sending that many bytes
+  delay        seconds to wait before each chunk of a GET, to keep
+               transfers in progress for a while
+"""
+
+import time
+import threading
+import BaseHTTPServer
+import SocketServer
+from email.utils import formatdate, parsedate_tz, mktime_tz
+
+CHUNK = 16384
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.answer(False)
+
+    def do_GET(self):
+        self.answer(True)
+
+    def answer(self, body):
+        server = self.server.owner
+        # BootServerRequest asks for http://server//boot/...
+        path = "/" + self.path.lstrip("/")
+        with server.lock:
+            server.requests.append((self.command, path,
+                                    self.headers.get('Range')))
+            breaks = server.breaks.pop(0) if body and server.breaks else None
+
+        if path in server.errors:
+            page = "<html><body>error {}</body></html>\n".format(server.errors[path])
+            self.send_response(server.errors[path])
+            self.send_header("Content-Type", "text/html")
+            self.send_header("Content-Length", str(len(page)))
+            self.end_headers()
+            if body:
+                self.wfile.write(page)
+            return
+
+        if path not in server.files:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        (data, mtime) = server.files[path]
+        etag = '"{:x}-{}"'.format(hash(data) & 0xffffffff, len(data))
+        since = self.headers.get('If-Modified-Since')
+        if self.headers.get('If-None-Match') == etag or \
+           (since and parsedate_tz(since) and mktime_tz(parsedate_tz(since)) >= int(mtime)):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        (start, end) = (0, len(data) - 1)
+        status = 200
+        requested = self.headers.get('Range')
+        if requested and server.ranges and requested.startswith("bytes="):
+            (first, last) = requested[len("bytes="):].split("-")
+            start = int(first)
+            if last:
+                end = min(int(last), len(data) - 1)
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            status = 206
+
+        self.send_response(status)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Last-Modified", formatdate(mtime, usegmt=True))
+        self.send_header("ETag", etag)
+        if server.ranges if server.advertise is None else server.advertise:
+            self.send_header("Accept-Ranges", "bytes")
+        if status == 206:
+            self.send_header("Content-Range",
+                             "bytes {}-{}/{}".format(start, end, len(data)))
+        self.end_headers()
+        if not body:
+            return
+
+        sent = 0
+        for offset in xrange(start, end + 1, CHUNK):
+            chunk = data[offset:min(offset + CHUNK, end + 1)]
+            if breaks is not None and sent + len(chunk) > breaks:
+                self.wfile.write(chunk[:breaks - sent])
+                self.wfile.flush()
+                self.close_connection = 1
+                return
+            if server.delay:
+                time.sleep(server.delay)
+            self.wfile.write(chunk)
+            sent += len(chunk)
+
+
+class HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        # clients hang up half-way on purpose
+        pass
+
+
+class FileServer:
+
+    def __init__(self, files = None):
+        # path -> (data, mtime)
+        self.files = {}
+        for (path, data) in (files or {}).items():
+            self.add(path, data)
+        self.ranges = True
+        self.advertise = None
+        self.errors = {}
+        self.breaks = []
+        self.delay = 0
+        self.requests = []
+        self.lock = threading.Lock()
+        self.httpd = HTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.owner = self
+        self.address = "127.0.0.1:{}".format(self.httpd.server_address[1])
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, path, data, mtime = None):
+        self.files[path] = (data, int(time.time() - 3600 if mtime is None else mtime))
+
+    def gets(self, path):
+        """
+        the Range headers of the GET requests made for path so far
+        """
+        with self.lock:
+            return [ requested for (command, request_path, requested) in self.requests
+                     if command == 'GET' and request_path == path ]
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,149 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2004-2007 The Trustees of Princeton University
+# All rights reserved.
+
+"""
+runs the steps that talk to PLC at the start of a boot, in the order
+BootManager runs them, against a fake API server, and checks that the
+data prefetched once authenticated is not fetched again
+
+run from the top of the tree with
+  python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import threading
+import unittest
+import xmlrpclib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "source"))
+
+import BootAPI
+from StepScheduler import StepScheduler, Step
+from steps import AuthenticateWithPLC, UpdateLastBootOnce, GetAndUpdateNodeDetails
+
+NODE_ID = 1
+INTERFACE_ID = 10
+INTERFACE_TAG_ID = 100
+
+UPDATE_LAST_BOOT_ONCE = "/tmp/UPDATE_LAST_BOOT_ONCE"
+
+
+class FakePLC:
+    """
+    answers the api calls made while booting, and counts them, whether
+    made directly or through system.multicall
+    """
+
+    ANSWERS = {
+        'BootCheckAuthentication': 1,
+        'BootUpdateNode': 1,
+        'GetNodes': [{ 'boot_state': 'boot', 'nodegroup_ids': [],
+                       'interface_ids': [INTERFACE_ID], 'model': 'Custom',
+                       'site_id': 1 }],
+        'GetInterfaces': [{ 'interface_id': INTERFACE_ID, 'is_primary': 1,
+                            'interface_tag_ids': [INTERFACE_TAG_ID] }],
+        'GetInterfaceTags': [],
+        'GetNodeTags': [],
+        'GetNodeFlavour': { 'virt': 'lxc', 'nodefamily': 'planetlab-f22-x86_64',
+                            'extensions': [], 'plain': False },
+        }
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.system = self
+
+    def answer(self, function):
+        with self.lock:
+            self.calls[function] = self.calls.get(function, 0) + 1
+        return self.ANSWERS[function]
+
+    def multicall(self, calls):
+        return [ [self.answer(call['methodName'])] for call in calls ]
+
+    def __getattr__(self, function):
+        if function not in self.ANSWERS:
+            raise AttributeError(function)
+        return lambda *params: self.answer(function)
+
+
+class Log:
+
+    OutputFile = None
+
+    def LogEntry(self, str, inc_newline = 1, display_screen = 1, when = None):
+        pass
+
+    def write(self, str):
+        pass
+
+    def flush(self):
+        pass
+
+
+class PrefetchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.plc = FakePLC()
+        self.connect = BootAPI.connect
+        BootAPI.connect = lambda server_url: (self.plc, None)
+        BootAPI.api_cache.clear()
+        BootAPI.stash.clear()
+        BootAPI.multicall_supported = True
+        if os.path.exists(UPDATE_LAST_BOOT_ONCE):
+            os.unlink(UPDATE_LAST_BOOT_ONCE)
+        self.vars = { 'API_SERVER_INST': self.plc,
+                      'BOOT_API_SERVER': 'https://plc.example.org/PLCAPI/',
+                      'NODE_ID': NODE_ID,
+                      'NODE_KEY': 'key',
+                      'NODE_SESSION': 'session',
+                      'DISCONNECTED_OPERATION': '',
+                      'NUM_AUTH_FAILURES_BEFORE_DEBUG': '2',
+                      'API_PREFETCH': '1',
+                      'SKIP_HARDWARE_REQUIREMENT_CHECK': 0,
+                      'INTERFACE_SETTINGS': { 'ip': '10.0.0.1' },
+                      'WAS_NODE_ID_IN_CONF': 1,
+                      'WAS_NODE_KEY_IN_CONF': 1,
+                      }
+
+    def tearDown(self):
+        BootAPI.connect = self.connect
+        if os.path.exists(UPDATE_LAST_BOOT_ONCE):
+            os.unlink(UPDATE_LAST_BOOT_ONCE)
+
+    def test_each_call_made_once(self):
+        # as in BootManager.Run
+        StepScheduler(self.vars, Log()).run([Step(AuthenticateWithPLC),
+                                             Step(UpdateLastBootOnce),
+                                             Step(GetAndUpdateNodeDetails)])
+        # the calls of the later steps that were prefetched:
+        # InstallPartitionDisks
+        BootAPI.call_api_function(self.vars, "GetNodeTags",
+                                  ({'node_id': NODE_ID},))
+        # plnet, from WriteNetworkConfig
+        BootAPI.call_api_function(self.vars, "GetInterfaceTags",
+                                  ({'interface_tag_id': [INTERFACE_TAG_ID]},))
+
+        self.assertEqual(self.plc.calls,
+                         dict((function, 1) for function in FakePLC.ANSWERS))
+        self.assertEqual(self.vars['INTERFACES'], FakePLC.ANSWERS['GetInterfaces'])
+
+    def test_update_of_interfaces_drops_them(self):
+        BootAPI.cache_store("GetInterfaces", ({'node_id': NODE_ID},),
+                            FakePLC.ANSWERS['GetInterfaces'])
+        BootAPI.call_api_function(self.vars, "BootUpdateNode",
+                                  ({'boot_state': 'boot'},))
+        self.assertEqual(BootAPI.cache_lookup("GetInterfaces",
+                                              ({'node_id': NODE_ID},))[0], True)
+        BootAPI.call_api_function(self.vars, "BootUpdateNode",
+                                  ({'primary_network': {}},))
+        self.assertEqual(BootAPI.cache_lookup("GetInterfaces",
+                                              ({'node_id': NODE_ID},))[0], False)
+
+
+if __name__ == '__main__':
+    unittest.main()
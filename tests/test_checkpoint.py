@@ -0,0 +1,174 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2004-2007 The Trustees of Princeton University
+# All rights reserved.
+
+"""
+the install checkpoint journal, on a root filesystem that stands in a
+temp dir, and what InstallBootstrapFS removes before extracting again
+
+run from the top of the tree with
+  python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "source"))
+
+import InstallCheckpoint
+from steps import InstallBootstrapFS
+
+SHA1SUM = "bootstrapfs-lxc-f22-x86_64.tar.zst.sha1sum"
+
+
+class Log:
+
+    def __init__(self):
+        self.text = ""
+
+    def write(self, text):
+        self.text += text
+
+
+class CheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.vars = { 'ROOT_MOUNTED': 1,
+                      'SYSIMG_PATH': self.dir,
+                      'nodefamily': 'lxc-f22-x86_64',
+                      'USABLE_BLOCK_DEVICES': ['/dev/sda', '/dev/sdb'],
+                      'virt': 'lxc',
+                      'lxc_ROOT_SIZE': '10G',
+                      'ONE_PARTITION': '0',
+                      'extensions': [],
+                      'plain': False,
+                      }
+        # what the boot server publishes
+        self.published = { SHA1SUM: "1234" }
+        self.record_steps()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def checkpoint(self):
+        checkpoint = InstallCheckpoint.InstallCheckpoint(self.vars, Log())
+        checkpoint.published_tarballs = \
+            lambda names: dict((name, self.published.get(name)) for name in names)
+        return checkpoint
+
+    def journal(self):
+        return os.path.join(self.dir, InstallCheckpoint.JOURNAL_NAME)
+
+    def record_steps(self):
+        checkpoint = self.checkpoint()
+        checkpoint.record('InstallPartitionDisks')
+        # as left by InstallBootstrapFS
+        with open(os.path.join(self.dir, SHA1SUM), "w") as sha1sum:
+            sha1sum.write("1234  bootstrapfs-lxc-f22-x86_64.tar.zst\n")
+        checkpoint.record('InstallBootstrapFS')
+
+    def loaded(self):
+        checkpoint = self.checkpoint()
+        checkpoint.load()
+        return sorted(checkpoint.completed_steps)
+
+    def test_resume(self):
+        self.assertEqual(self.loaded(), ['InstallBootstrapFS', 'InstallPartitionDisks'])
+
+    def test_disks_changed(self):
+        self.vars['USABLE_BLOCK_DEVICES'] = ['/dev/sda']
+        self.assertEqual(self.loaded(), [])
+        self.assertFalse(os.path.exists(self.journal()))
+
+    def test_root_size_changed(self):
+        self.vars['lxc_ROOT_SIZE'] = '20G'
+        self.assertEqual(self.loaded(), [])
+        self.assertFalse(os.path.exists(self.journal()))
+
+    def test_nodefamily_changed(self):
+        self.vars['nodefamily'] = 'lxc-f24-x86_64'
+        self.assertEqual(self.loaded(), [])
+        self.assertFalse(os.path.exists(self.journal()))
+
+    def test_step_vars_changed(self):
+        self.vars['extensions'] = ['extra']
+        self.assertEqual(self.loaded(), ['InstallPartitionDisks'])
+        self.assertTrue(os.path.exists(self.journal()))
+
+    def test_tarballs_changed(self):
+        # on the boot server
+        self.published[SHA1SUM] = "5678"
+        self.assertEqual(self.loaded(), ['InstallPartitionDisks'])
+        self.published[SHA1SUM] = None
+        self.assertEqual(self.loaded(), ['InstallPartitionDisks'])
+        # on the disk
+        self.published[SHA1SUM] = "1234"
+        os.remove(os.path.join(self.dir, SHA1SUM))
+        self.assertEqual(self.loaded(), ['InstallPartitionDisks'])
+
+    def test_unreadable_journal(self):
+        with open(self.journal(), "w") as journal:
+            journal.write("(dp0\n")
+        self.assertEqual(self.loaded(), [])
+        self.assertFalse(os.path.exists(self.journal()))
+
+    def test_invalidate(self):
+        checkpoint = self.checkpoint()
+        checkpoint.load()
+        checkpoint.invalidate()
+        self.assertFalse(checkpoint.completed('InstallPartitionDisks'))
+        self.assertFalse(os.path.exists(self.journal()))
+        self.assertEqual(self.loaded(), [])
+
+
+class WipeSysimgTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def make(self, *paths):
+        for path in paths:
+            path = os.path.join(self.dir, path)
+            if path.endswith("/"):
+                os.makedirs(path)
+            else:
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                open(path, "w").close()
+
+    def tree(self):
+        found = []
+        for (dirpath, dirnames, filenames) in os.walk(self.dir):
+            for name in dirnames + filenames:
+                found.append(os.path.relpath(os.path.join(dirpath, name), self.dir))
+        return sorted(found)
+
+    def test_wipe(self):
+        self.make(InstallCheckpoint.JOURNAL_NAME, "lost+found/", "bm-install.txt",
+                  "usr/bin/tar", "etc/", SHA1SUM,
+                  "vservers/.bootstrapfs-cache/1234",
+                  "vservers/.bootstrapfs-cache/5678",
+                  "vservers/lost+found/", "vservers/.pkgs/lxc")
+        os.symlink("usr/bin", os.path.join(self.dir, "bin"))
+        InstallBootstrapFS.WipeSysimg(self.dir,
+                                      [ os.path.join(self.dir, InstallCheckpoint.JOURNAL_NAME),
+                                        self.dir + "//vservers/.bootstrapfs-cache" ])
+        self.assertEqual(self.tree(),
+                         [ InstallCheckpoint.JOURNAL_NAME, "lost+found", "vservers",
+                           "vservers/.bootstrapfs-cache",
+                           "vservers/.bootstrapfs-cache/1234",
+                           "vservers/.bootstrapfs-cache/5678",
+                           "vservers/lost+found" ])
+
+
+if __name__ == '__main__':
+    unittest.main()
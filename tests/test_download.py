@@ -0,0 +1,225 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2004-2007 The Trustees of Princeton University
+# All rights reserved.
+
+"""
+downloads through BootServerRequest, from a local http server (see
+fileserver.py) that stands for the boot server
+
+run from the top of the tree with
+  python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "source"))
+
+import BootServerRequest
+import utils
+from fileserver import FileServer
+
+# boot servers as known to every BootServerRequest
+SHARED_STATE = ('BOOTSERVER_CERTS', 'MONITORSERVER_CERTS', 'PREFERRED_SERVERS')
+
+
+def make_data(size):
+    return "".join(chr((i * 7 + i // 251) % 256) for i in xrange(size))
+
+
+class DownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.server = FileServer()
+        for name in SHARED_STATE:
+            getattr(BootServerRequest.BootServerRequest, name).clear()
+        BootServerRequest.BootServerRequest.RANKING = None
+        BootServerRequest.BootServerRequest.PROXY_CHECKED = 0
+        self.vars = { 'BOOTCD_VERSION_FILE': os.path.join(self.dir, "no-bootcd"),
+                      'DEFAULT_BOOT_SERVER': self.server.address,
+                      'PROXY_FILE': os.path.join(self.dir, "no-proxy"),
+                      }
+
+    def tearDown(self):
+        # so that the connections kept alive get closed
+        pool = BootServerRequest.BootServerRequest.CURL_POOL.__dict__.pop('handles', {})
+        for curl in pool.values():
+            curl.close()
+        self.server.stop()
+        shutil.rmtree(self.dir)
+
+    def request(self):
+        request = BootServerRequest.BootServerRequest(self.vars)
+        # no need to wait before resuming here
+        request.RESUME_INITIAL_DELAY = 0
+        return request
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def contents(self, name):
+        with open(self.path(name)) as dest:
+            return dest.read()
+
+
+class ConditionalTest(DownloadTest):
+
+    def setUp(self):
+        DownloadTest.setUp(self)
+        with open(self.path("x.sha1sum"), "w") as copy:
+            copy.write("good  x\n")
+        self.mtime = 1000000000
+        os.utime(self.path("x.sha1sum"), (self.mtime, self.mtime))
+
+    def download(self, validators):
+        return self.request().DownloadFile("/boot/x.sha1sum", None, None, 0, 0,
+                                           self.path("x.sha1sum"),
+                                           Validators = validators)
+
+    def test_not_modified(self):
+        self.server.add("/boot/x.sha1sum", "new  x\n", self.mtime - 10)
+        validators = { 'mtime': self.mtime }
+        self.assertEqual(self.download(validators), 1)
+        self.assertEqual(validators['modified'], False)
+        self.assertEqual(self.contents("x.sha1sum"), "good  x\n")
+
+    def test_modified(self):
+        self.server.add("/boot/x.sha1sum", "new  x\n", self.mtime + 10)
+        validators = { 'mtime': self.mtime }
+        self.assertEqual(self.download(validators), 1)
+        self.assertEqual(validators['modified'], True)
+        self.assertEqual(validators['mtime'], self.mtime + 10)
+        self.assertEqual(self.contents("x.sha1sum"), "new  x\n")
+        self.assertEqual(os.path.getmtime(self.path("x.sha1sum")), self.mtime + 10)
+
+    def test_error_keeps_copy(self):
+        for code in (404, 500):
+            self.server.errors["/boot/x.sha1sum"] = code
+            validators = { 'mtime': self.mtime }
+            self.assertEqual(self.download(validators), 0)
+            self.assertEqual(validators, { 'mtime': self.mtime })
+            self.assertEqual(self.contents("x.sha1sum"), "good  x\n")
+            self.assertEqual(os.path.getmtime(self.path("x.sha1sum")), self.mtime)
+            self.assertEqual(os.listdir(self.dir), ["x.sha1sum"])
+
+
+class ResumeTest(DownloadTest):
+
+    def setUp(self):
+        DownloadTest.setUp(self)
+        self.data = make_data(200000)
+        self.server.add("/boot/x.tar", self.data)
+
+    def download(self, resumes):
+        self.digest = utils.DigestSink()
+        return self.request().DownloadFile("/boot/x.tar", None, None, 0, 0,
+                                           self.path("x.tar"),
+                                           MaxResumes = resumes,
+                                           DigestSink = self.digest)
+
+    def check(self):
+        self.assertEqual(self.contents("x.tar"), self.data)
+        self.assertEqual(self.digest.hexdigest(), hashlib.sha1(self.data).hexdigest())
+
+    def test_resume(self):
+        self.server.breaks = [ 50000, 70000 ]
+        self.assertEqual(self.download(3), 1)
+        self.check()
+        self.assertEqual(self.server.gets("/boot/x.tar"),
+                         [ None, "bytes=50000-", "bytes=120000-" ])
+
+    def test_no_resume(self):
+        self.server.breaks = [ 50000 ]
+        self.assertEqual(self.download(0), 0)
+        self.assertEqual(self.server.gets("/boot/x.tar"), [ None ])
+
+    def test_too_many_breaks(self):
+        self.server.breaks = [ 1000, 1000, 1000 ]
+        self.assertEqual(self.download(2), 0)
+        self.assertEqual(len(self.server.gets("/boot/x.tar")), 3)
+
+    def test_range_ignored(self):
+        # the resumed transfer starts over from scratch
+        self.server.ranges = False
+        self.server.breaks = [ 50000 ]
+        self.assertEqual(self.download(3), 1)
+        self.check()
+        self.assertEqual(len(self.server.gets("/boot/x.tar")), 3)
+
+
+class SegmentedTest(DownloadTest):
+
+    def setUp(self):
+        DownloadTest.setUp(self)
+        self.data = make_data(100003)
+        self.server.add("/boot/x.tar", self.data)
+
+    def download(self, min_size = 0):
+        result = self.request().DownloadFileSegmented("/boot/x.tar", 0, 0,
+                                                      self.path("x.tar"), 4,
+                                                      MinSize = min_size)
+        self.assertEqual(result, 1)
+        self.assertEqual(self.contents("x.tar"), self.data)
+        return self.server.gets("/boot/x.tar")
+
+    def test_segments(self):
+        gets = self.download()
+        self.assertEqual(sorted(gets, key = lambda requested: int(requested[6:].split("-")[0])),
+                         [ "bytes=0-25000", "bytes=25001-50001",
+                           "bytes=50002-75002", "bytes=75003-100002" ])
+
+    def test_small_file(self):
+        self.assertEqual(self.download(min_size = 200000), [ None ])
+
+    def test_ranges_not_advertised(self):
+        self.server.ranges = False
+        self.assertEqual(self.download(), [ None ])
+
+    def test_ranges_ignored(self):
+        # each segment would get the whole file
+        self.server.ranges = False
+        self.server.advertise = True
+        gets = self.download()
+        # then a single stream
+        self.assertEqual(gets.count(None), 1)
+        self.assertTrue(len(gets) > 1)
+
+    def test_broken_segment(self):
+        self.server.breaks = [ 1000 ]
+        gets = self.download()
+        self.assertEqual(gets.count(None), 1)
+
+
+class SegmentedDigestTest(DownloadTest):
+
+    def download(self, data, segments):
+        self.server.add("/boot/x.tar", data)
+        digest = utils.DigestSink()
+        # some data left over from an earlier attempt
+        digest.update("stale")
+        result = self.request().DownloadFileSegmented("/boot/x.tar", 0, 0,
+                                                      self.path("x.tar"), segments,
+                                                      DigestSink = digest)
+        self.assertEqual(result, 1)
+        self.assertEqual(self.contents("x.tar"), data)
+        self.assertEqual(digest.hexdigest(), hashlib.sha1(data).hexdigest())
+
+    def test_digest_in_file_order(self):
+        # the segments all get ahead of the digest before it reaches them
+        self.server.delay = 0.005
+        self.download(make_data(300000), 4)
+        self.assertEqual(len(self.server.gets("/boot/x.tar")), 4)
+
+    def test_digest_uneven_segments(self):
+        self.download(make_data(100003), 7)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2004-2007 The Trustees of Princeton University
+# All rights reserved.
+
+"""
+checks that the log writer thread gets every entry into bm.log, in
+order, whatever goes through log.OutputFile, and that errors make it
+to the screen past LOG_SCREEN_RATE
+
+run from the top of the tree with
+  python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import traceback
+import unittest
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "source"))
+
+import BootManager
+from StepScheduler import BufferedLog
+
+
+class LogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "bm.log")
+        self.vars_file = BootManager.VARS_FILE
+        BootManager.VARS_FILE = os.path.join(self.dir, "configuration")
+        self.configure({})
+        self.stdout = sys.stdout
+        sys.stdout = self.screen = StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        BootManager.VARS_FILE = self.vars_file
+        shutil.rmtree(self.dir)
+
+    def configure(self, settings):
+        with open(BootManager.VARS_FILE, "w") as vars_file:
+            for (name, value) in settings.items():
+                vars_file.write("{}={}\n".format(name, value))
+
+    def contents(self):
+        with open(self.path) as log_file:
+            return log_file.read()
+
+    def test_output_file_keeps_writer_alive(self):
+        log = BootManager.log(self.path)
+        log.LogEntry("before")
+        try:
+            raise KeyError("failure")
+        except KeyError:
+            traceback.print_exc(file=log.OutputFile)
+        log.LogEntry("after")
+        log.flush()
+        self.assertTrue(log.writer.is_alive())
+        contents = self.contents()
+        self.assertTrue(contents.index("before") < contents.index("KeyError")
+                        < contents.index("after"))
+        # what goes to OutputFile is not shown on the screen
+        self.assertFalse("KeyError" in self.screen.getvalue())
+        log.close()
+
+    def test_buffered_output_file(self):
+        log = BootManager.log(self.path)
+        buffered = BufferedLog(log)
+        buffered.OutputFile.write("held back\n")
+        buffered.go_live()
+        buffered.OutputFile.write("live\n")
+        log.LogEntry("last")
+        log.flush()
+        contents = self.contents()
+        self.assertTrue(contents.index("held back") < contents.index("live")
+                        < contents.index("last"))
+        log.close()
+
+    def test_settings(self):
+        self.configure({ 'LOG_FLUSH_INTERVAL': '0', 'LOG_SCREEN_RATE': '10',
+                         'LOG_FLUSH_SIZE': '100' })
+        log = BootManager.log(self.path)
+        # read before the writer thread started
+        self.assertEqual(log.flush_interval, BootManager.log.min_flush_interval)
+        self.assertEqual(log.screen_rate, 10)
+        self.assertEqual(log.flush_size, 100)
+        log.close()
+
+    def test_errors_always_shown(self):
+        self.configure({ 'LOG_SCREEN_RATE': '10' })
+        log = BootManager.log(self.path)
+        log.LogEntry("dropped, too long for the screen rate")
+        log.LogError("shown anyway\n")
+        log.flush()
+        screen = self.screen.getvalue()
+        self.assertFalse("dropped" in screen)
+        self.assertTrue("shown anyway" in screen)
+        self.assertTrue("bytes not shown" in screen)
+        # the file has it all
+        self.assertTrue("dropped, too long" in self.contents())
+        log.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
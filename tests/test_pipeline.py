@@ -0,0 +1,198 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2004-2007 The Trustees of Princeton University
+# All rights reserved.
+
+"""
+InstallBootstrapFS in pipeline mode: a tarball streamed into tar is
+extracted in a staging area, that gets committed into the system image
+only when its sha1 matches, and rolled back otherwise
+
+run from the top of the tree with
+  python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import shutil
+import hashlib
+import tarfile
+import tempfile
+import unittest
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "source"))
+
+from Exceptions import BootManagerException
+import BootstrapFSCache
+from steps import InstallBootstrapFS
+
+TARBALL = "/boot/bootstrapfs-lxc.tar"
+HASH_FILE = TARBALL + ".sha1sum"
+
+
+class Log:
+
+    def __init__(self):
+        self.text = ""
+
+    def write(self, text):
+        self.text += text
+
+
+class BootServer:
+    """
+    stands for BootServerRequest, serving files from memory
+    """
+
+    def __init__(self, files):
+        self.files = files
+
+    def DownloadFile(self, PartialPath, GetVars, PostVars,
+                     DoSSL, DoCertCheck, DestFilePath,
+                     ConnectTimeout = 30, MaxTransferTime = 14400,
+                     MaxResumes = 0, ResumeTimeBudget = None,
+                     DigestSink = None, DestStream = None, Validators = None):
+        if PartialPath not in self.files:
+            return 0
+        data = self.files[PartialPath]
+        if DestStream is None:
+            with open(DestFilePath, "wb") as dest:
+                dest.write(data)
+        else:
+            for offset in range(0, len(data), 4096):
+                DestStream.write(data[offset:offset + 4096])
+        if DigestSink is not None:
+            DigestSink.update(data)
+        if Validators is not None:
+            Validators['modified'] = True
+        return 1
+
+
+def make_tarball(files):
+    buffer = StringIO()
+    tar = tarfile.open(fileobj=buffer, mode="w")
+    for (name, data) in sorted(files.items()):
+        info = tarfile.TarInfo(name)
+        if data is None:
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+            tar.addfile(info)
+        else:
+            info.size = len(data)
+            info.mode = 0o644
+            tar.addfile(info, StringIO(data))
+    tar.close()
+    return buffer.getvalue()
+
+
+class StreamTarballTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.sysimg = os.path.join(self.dir, "sysimg")
+        # what a previous tarball left
+        self.write("etc/hostname", "old\n")
+        self.write("usr/bin/tool", "old tool\n")
+        self.tarball = make_tarball({ "etc": None,
+                                      "etc/fstab": "fstab\n",
+                                      "usr": None,
+                                      "usr/bin": None,
+                                      "usr/bin/tool": "new tool\n" })
+        self.sha1 = hashlib.sha1(self.tarball).hexdigest()
+        self.server = BootServer({ TARBALL: self.tarball,
+                                   HASH_FILE: "{}  bootstrapfs-lxc.tar\n".format(self.sha1) })
+        self.log = Log()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, data):
+        path = os.path.join(self.sysimg, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "w") as output:
+            output.write(data)
+
+    def read(self, name):
+        with open(os.path.join(self.sysimg, name)) as input:
+            return input.read()
+
+    def tree(self):
+        found = []
+        for (dirpath, dirnames, filenames) in os.walk(self.sysimg):
+            for name in dirnames + filenames:
+                found.append(os.path.relpath(os.path.join(dirpath, name), self.sysimg))
+        return sorted(found)
+
+    def stream(self, cache = None, fill_cache = False):
+        return InstallBootstrapFS.StreamTarball(
+            self.server, TARBALL, HASH_FILE,
+            os.path.join(self.sysimg, "bootstrapfs-lxc.tar.sha1sum"),
+            self.sysimg, "", cache, fill_cache, self.log)
+
+    def check_rolled_back(self):
+        self.assertEqual(self.tree(), [ "bootstrapfs-lxc.tar.sha1sum",
+                                        "etc", "etc/hostname",
+                                        "usr", "usr/bin", "usr/bin/tool" ])
+        self.assertEqual(self.read("usr/bin/tool"), "old tool\n")
+
+    def test_commit(self):
+        self.assertEqual(self.stream(), 1)
+        # merged into what was there, the staging area is gone
+        self.assertEqual(self.tree(), [ "bootstrapfs-lxc.tar.sha1sum",
+                                        "etc", "etc/fstab", "etc/hostname",
+                                        "usr", "usr/bin", "usr/bin/tool" ])
+        self.assertEqual(self.read("etc/fstab"), "fstab\n")
+        self.assertEqual(self.read("usr/bin/tool"), "new tool\n")
+        self.assertEqual(self.read("etc/hostname"), "old\n")
+
+    def test_sha1_mismatch(self):
+        self.server.files[HASH_FILE] = "{}  bootstrapfs-lxc.tar\n".format("0" * 40)
+        self.assertRaises(BootManagerException, self.stream)
+        self.check_rolled_back()
+
+    def test_broken_tarball(self):
+        self.server.files[TARBALL] = self.tarball[:1000] + "garbage" * 100
+        self.assertRaises(BootManagerException, self.stream)
+        self.check_rolled_back()
+
+    def test_missing_tarball(self):
+        del self.server.files[TARBALL]
+        self.assertEqual(self.stream(), 0)
+        self.check_rolled_back()
+
+    def test_leftover_staging(self):
+        # from an attempt that was interrupted
+        self.write(InstallBootstrapFS.STAGING_DIR + "/etc/stale", "stale\n")
+        self.assertEqual(self.stream(), 1)
+        self.assertFalse(os.path.exists(os.path.join(self.sysimg, "etc/stale")))
+        self.assertFalse(os.path.exists(os.path.join(self.sysimg,
+                                                     InstallBootstrapFS.STAGING_DIR)))
+
+    def test_fill_cache(self):
+        cache = BootstrapFSCache.BootstrapFSCache(os.path.join(self.dir, "cache"),
+                                                  1 << 20, self.log)
+        self.assertEqual(self.stream(cache, fill_cache = True), 1)
+        cached = cache.lookup(self.sha1)
+        self.assertNotEqual(cached, None)
+        with open(cached) as input:
+            self.assertEqual(input.read(), self.tarball)
+        # now extracted from the cache
+        del self.server.files[TARBALL]
+        os.remove(os.path.join(self.sysimg, "etc/fstab"))
+        self.assertEqual(self.stream(cache, fill_cache = True), 1)
+        self.assertEqual(self.read("etc/fstab"), "fstab\n")
+
+    def test_cache_not_filled_on_mismatch(self):
+        cache = BootstrapFSCache.BootstrapFSCache(os.path.join(self.dir, "cache"),
+                                                  1 << 20, self.log)
+        self.server.files[TARBALL] = make_tarball({ "etc/fstab": "other\n" })
+        self.assertRaises(BootManagerException, self.stream, cache, True)
+        self.assertEqual(cache.lookup(self.sha1), None)
+        self.assertEqual(os.listdir(cache.path), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
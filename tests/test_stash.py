@@ -0,0 +1,174 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2004-2007 The Trustees of Princeton University
+# All rights reserved.
+
+"""
+the stash of api results kept for disconnected operation: its journal
+on the Stash device, which stands in a temp file here, and the
+migration from the pickled list saved by older versions
+
+run from the top of the tree with
+  python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import shutil
+import cPickle
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "source"))
+
+import BootAPI
+from Exceptions import BootManagerException
+
+
+class FileStash(file):
+    """
+    stands for BootAPI.Stash, without mounting a device
+    """
+
+    path = None
+
+    def __init__(self, vars, mode):
+        if not os.path.exists(self.path):
+            open(self.path, 'a').close()
+        file.__init__(self, self.path, mode)
+
+
+class StashTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        FileStash.path = os.path.join(self.dir, "api.cache")
+        self.stash_class = BootAPI.Stash
+        BootAPI.Stash = FileStash
+        self.reset()
+        # no API server, as when disconnected
+        self.vars = { 'DISCONNECTED_OPERATION': 'uuid',
+                      'API_SERVER_INST': None }
+
+    def tearDown(self):
+        BootAPI.Stash = self.stash_class
+        self.reset()
+        shutil.rmtree(self.dir)
+
+    def reset(self):
+        """
+        start over, as on the next boot
+        """
+        BootAPI.stash = {}
+        BootAPI.stash_loaded = False
+        BootAPI.stash_pending = []
+
+    def call(self, function, *params):
+        return BootAPI.call_api_function(self.vars, function, params)
+
+    def contents(self):
+        with open(FileStash.path, 'rb') as f:
+            return f.read()
+
+    def journal(self):
+        with open(FileStash.path, 'rb') as f:
+            return BootAPI.read_journal(f)
+
+    def test_format(self):
+        BootAPI.stash_result('GetNodes', ({ 'node_id': 1 }, ['boot_state']), [{ 'boot_state': 'boot' }])
+        BootAPI.stash_result('GetNodeFlavour', (1,), { 'virt': 'lxc' })
+        BootAPI.save(self.vars)
+        self.assertTrue(self.contents().startswith("{} {}\n".format(BootAPI.STASH_MAGIC,
+                                                                    BootAPI.STASH_VERSION)))
+        (records, current) = self.journal()
+        self.assertTrue(current)
+        self.assertEqual(records,
+                         [ (('GetNodes', (('dict', ('node_id', 1)), ('boot_state',))),
+                            [{ 'boot_state': 'boot' }]),
+                           (('GetNodeFlavour', (1,)), { 'virt': 'lxc' }) ])
+
+    def test_lazy_load(self):
+        BootAPI.stash_result('GetNodes', ({ 'node_id': 1, 'x': 2 },), ['first'])
+        BootAPI.save(self.vars)
+        self.reset()
+        self.assertFalse(BootAPI.stash_loaded)
+        # whatever the order of the keys
+        self.assertEqual(self.call('GetNodes', { 'x': 2, 'node_id': 1 }), ['first'])
+        self.assertTrue(BootAPI.stash_loaded)
+        self.assertRaises(BootManagerException, self.call, 'GetNodes', { 'node_id': 2 })
+
+    def test_append(self):
+        BootAPI.stash_result('GetNodes', (1,), ['first'])
+        BootAPI.save(self.vars)
+        before = self.contents()
+        self.reset()
+        BootAPI.stash_result('GetInterfaces', (1,), ['interface'])
+        BootAPI.save(self.vars)
+        self.assertTrue(self.contents().startswith(before))
+        self.assertEqual(len(self.journal()[0]), 2)
+        # nothing new, nothing written
+        BootAPI.save(self.vars)
+        self.assertEqual(len(self.journal()[0]), 2)
+
+    def test_latest_wins(self):
+        for boot in range(10):
+            self.reset()
+            BootAPI.stash_result('GetNodes', (1,), ['boot {}'.format(boot)])
+            BootAPI.stash_result('GetNodeFlavour', (1,), { 'virt': 'lxc' })
+            BootAPI.save(self.vars)
+            (records, current) = self.journal()
+            # compacted before it holds more than twice the calls
+            self.assertTrue(len(records) <= 4)
+        self.reset()
+        self.assertEqual(self.call('GetNodes', 1), ['boot 9'])
+
+    def test_results_of_this_run_win(self):
+        BootAPI.stash_result('GetNodes', (1,), ['saved'])
+        BootAPI.save(self.vars)
+        self.reset()
+        BootAPI.stash_result('GetNodes', (1,), ['this run'])
+        self.assertEqual(self.call('GetNodes', 1), ['this run'])
+
+    def test_migration(self):
+        # as saved by older versions
+        with open(FileStash.path, 'wb') as f:
+            cPickle.dump([ ['GetNodes', (1,), ['old']],
+                           ['GetNodeFlavour', (1,), { 'virt': 'vs' }],
+                           ['GetNodes', (1,), ['older but later']] ], f)
+        self.assertEqual(self.call('GetNodes', 1), ['older but later'])
+        self.assertEqual(self.call('GetNodeFlavour', 1), { 'virt': 'vs' })
+        self.assertEqual(self.journal()[1], False)
+        # rewritten in the current format on the next save
+        BootAPI.stash_result('GetInterfaces', (1,), ['interface'])
+        BootAPI.save(self.vars)
+        (records, current) = self.journal()
+        self.assertTrue(current)
+        self.assertEqual(dict(records),
+                         { ('GetNodes', (1,)): ['older but later'],
+                           ('GetNodeFlavour', (1,)): { 'virt': 'vs' },
+                           ('GetInterfaces', (1,)): ['interface'] })
+
+    def test_interrupted_save(self):
+        BootAPI.stash_result('GetNodes', (1,), ['first'])
+        BootAPI.stash_result('GetInterfaces', (1,), ['interface'])
+        BootAPI.save(self.vars)
+        with open(FileStash.path, 'r+b') as f:
+            f.truncate(len(self.contents()) - 5)
+        self.reset()
+        self.assertEqual(self.call('GetNodes', 1), ['first'])
+        self.assertEqual(self.journal(), ([ (('GetNodes', (1,)), ['first']) ], False))
+        BootAPI.stash_result('GetNodeFlavour', (1,), { 'virt': 'lxc' })
+        BootAPI.save(self.vars)
+        (records, current) = self.journal()
+        self.assertTrue(current)
+        self.assertEqual(len(records), 2)
+
+    def test_unsupported_version(self):
+        with open(FileStash.path, 'wb') as f:
+            f.write("{} {}\n".format(BootAPI.STASH_MAGIC, BootAPI.STASH_VERSION + 1))
+        self.assertRaises(BootManagerException, self.call, 'GetNodes', 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
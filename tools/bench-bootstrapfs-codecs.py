@@ -0,0 +1,86 @@
+#!/usr/bin/python
+#
+# Copyright (c) 2004-2007 The Trustees of Princeton University
+# All rights reserved.
+#
+# compare the wall-clock time needed to extract a bootstrapfs-like
+# tarball with each of the codecs supported by InstallBootstrapFS
+#
+# usage: bench-bootstrapfs-codecs.py [-n runs] <sample-tree>
+# e.g.   bench-bootstrapfs-codecs.py /vservers/.vref/some-image
+
+from __future__ import print_function
+
+import os, sys
+import getopt
+import shutil
+import subprocess
+import tempfile
+import time
+
+# keep in sync with CODECS in source/steps/InstallBootstrapFS.py
+# (name, suffix, program, tar compress/uncompress option)
+CODECS = [
+    ('plain',  '.tar',     'tar',    ''),
+    ('bzip2',  '.tar.bz2', 'bzip2',  '-j'),
+    ('lbzip2', '.tar.bz2', 'lbzip2', '--use-compress-program=lbzip2'),
+    ('pbzip2', '.tar.bz2', 'pbzip2', '--use-compress-program=pbzip2'),
+    ('xz',     '.tar.xz',  'xz',     '-J'),
+    ('zst',    '.tar.zst', 'zstd',   '--use-compress-program=zstd'),
+]
+
+def find_program(program):
+    for path in os.environ.get('PATH', '').split(':'):
+        candidate = os.path.join(path, program)
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return candidate
+    return None
+
+def run(cmd):
+    start = time.time()
+    subprocess.check_call(cmd, shell=True)
+    return time.time() - start
+
+def usage():
+    print("Usage: {} [-n runs] <sample-tree>".format(sys.argv[0]))
+    sys.exit(1)
+
+def main():
+    try:
+        opt_list, arg_list = getopt.getopt(sys.argv[1:], "n:h")
+    except getopt.GetoptError:
+        usage()
+    runs = 3
+    for opt, arg in opt_list:
+        if opt == "-n":
+            runs = int(arg)
+        else:
+            usage()
+    if len(arg_list) != 1 or not os.path.isdir(arg_list[0]):
+        usage()
+    tree = arg_list[0]
+
+    workdir = tempfile.mkdtemp(prefix="bench-codecs-")
+    try:
+        print("{:<8} {:>12} {:>10} {:>10}".format("codec", "size", "create", "extract"))
+        for (name, suffix, program, option) in CODECS:
+            if find_program(program) is None:
+                print("{:<8} {:>12}".format(name, "not installed"))
+                continue
+            archive = os.path.join(workdir, "bootstrapfs-bench-{}{}".format(name, suffix))
+            create = run("tar -C {} -cpf {} {} .".format(tree, archive, option))
+            size = os.path.getsize(archive)
+            timings = []
+            for i in range(runs):
+                target = os.path.join(workdir, "extract")
+                os.mkdir(target)
+                timings.append(run("tar -C {} -xpf {} {}".format(target, archive, option)))
+                shutil.rmtree(target)
+            os.unlink(archive)
+            print("{:<8} {:>12} {:>9.1f}s {:>9.1f}s"
+                  .format(name, size, create, min(timings)))
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    main()